@@ -32,13 +32,21 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
 
 from src.local.butler import common, constants, guard
 from src.local.butler.modules import fix_module_search_paths
+# Imported without the src prefix like the command modules do, so that they
+# all share the same profiler.
+from local.butler import profiler
 
 guard.check()
 
 @click.group()
-def cli():
+@click.option('--profile', is_flag=True, help='Record how long each phase of the command takes, print a summary and write a Chrome trace.')
+@click.option('--profile-output', default='butler-trace.json', type=click.Path(dir_okay=False), help='Chrome trace-event JSON file written with --profile.')
+@click.pass_context
+def cli(ctx, profile, profile_output):
     """Butler is here to help you with command-line tasks."""
-    pass
+    if profile:
+        profiler.enable(profile_output)
+        ctx.with_resource(profiler.span(ctx.invoked_subcommand, 'command'))
 
 @cli.command()
 @click.option('-r', '--only-reproduce', is_flag=True, help='Only install dependencies needed for the reproduce tool.')
@@ -56,11 +64,25 @@ def bootstrap(only_reproduce, packages):
 @click.option('--skip-install-deps', is_flag=True, help='Skip installing dependencies before running.')
 @click.option('--log-level', default='info', help='Logging level.')
 @click.option('--clean', is_flag=True, help='Clear existing database data.')
-def run_server(bootstrap, storage_path, skip_install_deps, log_level, clean):
+@click.option('--recreate-containers', is_flag=True, help='Recreate the database, queue and minio containers even if they are running and healthy.')
+@click.option('--prod', is_flag=True, help='Serve with a multi-worker gunicorn server instead of the Django dev server.')
+@click.option('--workers', default=0, help='Number of gunicorn workers with --prod. Defaults to twice the CPU count plus one.')
+@click.option('--django-settings', default='PinguBackend.settings.development', help='Django settings module of the server.')
+def run_server(bootstrap, storage_path, skip_install_deps, log_level, clean, recreate_containers, prod, workers, django_settings):
     """Run the local PinguCrew server."""
     command = importlib.import_module('src.local.butler.run_server')
     _setup('backend')
-    args = Namespace(bootstrap=bootstrap, storage_path=storage_path, skip_install_deps=skip_install_deps, log_level=log_level, clean=clean)
+    args = Namespace(bootstrap=bootstrap, storage_path=storage_path, skip_install_deps=skip_install_deps, log_level=log_level, clean=clean, recreate_containers=recreate_containers, prod=prod, workers=workers, django_settings=django_settings)
+    command.execute(args)
+
+@cli.command()
+@click.option('-c', '--config-dir', help='Config directory holding redis/config.yaml. Defaults to configs.')
+@click.option('--force', is_flag=True, help='Recreate queues whose type or priority changed even if they hold messages.')
+def queues(config_dir, force):
+    """Declare the queues and reconcile their options."""
+    command = importlib.import_module('src.local.butler.queues')
+    _setup(None)
+    args = Namespace(config_dir=config_dir, force=force)
     command.execute(args)
 
 @cli.command()
@@ -82,27 +104,130 @@ def run(script_name, non_dry_run, config_dir, local):
 @click.argument('directory')
 @click.option('--android-serial', help='Serial number of an Android device to connect to.')
 @click.option('--testing', is_flag=True, help='Run in testing mode.')
-def run_bot(config_dir, name, server_storage_path, directory, android_serial, testing):
-    """Run a local bot."""
+@click.option('--count', default=1, type=click.IntRange(min=1), help='Number of bots to run, sharing one source snapshot.')
+@click.option('--max-rss-mb', type=int, help='Kill a bot whose process tree stays over this resident memory.')
+@click.option('--max-open-fds', type=int, help='Kill a bot whose process tree stays over this many open file descriptors.')
+@click.option('--max-child-processes', type=int, help='Kill a bot that stays over this many descendant processes.')
+@click.option('--max-cpu-percent', type=int, help='Kill a bot whose process tree stays over this CPU use, in percent of one core.')
+@click.option('--metrics-file', type=click.Path(dir_okay=False), help='Prometheus textfile to export per-bot resource metrics to.')
+@click.option('--log-dir', type=click.Path(file_okay=False), help='Directory of the compressed bot logs. Defaults to DIRECTORY/logs.')
+@click.option('--log-segment-mb', default=64, type=click.IntRange(min=1), help='Uncompressed size at which bot log segments are rotated.')
+@click.option('--echo-logs/--no-echo-logs', default=None, help='Also print bot output to the console. Defaults to on when the console is a terminal.')
+@click.option('--upload-logs', is_flag=True, help='Upload finished bot log segments to FUZZ_LOGS_BUCKET.')
+def run_bot(config_dir, name, server_storage_path, directory, android_serial, testing, count, max_rss_mb, max_open_fds, max_child_processes, max_cpu_percent, metrics_file, log_dir, log_segment_mb, echo_logs, upload_logs):
+    """Run local bots."""
     command = importlib.import_module('src.local.butler.run_bot')
     _setup('pingubot')
-    args = Namespace(config_dir=config_dir, name=name, server_storage_path=server_storage_path, directory=directory, android_serial=android_serial, testing=testing)
+    args = Namespace(config_dir=config_dir, name=name, server_storage_path=server_storage_path, directory=directory, android_serial=android_serial, testing=testing, count=count, max_rss_mb=max_rss_mb, max_open_fds=max_open_fds, max_child_processes=max_child_processes, max_cpu_percent=max_cpu_percent, metrics_file=metrics_file, log_dir=log_dir, log_segment_mb=log_segment_mb, echo_logs=echo_logs, upload_logs=upload_logs)
+    command.execute(args)
+
+@cli.command()
+@click.option('-c', '--config-dir', help='Config directory holding redis/config.yaml. Defaults to configs.')
+@click.option('--kind', default='bot', type=click.Choice(['bot', 'verifier']), help='Kind of processes to scale.')
+@click.option('-q', '--queue', multiple=True, help='Queue whose load drives the scaling. Repeat for several queues. Defaults to every configured queue.')
+@click.option('--min', 'min_count', default=1, type=click.IntRange(min=0), help='Least number of processes to run.')
+@click.option('--max', 'max_count', default=4, type=click.IntRange(min=0), help='Most number of processes to run.')
+@click.option('--messages-per-process', default=10, type=click.IntRange(min=1), help='Ready messages per consumer above which processes are added.')
+@click.option('--interval', default=30, type=click.IntRange(min=1), help='Seconds between queue polls.')
+@click.option('--scale-up-polls', default=2, type=click.IntRange(min=1), help='Consecutive polls asking for more processes before scaling up.')
+@click.option('--scale-down-polls', default=6, type=click.IntRange(min=1), help='Consecutive polls asking for fewer processes before scaling down.')
+@click.option('--cooldown', default=120, type=click.IntRange(min=0), help='Least number of seconds between two scaling changes.')
+@click.option('--management-url', help='Base URL of the RabbitMQ management API, e.g. http://localhost:15672/api. Defaults to the broker of the queue config.')
+@click.option('--verifier', help='Module of the verifier to run with --kind verifier, e.g. src.verifier.dummy_verifier.DummyVerifier.')
+@click.option('--name', help='Name prefix of the processes. Defaults to the kind.')
+@click.option('-d', '--directory', default='local/bots', help='Directory of the bots.')
+@click.option('--max-rss-mb', type=int, help='Kill a bot whose process tree stays over this resident memory.')
+@click.option('--metrics-file', type=click.Path(dir_okay=False), help='Prometheus textfile to export per-process resource metrics to.')
+@click.option('--log-dir', type=click.Path(file_okay=False), help='Directory of the compressed bot logs. Defaults to DIRECTORY/logs.')
+@click.option('--echo-logs/--no-echo-logs', default=None, help='Also print bot output to the console. Defaults to on when the console is a terminal.')
+def autoscale(config_dir, kind, queue, min_count, max_count, messages_per_process, interval, scale_up_polls, scale_down_polls, cooldown, management_url, verifier, name, directory, max_rss_mb, metrics_file, log_dir, echo_logs):
+    """Scale local bots or verifiers with the load of their queues."""
+    command = importlib.import_module('src.local.butler.autoscale')
+    _setup('pingubot' if kind == 'bot' else None)
+    args = Namespace(config_dir=config_dir, kind=kind, queue=queue, min=min_count, max=max_count, messages_per_process=messages_per_process, interval=interval, scale_up_polls=scale_up_polls, scale_down_polls=scale_down_polls, cooldown=cooldown, management_url=management_url, verifier=verifier, name=name or kind, directory=directory, testing=False, android_serial=None, max_rss_mb=max_rss_mb, max_open_fds=None, max_child_processes=None, max_cpu_percent=None, metrics_file=metrics_file, log_dir=log_dir, log_segment_mb=64, echo_logs=echo_logs, upload_logs=False)
     command.execute(args)
 
 @cli.command()
-@click.option('-t', '--testcase', required=True, help='Testcase URL.')
-@click.option('-b', '--build-dir', required=True, help='Build directory containing the target app and dependencies.')
+@click.option('-b', '--bucket', envvar='DEPLOYMENT_BUCKET', required=True, help='Deployment bucket holding the bot sources. Defaults to DEPLOYMENT_BUCKET.')
+@click.option('--platform', type=click.Choice(['linux', 'macos', 'windows']), help='Platform of the bot sources. Defaults to the current platform.')
+@click.argument('directory')
+def update_source(bucket, platform, directory):
+    """Update bot sources, downloading only the files that changed."""
+    command = importlib.import_module('src.local.butler.bot_source')
+    _setup(None)
+    args = Namespace(bucket=bucket, platform=platform, directory=directory)
+    command.execute(args)
+
+@cli.command()
+@click.option('-t', '--testcase', multiple=True, help='Testcase ID. Repeat to reproduce several test cases in batch mode.')
+@click.option('-b', '--build-dir', multiple=True, help='Build directory containing the target app and dependencies. Repeat to compare several sanitizer builds.')
 @click.option('-i', '--iterations', default=10, help='Number of times to attempt reproduction.')
 @click.option('-dx', '--disable-xvfb', is_flag=True, help='Disable running test case in a virtual frame buffer.')
 @click.option('-da', '--disable-android-setup', is_flag=True, help='Skip Android device setup.')
 @click.option('-v', '--verbose', is_flag=True, help='Print additional log messages.')
 @click.option('-e', '--emulator', is_flag=True, help='Run using the Android emulator.')
 @click.option('-a', '--application', help='Name of the application binary to run.')
-def reproduce(testcase, build_dir, iterations, disable_xvfb, disable_android_setup, verbose, emulator, application):
+@click.option('-j', '--jobs', default=1, type=click.IntRange(min=1), help='Number of reproduction attempts to run concurrently.')
+@click.option('--estimate-reproducibility', is_flag=True, help='Keep running attempts after a reproduction to estimate how reliably the test case crashes.')
+@click.option('--testcase-file', type=click.Path(exists=True, dir_okay=False), help='File with one testcase ID per line to reproduce in batch mode.')
+@click.option('--job', help='Reproduce all testcases of this job ID in batch mode.')
+@click.option('--fuzzer', help='Reproduce all testcases of this fuzzer ID in batch mode.')
+@click.option('-o', '--output', default='-', help='Batch mode JSONL report path (- for stdout).')
+@click.option('-w', '--workers', default=os.cpu_count(), type=click.IntRange(min=1), help='Number of testcases reproduced concurrently in batch mode.')
+@click.option('--fetch-build', is_flag=True, help='Download the build of the testcase revision into the local build cache instead of using --build-dir.')
+@click.option('--build-cache-size', default=20, type=click.FloatRange(min=0), help='Maximum size of the local build cache in GB.')
+@click.option('--memory-inputs', is_flag=True, help='Materialize testcases in a memory backed directory (/dev/shm).')
+@click.option('--member-only', is_flag=True, help='Only extract the testcase file itself from an archived testcase instead of the whole archive.')
+@click.option('--emulator-count', default=1, type=click.IntRange(min=1), help='Number of Android emulators to boot with --emulator. More than one needs --all-devices.')
+@click.option('--all-devices', is_flag=True, help='Install the build on every attached Android device or emulator and spread attempts across them.')
+@click.option('--fork-server', is_flag=True, help='Start Linux blackbox targets once and fork a fresh child for every attempt.')
+@click.option('--watch', is_flag=True, help='Keep the environment alive and re-run the attempts whenever --build-dir changes.')
+def reproduce(testcase, build_dir, iterations, disable_xvfb, disable_android_setup, verbose, emulator, application, jobs, estimate_reproducibility, testcase_file, job, fuzzer, output, workers, fetch_build, build_cache_size, memory_inputs, member_only, emulator_count, all_devices, fork_server, watch):
     """Reproduce a crash or error from a test case."""
     command = importlib.import_module('src.local.butler.reproduce')
     _setup(None)
-    args = Namespace(testcase=testcase, build_dir=build_dir, iterations=iterations, disable_xvfb=disable_xvfb, disable_android_setup=disable_android_setup, verbose=verbose, emulator=emulator, application=application)
+    args = Namespace(testcase=testcase, build_dir=build_dir, iterations=iterations, disable_xvfb=disable_xvfb, disable_android_setup=disable_android_setup, verbose=verbose, emulator=emulator, application=application, jobs=jobs, estimate_reproducibility=estimate_reproducibility, testcase_file=testcase_file, job=job, fuzzer=fuzzer, output=output, workers=workers, fetch_build=fetch_build, build_cache_size=build_cache_size, memory_inputs=memory_inputs, member_only=member_only, emulator_count=emulator_count, all_devices=all_devices, fork_server=fork_server, watch=watch)
+    command.execute(args)
+
+@cli.command()
+@click.option('-t', '--testcase', required=True, help='Testcase ID.')
+@click.option('-b', '--build-dir', help='Build directory containing the target app and dependencies.')
+@click.option('--fetch-build', is_flag=True, help='Download the build of the testcase revision into the local build cache instead of using --build-dir.')
+@click.option('--build-cache-size', default=20, type=click.FloatRange(min=0), help='Maximum size of the local build cache in GB.')
+@click.option('-i', '--iterations', default=1, type=click.IntRange(min=1), help='Number of times to try each candidate before discarding it.')
+@click.option('-w', '--workers', default=os.cpu_count(), type=click.IntRange(min=1), help='Number of candidates tested concurrently.')
+@click.option('-o', '--output', help='Path of the minimized testcase (minimized-<testcase><ext> by default).')
+@click.option('-a', '--application', help='Name of the application binary to run.')
+@click.option('-dx', '--disable-xvfb', is_flag=True, help='Disable running test case in a virtual frame buffer.')
+@click.option('-v', '--verbose', is_flag=True, help='Print additional log messages.')
+@click.option('--fork-server', is_flag=True, help='Start Linux blackbox targets once and fork a fresh child for every candidate.')
+@click.option('--memory-inputs', is_flag=True, help='Materialize testcases in a memory backed directory (/dev/shm).')
+@click.option('--member-only', is_flag=True, help='Only extract the testcase file itself from an archived testcase instead of the whole archive.')
+def minimize(testcase, build_dir, fetch_build, build_cache_size, iterations, workers, output, application, disable_xvfb, verbose, fork_server, memory_inputs, member_only):
+    """Minimize a test case locally."""
+    command = importlib.import_module('src.local.butler.minimize')
+    _setup(None)
+    args = Namespace(testcase=testcase, build_dir=build_dir, fetch_build=fetch_build, build_cache_size=build_cache_size, iterations=iterations, workers=workers, output=output, application=application, disable_xvfb=disable_xvfb, verbose=verbose, fork_server=fork_server, memory_inputs=memory_inputs, member_only=member_only)
+    command.execute(args)
+
+@cli.command()
+@click.option('-t', '--testcase', required=True, help='Testcase ID.')
+@click.option('--fixed', is_flag=True, help='Find the range that fixed the crash instead of the one that introduced it.')
+@click.option('--start', type=int, help='Lowest revision to consider.')
+@click.option('--end', type=int, help='Highest revision to consider.')
+@click.option('-i', '--iterations', default=3, type=click.IntRange(min=1), help='Number of times to attempt reproduction on each revision.')
+@click.option('-w', '--workers', default=os.cpu_count(), type=click.IntRange(min=1), help='Number of revisions fetched and tested concurrently.')
+@click.option('--build-cache-size', default=20, type=click.FloatRange(min=0), help='Maximum size of the local build cache in GB. Builds being tested are never evicted.')
+@click.option('-a', '--application', help='Name of the application binary to run.')
+@click.option('-dx', '--disable-xvfb', is_flag=True, help='Disable running test case in a virtual frame buffer.')
+@click.option('-v', '--verbose', is_flag=True, help='Print additional log messages.')
+@click.option('--memory-inputs', is_flag=True, help='Materialize testcases in a memory backed directory (/dev/shm).')
+@click.option('--member-only', is_flag=True, help='Only extract the testcase file itself from an archived testcase instead of the whole archive.')
+def bisect(testcase, fixed, start, end, iterations, workers, build_cache_size, application, disable_xvfb, verbose, memory_inputs, member_only):
+    """Find the revision range that introduced or fixed a crash."""
+    command = importlib.import_module('src.local.butler.bisect')
+    _setup(None)
+    args = Namespace(testcase=testcase, fixed=fixed, start=start, end=end, iterations=iterations, workers=workers, build_cache_size=build_cache_size, application=application, disable_xvfb=disable_xvfb, verbose=verbose, memory_inputs=memory_inputs, member_only=member_only)
     command.execute(args)
 
 @cli.command()
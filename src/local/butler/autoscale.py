@@ -0,0 +1,272 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""autoscale.py scales the number of local bots or verifiers with the depth
+of the queues they consume.
+
+Every poll reads the ready and unacknowledged messages and the consumers of
+the queues from the RabbitMQ management API. The process count only changes
+once the same decision held for several consecutive polls and the cooldown
+since the last change passed, so that bursty queues don't make processes
+flap."""
+import configparser
+import math
+import os
+import signal
+import sys
+import time
+
+from local.butler import queues
+from local.butler import run_bot
+from local.butler import supervisor
+
+POLL_INTERVAL = 30
+MESSAGES_PER_PROCESS = 10
+SCALE_UP_POLLS = 2
+# Scaling down waits longer than scaling up, a queue that just emptied often
+# fills up again.
+SCALE_DOWN_POLLS = 6
+COOLDOWN = 120
+VERIFIER_CONFIG_FILENAME = 'verifier.cfg'
+
+
+def get_queue_load(api, queue_names):
+    """Return the ready and unacknowledged messages summed over
+    |queue_names| and the most consumers of any of them. A process consuming
+    several of the queues holds one consumer on each, so consumers are not
+    summed. Queues that don't exist yet count as empty."""
+    existing = api.get_queues()
+    ready = unacknowledged = consumers = 0
+    for name in queue_names:
+        queue = existing.get(name) or {}
+        ready += queue.get('messages_ready', 0)
+        unacknowledged += queue.get('messages_unacknowledged', 0)
+        consumers = max(consumers, queue.get('consumers', 0))
+    return ready, unacknowledged, consumers
+
+
+class ScalingPolicy(object):
+    """Turns queue load into a process count, with hysteresis."""
+
+    def __init__(self,
+                 min_count,
+                 max_count,
+                 messages_per_process=MESSAGES_PER_PROCESS,
+                 scale_up_polls=SCALE_UP_POLLS,
+                 scale_down_polls=SCALE_DOWN_POLLS,
+                 cooldown=COOLDOWN):
+        if not 0 <= min_count <= max_count:
+            raise ValueError('The process bounds must satisfy '
+                             '0 <= min <= max.')
+        self.min_count = min_count
+        self.max_count = max_count
+        self.messages_per_process = messages_per_process
+        self.scale_up_polls = scale_up_polls
+        self.scale_down_polls = scale_down_polls
+        self.cooldown = cooldown
+        self._direction = 0
+        self._polls = 0
+        self._changed_at = None
+
+    def get_wanted_count(self, ready, unacknowledged, consumers, current):
+        """Return how many local processes would leave at most
+        |messages_per_process| ready messages per consumer. Consumers beyond
+        the |current| local processes belong to other hosts.
+
+        Processes holding |unacknowledged| messages are busy, and are never
+        scaled away. Remote consumers are assumed to be the busy ones
+        first."""
+        remote_consumers = max(0, consumers - current)
+        wanted = (math.ceil(ready / self.messages_per_process) -
+                  remote_consumers)
+        busy = min(current, max(0, unacknowledged - remote_consumers))
+        return max(self.min_count, min(self.max_count, max(wanted, busy)))
+
+    def decide(self, ready, unacknowledged, consumers, current, now):
+        """Return the number of processes to run after a poll at |now|."""
+        if not self.min_count <= current <= self.max_count:
+            return max(self.min_count, min(self.max_count, current))
+
+        wanted = self.get_wanted_count(ready, unacknowledged, consumers,
+                                       current)
+        direction = (wanted > current) - (wanted < current)
+        if direction != self._direction:
+            self._direction = direction
+            self._polls = 0
+        if not direction:
+            return current
+
+        self._polls += 1
+        polls = self.scale_up_polls if direction > 0 else self.scale_down_polls
+        if self._polls < polls:
+            return current
+        if (self._changed_at is not None and
+                now - self._changed_at < self.cooldown):
+            return current
+
+        self._polls = 0
+        self._changed_at = now
+        return wanted
+
+
+class Autoscaler(object):
+    """Supervisor poll hook that adds or removes processes with the load of
+    the queues."""
+
+    def __init__(self, api, queue_names, policy, create_process,
+                 interval=POLL_INTERVAL):
+        self.api = api
+        self.queue_names = queue_names
+        self.policy = policy
+        self.create_process = create_process
+        self.interval = interval
+        self._next_poll = time.time() + interval
+
+    def __call__(self, process_supervisor):
+        now = time.time()
+        if now < self._next_poll:
+            return
+        self._next_poll = now + self.interval
+
+        processes = process_supervisor.processes
+        try:
+            ready, unacknowledged, consumers = get_queue_load(
+                self.api, self.queue_names)
+        except (OSError, ValueError) as e:
+            # URLError is an OSError.
+            print('Failed to poll the queues, keeping %d processes: %s' %
+                  (len(processes), e))
+            return
+
+        count = self.policy.decide(ready, unacknowledged, consumers,
+                                   len(processes), now)
+        if count == len(processes):
+            return
+
+        print('Scaling from %d to %d processes, %d messages are ready and %d '
+              'in flight for %d consumers.' %
+              (len(processes), count, ready, unacknowledged, consumers))
+        # Processes are numbered by position, so the newest ones are stopped
+        # first and the numbers of the others never change.
+        if count < len(processes):
+            process_supervisor.remove(processes[count:])
+        while len(processes) < count:
+            process_supervisor.add(self.create_process(len(processes)))
+
+
+def get_verifier_queue(module_name):
+    """Return the in_queue of the verifier.cfg next to the verifier module
+    |module_name|, or None if it has none."""
+    config_path = os.path.join(os.environ['ROOT_DIR'],
+                               *module_name.split('.')[:-1],
+                               VERIFIER_CONFIG_FILENAME)
+    verifier_config = configparser.ConfigParser()
+    if not verifier_config.read(config_path):
+        return None
+    return verifier_config['DEFAULT'].get('in_queue')
+
+
+def _get_queue_names(args, config):
+    """Return the queues to scale on: |args.queue|, the queue of the verifier,
+    or every configured queue that bots consume."""
+    if args.queue:
+        return list(args.queue)
+
+    if args.kind == 'verifier':
+        queue_name = get_verifier_queue(args.verifier)
+        if not queue_name:
+            raise ValueError('%s has no %s with an in_queue, use --queue to '
+                             'name the queue it consumes.' %
+                             (args.verifier, VERIFIER_CONFIG_FILENAME))
+        return [queue_name]
+
+    queue_options = queues.get_queue_options(config)
+    dead_letter_queues = queues.get_dead_letter_queues(queue_options)
+    return [
+        options.name
+        for options in queue_options
+        if options.name not in dead_letter_queues
+    ]
+
+
+def _run_verifiers(args, config, queue_names, create_autoscaler):
+    # Verifiers consume a single queue.
+    prefetch_count = queues.get_prefetch_count(config, queue_names[0])
+
+    def create_verifier(index):
+        return supervisor.SupervisedProcess(
+            '%s-%d' % (args.name, index), [sys.executable, '-m', args.verifier],
+            extra_environments={
+                queues.PREFETCH_COUNT_ENV: str(prefetch_count)
+            },
+            cwd=os.environ['ROOT_DIR'])
+
+    verifier_supervisor = supervisor.Supervisor(
+        [create_verifier(index) for index in range(args.min)],
+        metrics_path=args.metrics_file,
+        metric_prefix='pingu_verifier')
+    signal.signal(signal.SIGTERM, verifier_supervisor.stop)
+    try:
+        verifier_supervisor.run(create_autoscaler(create_verifier))
+    except KeyboardInterrupt:
+        pass
+    print('Verifiers have been stopped. Exit.')
+
+
+def _run_bots(args, create_autoscaler):
+    command, snapshot_dir = run_bot.prepare_shared_bots(args)
+    # Cores are split for the largest number of bots, so that a bot keeps its
+    # cores however many others run.
+    bot_cpus = run_bot.get_bot_cpus(args.max)
+
+    def create_bot(index):
+        return run_bot.create_bot(args, command, snapshot_dir, index,
+                                  bot_cpus[index])
+
+    run_bot.supervise(args, [create_bot(index) for index in range(args.min)],
+                      on_poll=create_autoscaler(create_bot))
+
+
+def execute(args):
+    """Run bots or verifiers, scaling their number with the queue load."""
+    if args.kind == 'verifier' and not args.verifier:
+        print('--verifier is needed to scale verifiers.')
+        return
+
+    config = queues.load_config(args.config_dir)
+    try:
+        queue_names = _get_queue_names(args, config)
+        policy = ScalingPolicy(
+            args.min,
+            args.max,
+            messages_per_process=args.messages_per_process,
+            scale_up_polls=args.scale_up_polls,
+            scale_down_polls=args.scale_down_polls,
+            cooldown=args.cooldown)
+    except ValueError as e:
+        print(e)
+        return
+
+    api = queues.get_management_api(config, base_url=args.management_url)
+
+    def create_autoscaler(create_process):
+        return Autoscaler(api, queue_names, policy, create_process,
+                          interval=args.interval)
+
+    print('Scaling between %d and %d %ss on %s.' %
+          (args.min, args.max, args.kind, ', '.join(queue_names)))
+    if args.kind == 'verifier':
+        _run_verifiers(args, config, queue_names, create_autoscaler)
+    else:
+        _run_bots(args, create_autoscaler)
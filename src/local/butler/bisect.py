@@ -0,0 +1,175 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""bisect.py finds the revision range that introduced or fixed a crash."""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from src.local.butler import reproduce
+from pingu_sdk import testcase_manager
+from pingu_sdk.system import environment
+from pingu_sdk.system import shell
+from local.butler.reproduce_tool import bisection
+from local.butler.reproduce_tool import build_cache
+from local.butler.reproduce_tool import errors
+from local.butler.reproduce_tool import forkserver
+from local.butler.reproduce_tool import parallel
+from local.butler.reproduce_tool import xvfb
+
+# State shared with forked workers. Set right before the pool is created so
+# that it is inherited rather than pickled.
+_bisect_context = None
+
+
+def _test_revision(revision):
+  """Fetch the build of |revision| and test it in a worker. Returns the
+  revision and whether it reproduced the crash, or None if it could not be
+  tested."""
+  (testcase, testcase_path, crash, job_name, build_bucket_path, cache,
+   iterations, scratch_root) = _bisect_context
+
+  build_directory = scratch_directory = None
+  try:
+    # The build stays in use, so other workers can't evict it, until the
+    # revision is tested.
+    build_directory = cache.fetch(
+        job_name, revision,
+        build_cache.get_build_url(build_bucket_path, revision))
+    reproduce.use_build_directory(build_directory)
+
+    inputs_directory = environment.get_value('FUZZ_INPUTS')
+    scratch_directory = os.path.join(scratch_root,
+                                     'revision-{}'.format(revision))
+    shutil.copytree(inputs_directory, scratch_directory)
+    environment.set_value('FUZZ_INPUTS', scratch_directory)
+    revision_testcase_path = os.path.join(
+        scratch_directory, os.path.relpath(testcase_path, inputs_directory))
+
+    with xvfb.leased_display():
+      result = testcase_manager.test_for_crash_with_retries(
+          testcase,
+          revision_testcase_path,
+          environment.get_value('TEST_TIMEOUT'),
+          crash,
+          crash_retries=iterations)
+    return revision, forkserver.is_expected_crash(result, crash)
+  except Exception as e:
+    print('Unable to test revision {revision}: {error}'.format(
+        revision=revision, error=e))
+    return revision, None
+  finally:
+    if scratch_directory:
+      shell.remove_directory(scratch_directory)
+    if build_directory:
+      cache.release(build_directory)
+
+
+def _get_revision_range(revisions, crash_revision, fixed, start, end):
+  """Return the revisions to bisect, bounded by the crash revision."""
+  if crash_revision not in revisions:
+    raise errors.ReproduceToolUnrecoverableError(
+        'No build was found for the crash revision {revision}.'.format(
+            revision=crash_revision))
+
+  if fixed:
+    start = crash_revision
+  else:
+    end = crash_revision
+
+  return [
+      revision for revision in revisions
+      if (start is None or revision >= start) and
+      (end is None or revision <= end)
+  ]
+
+
+def _bisect(revisions, workers, fixed):
+  """Run the k-ary search with one worker per concurrently tested build."""
+  pool = multiprocessing.get_context('fork').Pool(
+      workers, initializer=parallel.initialize_worker, maxtasksperchild=1)
+
+  def _test_revisions(revisions_to_test):
+    results = {}
+    for revision, crashes in pool.imap_unordered(_test_revision,
+                                                 revisions_to_test):
+      if crashes is not None:
+        print('Revision {revision}: {outcome}.'.format(
+            revision=revision,
+            outcome='crashes' if crashes else 'does not crash'))
+        if fixed:
+          # A fix is a change from crashing to not crashing.
+          crashes = not crashes
+      results[revision] = crashes
+    return results
+
+  try:
+    return bisection.find_change(revisions, _test_revisions, workers)
+  finally:
+    parallel.terminate_pool(pool)
+
+
+def execute(args):
+  """Find the regression or fixed range of a test case's crash."""
+  global _bisect_context
+  reproduce.initialize()
+
+  cache = build_cache.BuildCache(max_size_gb=args.build_cache_size)
+  scratch_root = None
+  try:
+    # The environment is prepared with the crash revision's build, then each
+    # worker switches to the build it tests.
+    (testcase, testcase_related_job, testcase_related_crash, _,
+     testcase_path) = reproduce.setup_testcase_run(
+         args.testcase,
+         None,
+         args.verbose,
+         args.application,
+         cache=cache,
+         disable_xvfb=args.disable_xvfb,
+         display_count=args.workers,
+         memory_inputs=args.memory_inputs,
+         member_only=args.member_only)
+
+    build_bucket_path = build_cache.get_job_build_bucket_path(
+        testcase_related_job)
+    revisions = _get_revision_range(
+        build_cache.list_build_revisions(build_bucket_path),
+        int(testcase.crash_revision), args.fixed, args.start, args.end)
+    print('Bisecting {count} builds across {workers} workers...'.format(
+        count=len(revisions), workers=args.workers))
+
+    scratch_root = tempfile.mkdtemp(
+        prefix='bisect-',
+        dir=os.path.dirname(environment.get_value('FUZZ_INPUTS')))
+    _bisect_context = (testcase, testcase_path, testcase_related_crash,
+                       testcase_related_job.id, build_bucket_path, cache,
+                       args.iterations, scratch_root)
+    before, after = _bisect(revisions, args.workers, args.fixed)
+  except errors.ReproduceToolUnrecoverableError as exception:
+    print(exception)
+    return
+  except KeyboardInterrupt:
+    print('Aborting...')
+    return
+  finally:
+    _bisect_context = None
+    if scratch_root:
+      shell.remove_directory(scratch_root)
+    reproduce.cleanup()
+
+  print('{kind} range: {before}:{after}'.format(
+      kind='Fixed' if args.fixed else 'Regression', before=before, after=after))
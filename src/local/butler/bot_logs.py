@@ -0,0 +1,362 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""bot_logs.py persists bot output without ever blocking the bots.
+
+A single reader thread drains every bot's pipe with large non-blocking reads
+and hands the chunks to a writer thread. The writer appends them to
+compressed, size-rotated segment files with a time index, and an uploader
+thread ships finished segments to a bucket in batches. Segments are also
+closed once they are UPLOAD_INTERVAL old, so that quiet bots get their logs
+uploaded too. When the writer falls
+behind, output is dropped rather than letting the pipes fill up."""
+import gzip
+import json
+import os
+import queue
+import re
+import selectors
+import threading
+import time
+
+from local.butler import storage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+READ_SIZE = 1024 * 1024
+SEGMENT_SIZE = 64 * 1024 * 1024
+MAX_QUEUED_BYTES = 256 * 1024 * 1024
+# Seconds between time index entries of a bot.
+INDEX_INTERVAL = 1
+UPLOAD_INTERVAL = 60
+SEGMENT_MAX_AGE = UPLOAD_INTERVAL
+INDEX_FILENAME = 'index.jsonl'
+UPLOADED_FILENAME = 'uploaded'
+SEGMENT_REGEX = re.compile(r'^(\d+)\.log\.(zst|gz)$')
+
+
+def _open_compressed(path):
+    """Open |path| for writing with zstd if available, otherwise gzip."""
+    if zstandard:
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+
+    # Favour speed over ratio so that compression keeps up with the bots.
+    return gzip.open(path, 'wb', compresslevel=1)
+
+
+class _SegmentWriter(object):
+    """Writes the output of one bot to rotated segments and a time index."""
+
+    def __init__(self,
+                 directory,
+                 segment_size,
+                 on_segment_closed,
+                 segment_max_age=SEGMENT_MAX_AGE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_max_age = segment_max_age
+        self.on_segment_closed = on_segment_closed
+        os.makedirs(directory, exist_ok=True)
+        # Continue numbering after the segments of previous runs.
+        self._sequence = max([
+            int(match.group(1))
+            for match in map(SEGMENT_REGEX.match, os.listdir(directory))
+            if match
+        ] or [0])
+        self._index = open(os.path.join(directory, INDEX_FILENAME), 'a')
+        self._segment = None
+        self._segment_path = None
+        self._segment_bytes = 0
+        self._indexed_at = 0
+        self._opened_at = 0
+
+    def _open_segment(self):
+        self._sequence += 1
+        self._segment_path = os.path.join(
+            self.directory, '%06d.log.%s' % (self._sequence,
+                                            'zst' if zstandard else 'gz'))
+        self._segment = _open_compressed(self._segment_path)
+        self._segment_bytes = 0
+        self._indexed_at = 0
+        self._opened_at = time.time()
+
+    def _close_segment(self):
+        self._segment.close()
+        self.on_segment_closed(self._segment_path)
+        self._segment = None
+
+    def write(self, timestamp, data):
+        if self._segment is None:
+            self._open_segment()
+
+        if timestamp - self._indexed_at >= INDEX_INTERVAL:
+            self._index.write(json.dumps({
+                'time': timestamp,
+                'segment': os.path.basename(self._segment_path),
+                'offset': self._segment_bytes,
+            }) + '\n')
+            self._indexed_at = timestamp
+
+        self._segment.write(data)
+        self._segment_bytes += len(data)
+        if (self._segment_bytes >= self.segment_size or
+                timestamp - self._opened_at >= self.segment_max_age):
+            self._close_segment()
+
+    def close_if_old(self, now):
+        """Close the segment if it is |segment_max_age| old at |now|."""
+        if (self._segment is not None and
+                now - self._opened_at >= self.segment_max_age):
+            self._close_segment()
+
+    def flush(self):
+        """Make what was written so far readable, closing the segment if it
+        is old enough."""
+        self.close_if_old(time.time())
+        if self._segment is not None:
+            self._segment.flush()
+        self._index.flush()
+
+    def close(self):
+        if self._segment is not None:
+            self._close_segment()
+        self._index.close()
+
+
+class LogPipeline(object):
+    """Collects the output of supervised processes into per-process logs."""
+
+    def __init__(self,
+                 directory,
+                 segment_size=SEGMENT_SIZE,
+                 echo=False,
+                 upload_bucket=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.echo = echo
+        self.upload_bucket = upload_bucket
+        self.dropped_bytes = 0
+        self._writers = {}
+        self._chunks = queue.Queue()
+        self._queued_bytes = 0
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+        self._pending = []
+        self._stopped = threading.Event()
+        self._uploads = []
+        self._partial_lines = {}
+        self._swept_at = 0
+
+        self._threads = [
+            threading.Thread(target=self._read_loop, daemon=True),
+            threading.Thread(target=self._write_loop, daemon=True),
+        ]
+        if upload_bucket:
+            self._uploads.extend(self._get_unuploaded_segments())
+            self._threads.append(
+                threading.Thread(target=self._upload_loop, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def handle_output(self, name, proc):
+        """Supervisor output handler. Hands the process' pipe to the reader
+        thread and returns immediately."""
+        with self._lock:
+            self._pending.append((name, proc.stdout))
+        os.write(self._wakeup_write, b'\0')
+
+    def _read(self, key):
+        """Read a chunk from a pipe. Returns whether there may be more data
+        to read right away."""
+        name, pipe = key.data
+        try:
+            data = os.read(key.fd, READ_SIZE)
+        except BlockingIOError:
+            return False
+
+        if not data:
+            self._selector.unregister(key.fd)
+            pipe.close()
+            return False
+
+        self._enqueue(name, data)
+        return True
+
+    def _read_loop(self):
+        while not self._stopped.is_set():
+            for key, _ in self._selector.select():
+                if key.fd == self._wakeup_read:
+                    self._register_pending()
+                else:
+                    self._read(key)
+
+        # Drain what the stopped processes left in their pipes.
+        for key in list(self._selector.get_map().values()):
+            if key.fd != self._wakeup_read:
+                while self._read(key):
+                    pass
+
+    def _register_pending(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for name, pipe in pending:
+            os.set_blocking(pipe.fileno(), False)
+            self._selector.register(pipe.fileno(), selectors.EVENT_READ,
+                                    (name, pipe))
+
+    def _enqueue(self, name, data):
+        with self._lock:
+            if self._queued_bytes + len(data) > MAX_QUEUED_BYTES:
+                self.dropped_bytes += len(data)
+                return
+            self._queued_bytes += len(data)
+
+        self._chunks.put((name, time.time(), data))
+
+    def _get_writer(self, name):
+        if name not in self._writers:
+            self._writers[name] = _SegmentWriter(
+                os.path.join(self.directory, name), self.segment_size,
+                self._segment_closed)
+        return self._writers[name]
+
+    def _echo(self, name, data):
+        lines = (self._partial_lines.pop(name, b'') + data).split(b'\n')
+        self._partial_lines[name] = lines.pop()
+        for line in lines:
+            print('%s| %s' % (name, line.rstrip().decode('utf-8',
+                                                         errors='replace')))
+
+    def _sweep(self):
+        """Close the old segments of all bots, also of quiet ones while
+        others keep the queue busy."""
+        now = time.time()
+        if now - self._swept_at < INDEX_INTERVAL:
+            return
+
+        self._swept_at = now
+        for writer in self._writers.values():
+            writer.close_if_old(now)
+
+    def _write_loop(self):
+        while True:
+            try:
+                chunk = self._chunks.get(timeout=INDEX_INTERVAL)
+            except queue.Empty:
+                # Make what was written so far readable while the bots are
+                # quiet.
+                for writer in self._writers.values():
+                    writer.flush()
+                continue
+
+            if chunk is None:
+                break
+
+            name, timestamp, data = chunk
+            with self._lock:
+                self._queued_bytes -= len(data)
+            self._get_writer(name).write(timestamp, data)
+            if self.echo:
+                self._echo(name, data)
+            self._sweep()
+
+        for writer in self._writers.values():
+            writer.close()
+
+    def _segment_closed(self, path):
+        if self.upload_bucket:
+            with self._lock:
+                self._uploads.append(path)
+
+    def _get_unuploaded_segments(self):
+        """Return the finished segments of previous runs that were not
+        uploaded."""
+        if not os.path.exists(self.directory):
+            return []
+
+        uploaded = set()
+        uploaded_path = os.path.join(self.directory, UPLOADED_FILENAME)
+        if os.path.exists(uploaded_path):
+            with open(uploaded_path) as f:
+                uploaded = set(f.read().splitlines())
+
+        segments = []
+        for name in os.listdir(self.directory):
+            bot_directory = os.path.join(self.directory, name)
+            if not os.path.isdir(bot_directory):
+                continue
+            for filename in os.listdir(bot_directory):
+                path = os.path.join(bot_directory, filename)
+                if SEGMENT_REGEX.match(filename) and path not in uploaded:
+                    segments.append(path)
+
+        return sorted(segments)
+
+    def _upload_batch(self):
+        with self._lock:
+            batch, self._uploads = self._uploads, []
+        if not batch:
+            return
+
+        try:
+            client = storage.get_client()
+            for path in list(batch):
+                bot_directory = os.path.dirname(path)
+                prefix = 'bot-logs/%s/' % os.path.basename(bot_directory)
+                storage.upload_file(client, self.upload_bucket,
+                                    prefix + os.path.basename(path), path)
+                # Re-upload the index so that it covers the new segment.
+                storage.upload_file(
+                    client, self.upload_bucket, prefix + INDEX_FILENAME,
+                    os.path.join(bot_directory, INDEX_FILENAME),
+                    content_type='application/x-ndjson')
+                with open(os.path.join(self.directory, UPLOADED_FILENAME),
+                          'a') as f:
+                    f.write(path + '\n')
+                batch.remove(path)
+        except Exception as e:
+            print('Failed to upload bot logs, will retry: %s' % e)
+            with self._lock:
+                self._uploads = batch + self._uploads
+
+    def _upload_loop(self):
+        while not self._stopped.wait(UPLOAD_INTERVAL):
+            self._upload_batch()
+
+    def close(self):
+        """Flush and close all segments, then upload the remaining ones."""
+        self._stopped.set()
+        os.write(self._wakeup_write, b'\0')
+        self._threads[0].join()
+        self._chunks.put(None)
+        self._threads[1].join()
+        if self.upload_bucket:
+            self._threads[2].join()
+            self._upload_batch()
+
+        if self.dropped_bytes:
+            print('Dropped %d bytes of bot output that could not be written '
+                  'fast enough.' % self.dropped_bytes)
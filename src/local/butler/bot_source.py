@@ -0,0 +1,249 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""bot_source.py publishes the bot sources as per-file manifests and
+content-addressed blobs, and applies them to bots so that an update only
+downloads the files that changed.
+
+Every revision is applied to its own directory under DIRECTORY/versions.
+Unchanged files are hard links into the previous version. The
+DIRECTORY/current symlink is then switched to the new version in a single
+rename, so a bot always sees one complete revision."""
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zipfile
+
+from local.butler import common
+from local.butler import constants
+from local.butler import package
+from local.butler import storage
+
+OBJECT_PREFIX = 'bot-source/'
+BLOBS_PREFIX = OBJECT_PREFIX + 'blobs/'
+FILE_MANIFEST_SUFFIX = '.files.json'
+# File manifest of a version, kept next to its files.
+FILE_MANIFEST_FILENAME = '.files.json'
+VERSIONS_DIRECTORY = 'versions'
+# Prefix of the directories versions are assembled in before being renamed.
+STAGING_PREFIX = '.staging-'
+CURRENT_LINK = 'current'
+TRANSFER_WORKERS = 16
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_blob_name(sha256):
+    return '%s%s/%s' % (BLOBS_PREFIX, sha256[:2], sha256)
+
+
+def get_file_manifest_name(zip_name):
+    """Return the object name of the file manifest of the zip |zip_name|."""
+    return OBJECT_PREFIX + os.path.splitext(zip_name)[0] + FILE_MANIFEST_SUFFIX
+
+
+def create_file_manifest(zip_path):
+    """Return the revision and the path, SHA-256, size and mode of every file
+    of the bot source zip at |zip_path|."""
+    files = {}
+    revision = None
+    with zipfile.ZipFile(zip_path) as f:
+        for info in f.infolist():
+            if info.is_dir():
+                continue
+
+            digest = hashlib.sha256()
+            with f.open(info) as entry:
+                for chunk in iter(lambda: entry.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            files[info.filename] = {
+                'sha256': digest.hexdigest(),
+                'size': info.file_size,
+                'mode': (info.external_attr >> 16) & 0o777 or 0o644,
+            }
+            if info.filename == constants.PACKAGE_ZIP_MANIFEST_PATH:
+                revision = f.read(info).decode('utf-8').strip()
+
+    return {'revision': revision, 'files': files}
+
+
+def _upload_blob(client, bucket_name, zip_path, sha256, path, zip_files,
+                 opened):
+    """Upload the member |path| of the zip at |zip_path| as blob |sha256|.
+    Each thread reads through its own ZipFile, so that at most one member per
+    thread is held in memory."""
+    if not hasattr(zip_files, 'zip_file'):
+        zip_files.zip_file = zipfile.ZipFile(zip_path)
+        opened.append(zip_files.zip_file)
+    storage.upload_data(client, bucket_name, get_blob_name(sha256),
+                        zip_files.zip_file.read(path))
+
+
+def publish(client, bucket_name, zip_path):
+    """Upload the blobs of the zip at |zip_path| that the bucket doesn't have
+    yet, then its file manifest. Returns the number of uploaded blobs."""
+    manifest = create_file_manifest(zip_path)
+    existing = {
+        blob.object_name for blob in client.list_objects(
+            bucket_name, prefix=BLOBS_PREFIX, recursive=True)
+    }
+    missing = {}
+    for path, entry in manifest['files'].items():
+        if get_blob_name(entry['sha256']) not in existing:
+            missing.setdefault(entry['sha256'], path)
+
+    zip_files = threading.local()
+    opened = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                TRANSFER_WORKERS) as executor:
+            futures = [
+                executor.submit(_upload_blob, client, bucket_name, zip_path,
+                                sha256, path, zip_files, opened)
+                for sha256, path in missing.items()
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        for zip_file in opened:
+            zip_file.close()
+
+    # Bots only look at the manifest, so it goes up once all of its blobs are
+    # in place.
+    storage.upload_data(
+        client, bucket_name,
+        get_file_manifest_name(os.path.basename(zip_path)),
+        json.dumps(manifest, sort_keys=True).encode('utf-8'),
+        content_type='application/json')
+    return len(missing)
+
+
+def _get_version_name(revision):
+    return re.sub(r'[^\w.-]', '_', revision)
+
+
+def _load_current_manifest(directory):
+    """Return the file manifest of the current version and its directory, or
+    (None, None) if no version was applied yet."""
+    version_dir = os.path.join(directory, CURRENT_LINK)
+    manifest_path = os.path.join(version_dir, FILE_MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None, None
+
+    with open(manifest_path) as f:
+        return json.load(f), os.path.realpath(version_dir)
+
+
+def _download_blob(client, bucket_name, sha256, path):
+    """Download the blob |sha256| to |path| and check its content."""
+    storage.download_file(client, bucket_name, get_blob_name(sha256), path)
+    if storage.get_file_sha256(path) != sha256:
+        raise RuntimeError('Blob %s is corrupted.' % sha256)
+
+
+def _prune_versions(versions_dir, keep):
+    """Remove the versions that are not in |keep|. Bots that still run from
+    an older version keep their open files. Versions still being assembled
+    by another update are left alone."""
+    for name in os.listdir(versions_dir):
+        path = os.path.join(versions_dir, name)
+        if name.startswith(STAGING_PREFIX):
+            continue
+        if os.path.realpath(path) not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def apply_update(client, bucket_name, file_manifest_name, directory):
+    """Bring the bot sources in |directory| to the revision of the file
+    manifest |file_manifest_name|. Returns whether there was an update."""
+    manifest = json.loads(
+        storage.download_data(client, bucket_name, file_manifest_name))
+    current_manifest, current_dir = _load_current_manifest(directory)
+    if current_manifest and current_manifest['revision'] == manifest['revision']:
+        print('Bot sources are up to date at %s.' % manifest['revision'])
+        return False
+
+    current_files = current_manifest['files'] if current_manifest else {}
+    versions_dir = os.path.join(directory, VERSIONS_DIRECTORY)
+    os.makedirs(versions_dir, exist_ok=True)
+    version_dir = os.path.join(versions_dir,
+                               _get_version_name(manifest['revision']))
+    staging_dir = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=versions_dir)
+    try:
+        downloads = []
+        linked = set()
+        for path, entry in manifest['files'].items():
+            target_path = os.path.join(staging_dir, path)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            current_entry = current_files.get(path)
+            if not current_entry or current_entry['sha256'] != entry['sha256']:
+                downloads.append((entry['sha256'], target_path))
+            elif current_entry['mode'] == entry['mode']:
+                os.link(os.path.join(current_dir, path), target_path)
+                linked.add(path)
+            else:
+                # A hard link shares its mode with the previous version, which
+                # bots may still run from.
+                shutil.copyfile(os.path.join(current_dir, path), target_path)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                TRANSFER_WORKERS) as executor:
+            futures = [
+                executor.submit(_download_blob, client, bucket_name, sha256,
+                                target_path)
+                for sha256, target_path in downloads
+            ]
+            for future in futures:
+                future.result()
+
+        for path, entry in manifest['files'].items():
+            if path not in linked:
+                os.chmod(os.path.join(staging_dir, path), entry['mode'])
+        with open(os.path.join(staging_dir, FILE_MANIFEST_FILENAME), 'w') as f:
+            json.dump(manifest, f, sort_keys=True)
+
+        if os.path.exists(version_dir):
+            shutil.rmtree(version_dir)
+        os.rename(staging_dir, version_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    # Replacing a symlink with a rename is atomic.
+    link_path = os.path.join(directory, CURRENT_LINK)
+    temporary_link_path = link_path + '.tmp'
+    if os.path.lexists(temporary_link_path):
+        os.remove(temporary_link_path)
+    os.symlink(os.path.relpath(version_dir, directory), temporary_link_path)
+    os.replace(temporary_link_path, link_path)
+
+    # The previous version is kept for bots that were started from it.
+    _prune_versions(versions_dir, {os.path.realpath(version_dir), current_dir})
+    print('Updated bot sources to %s, downloaded %d of %d files.' %
+          (manifest['revision'], len(downloads), len(manifest['files'])))
+    return True
+
+
+def execute(args):
+    """Update the bot sources in |args.directory| from the deployment
+    bucket."""
+    platform_name = args.platform or common.get_platform()
+    client = storage.get_client()
+    apply_update(
+        client, args.bucket,
+        get_file_manifest_name(package.get_zip_name(platform_name, True)),
+        os.path.abspath(args.directory))
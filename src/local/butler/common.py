@@ -279,12 +279,14 @@ def _install_platform_pip(requirements_path, target_path, platform_name):
         temp_dir = tempfile.mkdtemp()
         return_code, _ = execute(
             '{pip} download --no-deps --only-binary=:all: --platform={platform} '
-            '--abi={abi} -r {requirements_path} -d {output_dir}'.format(
+            '--abi={abi} -r {requirements_path} -d {output_dir} '
+            '--cache-dir {cache_dir}'.format(
                 pip=_pip(),
                 platform=pip_platform,
                 abi=pip_abi,
                 requirements_path=requirements_path,
-                output_dir=temp_dir),
+                output_dir=temp_dir,
+                cache_dir=constants.PIP_CACHE_DIRECTORY),
             exit_on_error=False)
 
         if return_code != 0:
@@ -58,4 +58,19 @@ TEST_APP_ID = 'test-bot'
 TEST_APP_ID_WITH_DEV_PREFIX = 'dev~' + TEST_APP_ID
 
 DEV_APPSERVER_PORT = 8086
-DEV_APPSERVER_HOST = 'localhost:' + str(DEV_APPSERVER_PORT)
\ No newline at end of file
+DEV_APPSERVER_HOST = 'localhost:' + str(DEV_APPSERVER_PORT)
+
+# Directory of the packaged bot source zips and their cached layers.
+PACKAGE_TARGET_ZIP_DIRECTORY = 'deployment'
+
+# Revision of the packaged bot sources, uploaded next to the zips.
+PACKAGE_TARGET_MANIFEST_PATH = os.path.join(PACKAGE_TARGET_ZIP_DIRECTORY,
+                                            'bot-source.manifest')
+
+# Path of the revision manifest inside a bot source zip.
+PACKAGE_ZIP_MANIFEST_PATH = 'bot-source.manifest'
+
+# Download cache of pip, shared by the packaging of every platform. pip keeps
+# its cache consistent across concurrent pip processes.
+PIP_CACHE_DIRECTORY = os.path.join(
+    os.path.expanduser('~'), '.cache', 'pingucrew', 'pip')
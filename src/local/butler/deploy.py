@@ -15,8 +15,10 @@
 """deploy.py handles the deploy command"""
 
 from collections import namedtuple
+import concurrent.futures
 import contextlib
 import datetime
+import functools
 import json
 import os
 import re
@@ -25,9 +27,12 @@ import tempfile
 import time
 
 from local.butler import appengine
+from local.butler import bot_source
 from local.butler import common
 from local.butler import constants
 from local.butler import package
+from local.butler import profiler
+from local.butler import storage
 from pingu_sdk.config import local_config
 from pingu_sdk.system import environment
 
@@ -37,6 +42,11 @@ APPENGINE_FILESIZE_LIMIT = 30 * 1000 * 1000  # ~32 MB
 DEPLOY_RETRIES = 3
 MATCH_ALL = '*'
 RETRY_WAIT_SECONDS = 10
+# Artifacts uploaded at the same time, and parts of each artifact uploaded at
+# the same time.
+UPLOAD_WORKERS = 4
+UPLOAD_PARALLEL_PARTS = 4
+UPLOAD_PART_SIZE = 64 * 1024 * 1024
 
 # Give 12 hours for cron jobs to complete before deleting a version.
 VERSION_DELETE_WINDOW_MINUTES = 12 * 60
@@ -109,10 +119,13 @@ def _deploy_app_prod(project,
             _delete_old_versions(project, service, VERSION_DELETE_WINDOW_MINUTES)
 
     if package_zip_paths:
-        for package_zip_path in package_zip_paths:
-            _deploy_zip(deployment_bucket, package_zip_path)
-
-        _deploy_manifest(deployment_bucket, constants.PACKAGE_TARGET_MANIFEST_PATH)
+        client = storage.get_client()
+        _deploy_zips(client, deployment_bucket, package_zip_paths)
+        _deploy_file_manifests(client, deployment_bucket, package_zip_paths)
+        # Only flip the manifest once every zip is in place, so bots never
+        # update to a revision that is partially uploaded.
+        _deploy_manifest(client, deployment_bucket,
+                         constants.PACKAGE_TARGET_MANIFEST_PATH)
 
 
 def _deploy_app_staging(project, yaml_paths):
@@ -186,11 +199,12 @@ def _deploy_appengine(project, yamls, stop_previous_version, version=None):
     version_arg = '--version=' + version if version else ''
 
     for retry_num in range(DEPLOY_RETRIES + 1):
-        return_code, _ = common.execute(
-            'gcloud app deploy %s --quiet '
-            '--project=%s %s %s' % (stop_previous_version_arg, project, version_arg,
-                                    ' '.join(yamls)),
-            exit_on_error=False)
+        with profiler.span('deploy.appengine', 'network'):
+            return_code, _ = common.execute(
+                'gcloud app deploy %s --quiet '
+                '--project=%s %s %s' % (stop_previous_version_arg, project,
+                                        version_arg, ' '.join(yamls)),
+                exit_on_error=False)
 
         if return_code == 0:
             break
@@ -213,22 +227,59 @@ def find_file_exceeding_limit(path, limit):
     return None
 
 
-def _deploy_zip(bucket_name, zip_path):
-    """Deploy zip to GCS."""
-    common.execute('gsutil cp %s gs://%s/%s' % (zip_path, bucket_name,
-                                                os.path.basename(zip_path)))
-
+def _deploy_zip(client, bucket_name, zip_path):
+    """Deploy zip to the deployment bucket, unless the bucket already holds a
+    zip with the same content."""
+    object_name = os.path.basename(zip_path)
+    sha256 = storage.get_file_sha256(zip_path)
+    if storage.get_object_sha256(client, bucket_name, object_name) == sha256:
+        print('%s is unchanged, skipping upload.' % object_name)
+        return
 
-def _deploy_manifest(bucket_name, manifest_path):
-    """Deploy source manifest to GCS."""
+    with profiler.span('deploy.upload_zip', 'network', zip=object_name):
+        storage.upload_file(
+            client,
+            bucket_name,
+            object_name,
+            zip_path,
+            content_type='application/zip',
+            metadata={storage.SHA256_METADATA: sha256},
+            part_size=UPLOAD_PART_SIZE,
+            parallel_parts=UPLOAD_PARALLEL_PARTS)
+    print('Uploaded %s.' % object_name)
+
+
+def _deploy_zips(client, bucket_name, zip_paths):
+    """Deploy zips to the deployment bucket in parallel."""
+    with concurrent.futures.ThreadPoolExecutor(UPLOAD_WORKERS) as executor:
+        # Iterating the results raises the first upload error, if any.
+        list(executor.map(
+            functools.partial(_deploy_zip, client, bucket_name), zip_paths))
+
+
+@profiler.profiled('deploy.upload_file_manifests', 'network')
+def _deploy_file_manifests(client, bucket_name, zip_paths):
+    """Deploy the per-file manifests and changed file blobs of the zips, so
+    that bots can update by downloading only the files that changed."""
+    for zip_path in zip_paths:
+        uploaded = bot_source.publish(client, bucket_name, zip_path)
+        print('Published the file manifest of %s with %d new blobs.' %
+              (os.path.basename(zip_path), uploaded))
+
+
+@profiler.profiled('deploy.upload_manifest', 'network')
+def _deploy_manifest(client, bucket_name, manifest_path):
+    """Deploy source manifest to the deployment bucket."""
     if sys.version_info.major == 3:
         manifest_suffix = '.3'
     else:
         manifest_suffix = ''
 
-    common.execute('gsutil cp -a public-read %s '
-                   'gs://%s/bot-source.manifest%s' %
-                   (manifest_path, bucket_name, manifest_suffix))
+    with open(manifest_path, 'rb') as f:
+        storage.upload_data(client, bucket_name,
+                            'bot-source.manifest' + manifest_suffix, f.read(),
+                            content_type='text/plain',
+                            metadata=storage.PUBLIC_READ_METADATA)
 
 
 def _update_deployment_manager(project, name, config_path):
@@ -447,12 +498,15 @@ def execute(args):
         print('Your branch is dirty. Please fix before deploying.')
         sys.exit(1)
 
-    if not common.has_file_in_path('gsutil'):
-        print('gsutil not found in PATH.')
+    try:
+        storage.get_client()
+    except RuntimeError as e:
+        print(e)
         sys.exit(1)
 
     # Build templates before deployment.
-    appengine.build_templates()
+    with profiler.span('deploy.build_templates', 'setup'):
+        appengine.build_templates()
 
     if not is_ci and not args.staging:
         if is_diff_origin_master():
@@ -484,15 +538,17 @@ def execute(args):
     is_python3 = sys.version_info.major == 3
     package_zip_paths = []
     if deploy_zips:
-        for platform_name in platforms:
-            package_zip_paths.append(
-                package.package(
-                    revision, platform_name=platform_name, python3=is_python3))
+        with profiler.span('package', 'setup'):
+            package_zip_paths = package.package_platforms(
+                revision, platforms, python3=is_python3)
     else:
         # package.package calls these, so only set these up if we're not packaging,
         # since they can be fairly slow.
-        appengine.sync_dirs()
-        common.install_dependencies('linux')
+        with profiler.span('copy.sync_dirs', 'io'):
+            appengine.sync_dirs()
+        with profiler.span('install.dependencies', 'install'):
+            common.install_dependencies('linux')
+        os.makedirs(constants.PACKAGE_TARGET_ZIP_DIRECTORY, exist_ok=True)
         with open(constants.PACKAGE_TARGET_MANIFEST_PATH, 'w') as f:
             f.write('%s\n' % revision)
 
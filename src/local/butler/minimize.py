@@ -0,0 +1,106 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""minimize.py minimizes test cases locally."""
+
+import os
+import time
+
+from src.local.butler import reproduce
+from pingu_sdk.system import environment
+from local.butler.reproduce_tool import build_cache
+from local.butler.reproduce_tool import errors
+from local.butler.reproduce_tool import forkserver
+from local.butler.reproduce_tool import minimizer
+
+
+def _get_output_path(output, testcase_id, testcase_path):
+  """Return where the minimized test case is written."""
+  if output:
+    return os.path.abspath(output)
+
+  extension = os.path.splitext(testcase_path)[1]
+  return os.path.abspath('minimized-{testcase_id}{extension}'.format(
+      testcase_id=testcase_id, extension=extension))
+
+
+def execute(args):
+  """Minimize a test case while it keeps reproducing the same crash."""
+  reproduce.initialize()
+
+  if not args.build_dir and not args.fetch_build:
+    print('Either --build-dir or --fetch-build must be specified.')
+    return
+
+  cache = None
+  if args.fetch_build:
+    cache = build_cache.BuildCache(max_size_gb=args.build_cache_size)
+
+  # The current working directory may change while we're running.
+  absolute_build_dir = None
+  if args.build_dir:
+    absolute_build_dir = os.path.abspath(args.build_dir)
+  output_path = args.output and os.path.abspath(args.output)
+
+  try:
+    (testcase, _, testcase_related_crash, testcase_related_fuzzer,
+     testcase_path) = reproduce.setup_testcase_run(
+         args.testcase,
+         absolute_build_dir,
+         args.verbose,
+         args.application,
+         cache=cache,
+         disable_xvfb=args.disable_xvfb,
+         display_count=args.workers,
+         memory_inputs=args.memory_inputs,
+         member_only=args.member_only)
+
+    use_fork_server = args.fork_server
+    if use_fork_server and not forkserver.is_supported(
+        testcase_related_fuzzer.name):
+      print('The fork server only supports blackbox targets on Linux. '
+            'Running without it.')
+      use_fork_server = False
+
+    original_size = os.path.getsize(testcase_path)
+    start_time = time.time()
+    data, stats = minimizer.run(
+        testcase,
+        testcase_path,
+        environment.get_value('TEST_TIMEOUT'),
+        testcase_related_crash,
+        args.workers,
+        attempts=args.iterations,
+        use_fork_server=use_fork_server)
+  except errors.ReproduceToolUnrecoverableError as exception:
+    print(exception)
+    return
+  except KeyboardInterrupt:
+    print('Aborting...')
+    return
+  finally:
+    reproduce.cleanup()
+
+  output_path = _get_output_path(output_path, args.testcase, testcase_path)
+  with open(output_path, 'wb') as f:
+    f.write(data)
+
+  print('Minimized {original_size} bytes to {size} bytes in {duration:.0f} '
+        'seconds ({tests} candidates tested, {cache_hits} cache hits).'.format(
+            original_size=original_size,
+            size=len(data),
+            duration=time.time() - start_time,
+            tests=stats.tests,
+            cache_hits=stats.cache_hits))
+  print('Minimized test case written to {path}.'.format(path=output_path))
@@ -0,0 +1,230 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""package.py packages the bot sources into one zip per platform.
+
+A zip is assembled from layers: the bot sources, the Python dependencies of
+the bot and the platform specific wheels. The dependency layers are cached
+under a hash of their inputs and reused until these change. Zips are
+reproducible, the same layers always give the same bytes."""
+import concurrent.futures
+import hashlib
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import zipfile
+
+from local.butler import appengine
+from local.butler import common
+from local.butler import constants
+from local.butler import profiler
+from local.butler import run_bot
+
+BOT_ROOT_DIR = os.path.join('src', 'pingubot')
+REQUIREMENTS_PATH = os.path.join(BOT_ROOT_DIR, 'requirements.txt')
+PLATFORM_REQUIREMENTS_PATH = os.path.join('src', 'platform_requirements.txt')
+LAYERS_DIRECTORY = 'layers'
+# Zip entries get a fixed timestamp, the earliest one zip supports, so that
+# their content alone decides the bytes of the zip.
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def _get_layer_digest(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:16]
+
+
+def _read_requirements(path):
+    if not os.path.exists(path):
+        return b''
+
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _get_layer(target_zip_dir, name, digest, build):
+    """Return the directory of layer |name|, building it with |build| unless a
+    layer with the same |digest| was built before."""
+    layers_dir = os.path.join(target_zip_dir, LAYERS_DIRECTORY)
+    os.makedirs(layers_dir, exist_ok=True)
+    layer_dir = os.path.join(layers_dir, '%s-%s' % (name, digest))
+    if os.path.exists(layer_dir):
+        print('Re-using unchanged %s layer.' % name)
+        return layer_dir
+
+    print('Building %s layer...' % name)
+    staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=layers_dir)
+    try:
+        build(staging_dir)
+        os.rename(staging_dir, layer_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return layer_dir
+
+
+def _get_dependencies_layer(target_zip_dir):
+    """Return the layer of the bot's Python dependencies."""
+    requirements = _read_requirements(REQUIREMENTS_PATH)
+
+    def build(layer_dir):
+        # Unlike common._install_pip, fail on errors so that a broken layer is
+        # never cached.
+        if requirements:
+            common.execute(
+                '{pip} install -r {requirements_path} --upgrade --target '
+                '{target_path} --cache-dir {cache_dir}'.format(
+                    pip=common._pip(),
+                    requirements_path=REQUIREMENTS_PATH,
+                    target_path=layer_dir,
+                    cache_dir=constants.PIP_CACHE_DIRECTORY))
+
+    return _get_layer(
+        target_zip_dir, 'dependencies',
+        _get_layer_digest(requirements, '%d.%d' % sys.version_info[:2]), build)
+
+
+def _get_platform_layer(target_zip_dir, platform_name):
+    """Return the layer of the wheels specific to |platform_name|."""
+    requirements = _read_requirements(PLATFORM_REQUIREMENTS_PATH)
+
+    def build(layer_dir):
+        if requirements:
+            common._install_platform_pip(PLATFORM_REQUIREMENTS_PATH, layer_dir,
+                                         platform_name)
+
+    return _get_layer(
+        target_zip_dir, 'platform-' + platform_name,
+        _get_layer_digest(requirements, repr(constants.PLATFORMS[platform_name]),
+                          constants.ABIS[platform_name]), build)
+
+
+def _add_directory_entries(entries, directory, prefix):
+    """Map the files under |directory| to zip entries under |prefix|."""
+    for root, dirs, files in os.walk(directory):
+        # Bots compile the sources themselves.
+        dirs[:] = [name for name in dirs if name != '__pycache__']
+        for name in files:
+            if name.endswith('.pyc'):
+                continue
+
+            path = os.path.join(root, name)
+            entries[os.path.join(prefix, os.path.relpath(
+                path, directory)).replace(os.sep, '/')] = path
+
+
+def _write_reproducible_zip(zip_path, entries):
+    """Write |entries|, a map of zip entry names to file paths or bytes, in
+    sorted order with fixed timestamps and permissions."""
+    temporary_path = zip_path + '.tmp'
+    with zipfile.ZipFile(temporary_path, 'w', zipfile.ZIP_DEFLATED) as f:
+        for name in sorted(entries):
+            source = entries[name]
+            info = zipfile.ZipInfo(name, ZIP_TIMESTAMP)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            if isinstance(source, bytes):
+                info.external_attr = 0o644 << 16
+                f.writestr(info, source)
+                continue
+
+            executable = os.stat(source).st_mode & stat.S_IXUSR
+            info.external_attr = (0o755 if executable else 0o644) << 16
+            with open(source, 'rb') as src, f.open(info, 'w') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+    os.replace(temporary_path, zip_path)
+
+
+def get_zip_name(platform_name, python3):
+    return platform_name + ('-3.zip' if python3 else '.zip')
+
+
+def _package_platform(revision, platform_name, python3, target_zip_dir,
+                      dependencies_layer):
+    """Package the bot sources for |platform_name|. Runs in a worker process
+    of package_platforms."""
+    entries = {}
+    for source, destination in run_bot.get_bot_sources(BOT_ROOT_DIR):
+        # The dependencies come from their own layer.
+        if destination != 'third_party' and os.path.exists(source):
+            _add_directory_entries(entries, source, destination)
+    _add_directory_entries(entries, dependencies_layer, 'third_party')
+    _add_directory_entries(entries,
+                           _get_platform_layer(target_zip_dir, platform_name),
+                           os.path.join('src', 'third_party'))
+    entries[constants.PACKAGE_ZIP_MANIFEST_PATH] = ('%s\n' %
+                                                    revision).encode('utf-8')
+
+    target_zip_path = os.path.join(target_zip_dir,
+                                   get_zip_name(platform_name, python3))
+    _write_reproducible_zip(target_zip_path, entries)
+    print('%s is ready.' % target_zip_path)
+    return target_zip_path
+
+
+def package_platforms(revision,
+                      platform_names,
+                      target_zip_dir=constants.PACKAGE_TARGET_ZIP_DIRECTORY,
+                      target_manifest_path=constants.PACKAGE_TARGET_MANIFEST_PATH,
+                      python3=True):
+    """Package the bot sources of |revision| for every platform of
+    |platform_names| in parallel. Returns the paths of the zips, in the order
+    of |platform_names|."""
+    os.makedirs(target_zip_dir, exist_ok=True)
+    # Shared by all platforms, so prepared once before packaging them.
+    with profiler.span('copy.sync_dirs', 'io'):
+        appengine.sync_dirs(
+            src_dir_py=BOT_ROOT_DIR, sub_configs=['bot', 'suppressions'])
+    with profiler.span('package.dependencies', 'install'):
+        dependencies_layer = _get_dependencies_layer(target_zip_dir)
+
+    with profiler.span('package.platforms', 'setup'):
+        if len(platform_names) == 1:
+            zip_paths = [
+                _package_platform(revision, platform_names[0], python3,
+                                  target_zip_dir, dependencies_layer)
+            ]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    len(platform_names)) as executor:
+                futures = [
+                    executor.submit(_package_platform, revision, platform_name,
+                                    python3, target_zip_dir, dependencies_layer)
+                    for platform_name in platform_names
+                ]
+                zip_paths = [future.result() for future in futures]
+
+    with open(target_manifest_path, 'w') as f:
+        f.write('%s\n' % revision)
+    print('Revision: %s' % revision)
+    return zip_paths
+
+
+def package(revision,
+            target_zip_dir=constants.PACKAGE_TARGET_ZIP_DIRECTORY,
+            target_manifest_path=constants.PACKAGE_TARGET_MANIFEST_PATH,
+            platform_name=None,
+            python3=True):
+    """Package the bot sources of |revision| for |platform_name|, or the
+    current platform. Returns the path of the zip."""
+    return package_platforms(
+        revision, [platform_name or common.get_platform()],
+        target_zip_dir=target_zip_dir,
+        target_manifest_path=target_manifest_path,
+        python3=python3)[0]
@@ -0,0 +1,176 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Phase level profiling for butler commands.
+
+Spans are only recorded once profiling is enabled with `butler --profile`,
+otherwise span() does nothing. Always import this module as
+local.butler.profiler so that every command shares the same profiler."""
+
+import atexit
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+_profiler = None
+
+
+class Profiler(object):
+  """Records wall clock spans and writes them as Chrome trace events."""
+
+  def __init__(self, trace_path):
+    self.trace_path = os.path.abspath(trace_path)
+    self.pid = os.getpid()
+    self._start = time.time()
+    self._events = []
+    self._lock = threading.Lock()
+    # Forked workers are usually killed rather than exit, so they append
+    # their spans to this file as soon as they end.
+    self._worker_events_path = self.trace_path + '.workers'
+    if os.path.exists(self._worker_events_path):
+      os.remove(self._worker_events_path)
+
+  def record(self, name, category, start, end, args):
+    """Record a span that ran from |start| to |end|."""
+    event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': int((start - self._start) * 1000000),
+        'dur': int((end - start) * 1000000),
+        'pid': os.getpid(),
+        'tid': threading.get_native_id(),
+        'args': args,
+    }
+    if os.getpid() == self.pid:
+      with self._lock:
+        self._events.append(event)
+      return
+
+    fd = os.open(self._worker_events_path,
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      os.write(fd, (json.dumps(event) + '\n').encode('utf-8'))
+    finally:
+      os.close(fd)
+
+  @contextlib.contextmanager
+  def span(self, name, category, **args):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.record(name, category, start, time.time(), args)
+
+  def _collect_events(self):
+    """Return the spans of this process and of its workers by start time."""
+    events = list(self._events)
+    if os.path.exists(self._worker_events_path):
+      with open(self._worker_events_path) as f:
+        for line in f:
+          try:
+            events.append(json.loads(line))
+          except ValueError:
+            # A worker was killed halfway through writing a span.
+            continue
+      os.remove(self._worker_events_path)
+
+    return sorted(events, key=lambda event: event['ts'])
+
+  def write_trace(self):
+    """Write the Chrome trace-event JSON file and return the events."""
+    events = self._collect_events()
+    with open(self.trace_path, 'w') as f:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    return events
+
+  def format_summary(self, events):
+    """Return a table of the time spent per phase, slowest first."""
+    wall_time = time.time() - self._start
+    phases = {}
+    for event in events:
+      count, total, longest = phases.get(event['name'], (0, 0, 0))
+      phases[event['name']] = (count + 1, total + event['dur'],
+                               max(longest, event['dur']))
+
+    name_width = max([len('Phase')] + [len(name) for name in phases])
+    row_format = ('{name:<' + str(name_width) + '}  {count:>6}  {total:>10}  '
+                  '{mean:>10}  {longest:>10}  {share:>6}')
+    lines = [
+        row_format.format(
+            name='Phase',
+            count='Count',
+            total='Total (s)',
+            mean='Mean (ms)',
+            longest='Max (ms)',
+            share='Wall')
+    ]
+    for name, (count, total, longest) in sorted(
+        phases.items(), key=lambda item: item[1][1], reverse=True):
+      lines.append(
+          row_format.format(
+              name=name,
+              count=count,
+              total='{:.3f}'.format(total / 1000000),
+              mean='{:.1f}'.format(total / count / 1000),
+              longest='{:.1f}'.format(longest / 1000),
+              share='{:.0%}'.format(total / 1000000 / wall_time)))
+
+    lines.append('Wall time: {:.3f}s'.format(wall_time))
+    return '\n'.join(lines)
+
+
+def enable(trace_path):
+  """Start recording spans. The trace and a summary are written at exit."""
+  global _profiler
+  _profiler = Profiler(trace_path)
+  atexit.register(_finish)
+
+
+def _finish():
+  if not _profiler or os.getpid() != _profiler.pid:
+    return
+
+  events = _profiler.write_trace()
+  print()
+  print(_profiler.format_summary(events))
+  print('Trace written to {path} (open it in chrome://tracing or '
+        'https://ui.perfetto.dev).'.format(path=_profiler.trace_path))
+
+
+def span(name, category='butler', **args):
+  """Context manager recording a phase named |name| if profiling is on."""
+  if not _profiler:
+    return contextlib.nullcontext()
+
+  return _profiler.span(name, category, **args)
+
+
+def profiled(name, category='butler'):
+  """Decorator recording every call of a function as a phase."""
+
+  def decorator(function):
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with span(name, category):
+        return function(*args, **kwargs)
+
+    return wrapper
+
+  return decorator
@@ -0,0 +1,285 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""queues.py declares the RabbitMQ queues of configs/redis/config.yaml with
+their options and reconciles existing queues with them.
+
+Queue type and priority are declaration arguments that RabbitMQ can't change
+on an existing queue, so a queue whose type or priority changed is deleted
+and declared again. Every other option is applied through a per-queue policy,
+which RabbitMQ applies to existing queues in place."""
+import base64
+import json
+import os
+import re
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from local.butler import constants
+from local.butler import service_health
+
+QUEUE_TYPES = ['classic', 'lazy', 'quorum']
+OVERFLOW_POLICIES = ['drop-head', 'reject-publish', 'reject-publish-dlx']
+POLICY_PREFIX = 'pingu-'
+# Above the default priority of 0 so that broad operator policies don't
+# shadow the queue options.
+POLICY_PRIORITY = 10
+DEFAULT_PREFETCH = 1
+# Environment variable that passes the prefetch hint to consumers.
+PREFETCH_COUNT_ENV = 'QUEUE_PREFETCH_COUNT'
+MANAGEMENT_TIMEOUT = 10
+
+
+def load_config(config_dir=None):
+    """Return the queue config, from |config_dir| or the default config
+    directory."""
+    import yaml
+
+    config_dir = config_dir or os.getenv('CONFIG_DIR_OVERRIDE',
+                                         constants.TEST_CONFIG_DIR)
+    with open(os.path.join(config_dir, 'redis', 'config.yaml')) as f:
+        return yaml.safe_load(f) or {}
+
+
+class QueueOptions(object):
+    """Options of one queue, with the queue_defaults of the config applied."""
+
+    def __init__(self, entry, defaults=None):
+        options = dict(defaults or {})
+        options.update(entry)
+        self.name = options['name']
+        self.type = options.get('type', 'classic')
+        self.max_priority = options.get('max_priority')
+        self.max_length = options.get('max_length')
+        self.max_length_bytes = options.get('max_length_bytes')
+        self.overflow = options.get('overflow')
+        self.message_ttl = options.get('message_ttl')
+        self.dead_letter_queue = options.get('dead_letter_queue')
+        self.prefetch = options.get('prefetch', DEFAULT_PREFETCH)
+
+        if self.type not in QUEUE_TYPES:
+            raise ValueError('Queue %s has unknown type %s.' % (self.name,
+                                                                self.type))
+        if self.overflow and self.overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Queue %s has unknown overflow policy %s.' %
+                             (self.name, self.overflow))
+        if self.type == 'quorum' and self.max_priority:
+            raise ValueError('Quorum queue %s can not have priorities.' %
+                             self.name)
+
+    def get_arguments(self):
+        """Return the arguments the queue must be declared with."""
+        arguments = {}
+        if self.type == 'quorum':
+            arguments['x-queue-type'] = 'quorum'
+        if self.max_priority:
+            arguments['x-max-priority'] = self.max_priority
+        return arguments
+
+    def get_policy(self):
+        """Return the definition of the queue's policy, which may be empty."""
+        definition = {
+            'max-length': self.max_length,
+            'max-length-bytes': self.max_length_bytes,
+            'overflow': self.overflow,
+            'message-ttl': self.message_ttl,
+        }
+        if self.type == 'lazy':
+            definition['queue-mode'] = 'lazy'
+        if self.dead_letter_queue:
+            # Dead letters go through the default exchange, which routes them
+            # to the queue named by the routing key.
+            definition['dead-letter-exchange'] = ''
+            definition['dead-letter-routing-key'] = self.dead_letter_queue
+        return {key: value for key, value in definition.items()
+                if value is not None}
+
+    def matches(self, queue):
+        """Whether an existing |queue| from the management API was declared
+        with the arguments of these options."""
+        arguments = queue.get('arguments') or {}
+        return (queue.get('type', 'classic') == ('quorum' if self.type ==
+                                                 'quorum' else 'classic') and
+                arguments.get('x-max-priority') == self.max_priority)
+
+
+def get_queue_options(config):
+    """Return the options of every queue of |config|. Dead letter queues must
+    be configured queues too, so that they get their own limits."""
+    defaults = config.get('queue_defaults') or {}
+    queue_options = [
+        QueueOptions(entry, defaults) for entry in config.get('queues', [])
+    ]
+    names = {options.name for options in queue_options}
+    for options in queue_options:
+        if options.dead_letter_queue and options.dead_letter_queue not in names:
+            raise ValueError('Dead letter queue %s of queue %s is not a '
+                             'configured queue.' %
+                             (options.dead_letter_queue, options.name))
+    return queue_options
+
+
+def get_dead_letter_queues(queue_options):
+    """Return the names of the queues that only receive dead letters."""
+    return {
+        options.dead_letter_queue
+        for options in queue_options
+        if options.dead_letter_queue
+    }
+
+
+def get_prefetch_count(config, queue_name):
+    """Return the prefetch count consumers of |queue_name| should use."""
+    for options in get_queue_options(config):
+        if options.name == queue_name:
+            return options.prefetch
+    return DEFAULT_PREFETCH
+
+
+class ManagementApi(object):
+    """Minimal client of the RabbitMQ management HTTP API."""
+
+    def __init__(self, host, port, user, password, vhost='/', base_url=None):
+        self.base_url = (base_url or
+                         'http://%s:%d/api' % (host, port)).rstrip('/')
+        self.vhost = urllib.parse.quote(vhost, safe='')
+        self._authorization = 'Basic ' + base64.b64encode(
+            ('%s:%s' % (user, password)).encode('utf-8')).decode('ascii')
+
+    def request(self, method, path, body=None):
+        request = urllib.request.Request(
+            self.base_url + path,
+            method=method,
+            data=json.dumps(body).encode('utf-8') if body is not None else None)
+        request.add_header('Authorization', self._authorization)
+        request.add_header('Content-Type', 'application/json')
+        with urllib.request.urlopen(request, timeout=MANAGEMENT_TIMEOUT) as f:
+            data = f.read()
+        return json.loads(data) if data else None
+
+    def get_queues(self):
+        """Return {name: queue} for the queues of the vhost."""
+        return {
+            queue['name']: queue
+            for queue in self.request('GET', '/queues/%s' % self.vhost)
+        }
+
+    def get_policies(self):
+        return self.request('GET', '/policies/%s' % self.vhost)
+
+    def set_policy(self, name, pattern, definition):
+        self.request(
+            'PUT', '/policies/%s/%s' % (self.vhost, urllib.parse.quote(name)), {
+                'pattern': pattern,
+                'definition': definition,
+                'priority': POLICY_PRIORITY,
+                'apply-to': 'queues',
+            })
+
+    def delete_policy(self, name):
+        self.request('DELETE', '/policies/%s/%s' %
+                     (self.vhost, urllib.parse.quote(name)))
+
+
+def get_connection_settings(config):
+    """Return the broker host, ports, credentials and vhost of |config|."""
+    env = config.get('env') or {}
+    return {
+        'host': service_health.resolve_host(env.get('QUEUE_HOST', 'localhost')),
+        'port': int(env.get('QUEUE_PORT', 5672)),
+        'management_port': int(env.get('QUEUE_MANAGEMENT_PORT', 15672)),
+        'user': env.get('QUEUE_USER', 'guest'),
+        'password': env.get('QUEUE_PASSWORD', 'guest'),
+        'vhost': env.get('QUEUE_VHOST', '/'),
+    }
+
+
+def get_management_api(config, base_url=None):
+    """Return a client of the management API of |config|'s broker, or of the
+    API at |base_url| such as a local stand-in."""
+    settings = get_connection_settings(config)
+    return ManagementApi(settings['host'], settings['management_port'],
+                         settings['user'], settings['password'],
+                         settings['vhost'], base_url=base_url)
+
+
+def reconcile(config, force=False):
+    """Declare the queues of |config| and bring existing ones in line with
+    their options. Queues whose type or priority changed are only recreated
+    while empty, unless |force| is set."""
+    import pika
+
+    settings = get_connection_settings(config)
+    api = get_management_api(config)
+    existing = api.get_queues()
+    queue_options = get_queue_options(config)
+
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(
+            host=settings['host'],
+            port=settings['port'],
+            virtual_host=settings['vhost'],
+            credentials=pika.PlainCredentials(settings['user'],
+                                              settings['password'])))
+    try:
+        channel = connection.channel()
+        for options in queue_options:
+            queue = existing.get(options.name)
+            if queue and not options.matches(queue):
+                if queue.get('messages') and not force:
+                    print('Queue %s has %d messages, not recreating it with '
+                          'its new type or priority. Use --force to drop '
+                          'them.' % (options.name, queue['messages']))
+                    continue
+
+                print('Recreating queue %s with its new type or priority.' %
+                      options.name)
+                channel.queue_delete(options.name)
+
+            channel.queue_declare(
+                options.name, durable=True, arguments=options.get_arguments())
+    finally:
+        connection.close()
+
+    # Policies are applied last so that they also cover recreated queues, and
+    # policies of queues without options any more are removed.
+    wanted_policies = set()
+    for options in queue_options:
+        definition = options.get_policy()
+        if not definition:
+            continue
+
+        policy_name = POLICY_PREFIX + options.name
+        wanted_policies.add(policy_name)
+        api.set_policy(policy_name, '^%s$' % re.escape(options.name),
+                       definition)
+
+    for policy in api.get_policies():
+        if (policy['name'].startswith(POLICY_PREFIX) and
+                policy['name'] not in wanted_policies):
+            api.delete_policy(policy['name'])
+
+    print('Reconciled %d queues.' % len(queue_options))
+
+
+def execute(args):
+    """Reconcile the broker's queues with the queue config."""
+    import pika
+
+    try:
+        reconcile(load_config(args.config_dir), force=args.force)
+    except (ValueError, urllib.error.URLError,
+            pika.exceptions.AMQPError) as e:
+        print('Failed to reconcile queues: %s' % e)
@@ -20,24 +20,35 @@ from pingu_sdk.system import modules
 
 modules.fix_module_search_paths(submodule_root="pingubot")
 
+import contextlib
+import functools
 import os
+import re
 import shutil
+import sys
 import tempfile
 import time
 
 from pingu_sdk.utils import json_utils
-from pingu_sdk.utils  import utils
 from pingu_sdk import testcase_manager
 from pingu_sdk.fuzzers import init
 from src.pingubot.src.bot.tasks import commands
 from src.pingubot.src.bot.tasks import setup
+from local.butler import profiler
 from pingu_sdk.system import archive
 from pingu_sdk.system import environment
-from pingu_sdk.system import new_process
 from pingu_sdk.system import shell
 from local.butler.reproduce_tool import android
+from local.butler.reproduce_tool import batch
+from local.butler.reproduce_tool import build_cache
+from local.butler.reproduce_tool import differential
 from local.butler.reproduce_tool import errors
+from local.butler.reproduce_tool import forkserver
+from local.butler.reproduce_tool import parallel
 from local.butler.reproduce_tool import prompts
+from local.butler.reproduce_tool import symbolizer
+from local.butler.reproduce_tool import watcher
+from local.butler.reproduce_tool import xvfb
 from pingu_sdk.datastore.models.fuzz_target import FuzzTarget
 from pingu_sdk.datastore.models.job import Job
 from pingu_sdk.datastore.models.fuzzer import Fuzzer
@@ -53,12 +64,15 @@ from pingu_sdk.datastore.pingu_api.fuzzer_api import FuzzerApi
 
 CONFIG_DIRECTORY = os.path.join(
     os.path.expanduser('~'), '.config', 'bot')
-DISPLAY = ':99'
-PROCESS_START_WAIT_SECONDS = 2
 SUPPORTED_PLATFORMS = ['android', 'fuchsia', 'linux', 'mac']
 
 FILENAME_RESPONSE_HEADER = 'x-goog-meta-filename'
 
+# Multiple of 4 so that every chunk but the last one decodes on its own.
+BASE64_CHUNK_SIZE = 4 * 1024 * 1024
+BASE64_INVALID_CHARACTERS = re.compile(r'[^A-Za-z0-9+/=]')
+MEMORY_BACKED_DIRECTORY = '/dev/shm'
+
 
 class SerializedTestcase(object):
   """Minimal representation of a test case."""
@@ -96,19 +110,63 @@ class SerializedTestcase(object):
     return fuzz_target
 
 
-def prepare_testcase(testcase):
-  """Download the test case and return its path."""
-  print('Downloading testcase...')
+def _get_memory_backed_root():
+  """Return the memory backed directory of this run, named after its
+  temporary ROOT_DIR so that concurrent runs don't share it."""
+  return os.path.join(MEMORY_BACKED_DIRECTORY, 'pingu-reproduce',
+                      os.path.basename(environment.get_value('ROOT_DIR')))
+
+
+def _get_testcase_directory(name, memory_backed=False):
+  """Return the directory a test case is materialized in. Memory backed
+  directories are removed by cleanup."""
+  if not memory_backed:
+    return os.path.join(CONFIG_DIRECTORY, name)
+
+  if not os.path.isdir(MEMORY_BACKED_DIRECTORY):
+    raise errors.ReproduceToolUnrecoverableError(
+        'Memory backed inputs require {directory}, which does not exist on '
+        'this host.'.format(directory=MEMORY_BACKED_DIRECTORY))
+
+  return os.path.join(_get_memory_backed_root(), name)
+
+
+def _write_base64_to_file(encoded_data, file_path):
+  """Decode base64 data straight to disk a chunk at a time, so that the
+  decoded test case is never held in memory as a whole."""
+  remainder = ''
+  with open(file_path, 'wb') as f:
+    for start in range(0, len(encoded_data), BASE64_CHUNK_SIZE):
+      chunk = encoded_data[start:start + BASE64_CHUNK_SIZE]
+      if isinstance(chunk, bytes):
+        chunk = chunk.decode('ascii', errors='ignore')
+
+      chunk = remainder + BASE64_INVALID_CHARACTERS.sub('', chunk)
+      decodable_length = len(chunk) - len(chunk) % 4
+      f.write(base64.b64decode(chunk[:decodable_length]))
+      remainder = chunk[decodable_length:]
 
-  content = base64.b64decode(testcase.test_case)
+    if remainder:
+      f.write(base64.b64decode(remainder + '=' * (-len(remainder) % 4)))
+
+
+@profiler.profiled('testcase.prepare', 'io')
+def prepare_testcase(testcase, testcase_directory=None, member_only=False):
+  """Download the test case and return its path.
+
+  Archived test cases are unpacked as a whole, since the test case file may
+  need the other files of its archive. With |member_only|, only the member
+  matching the original test case file is extracted."""
+  print('Downloading testcase...')
 
   # Store the test case in the config directory for debuggability.
-  testcase_directory = os.path.join(CONFIG_DIRECTORY, 'current-testcase')
+  if not testcase_directory:
+    testcase_directory = os.path.join(CONFIG_DIRECTORY, 'current-testcase')
   shell.remove_directory(testcase_directory, recreate=True)
   environment.set_value('FUZZ_INPUTS', testcase_directory)
   testcase_path = f'{testcase_directory}/{testcase.id}'
-                               
-  utils.write_data_to_file(content, testcase_path)
+
+  _write_base64_to_file(testcase.test_case, testcase_path)
 
   # Unpack the test case if it's archived.
   # TODO(mbarbella): Rewrite setup.unpack_testcase and share this code.
@@ -118,51 +176,52 @@ def prepare_testcase(testcase):
     mask = ArchiveStatus.FUZZED
 
   if testcase.archive_state & mask:
-    archive.unpack(testcase_path, testcase_directory)
-    file_list = archive.get_file_list(testcase_path)
+    archive_path = testcase_path
+    file_list = archive.get_file_list(archive_path)
 
-    testcase_path = None
+    member_name = None
     for file_name in file_list:
       if os.path.basename(file_name) == os.path.basename(
           testcase.absolute_path):
-        testcase_path = os.path.join(testcase_directory, file_name)
+        member_name = file_name
         break
 
-    if not testcase_path:
+    if not member_name:
       raise errors.ReproduceToolUnrecoverableError(
           'Test case file was not found in archive.\n'
           'Original filename: {absolute_path}.\n'
           'Archive contents: {file_list}'.format(
               absolute_path=testcase.absolute_path, file_list=file_list))
 
+    testcase_path = os.path.join(testcase_directory, member_name)
+    if not member_only:
+      archive.unpack(archive_path, testcase_directory)
+    else:
+      archive.unpack(
+          archive_path,
+          testcase_directory,
+          file_match_callback=lambda file_name: file_name == member_name)
+      # Nothing else will be read from the archive.
+      if os.path.abspath(testcase_path) != os.path.abspath(archive_path):
+        os.remove(archive_path)
+
   return testcase_path
 
 
-def _setup_x(fuzzer_name):
-  """Start Xvfb and blackbox before running the test application."""
+@profiler.profiled('process.start.xvfb', 'process')
+def _setup_x(fuzzer_name, display_count=1):
+  """Start a pool of Xvfb displays with blackbox before running the test
+  application. Returns whether a pool was started."""
   if environment.platform() != 'LINUX':
-    return []
+    return False
 
   if environment.is_engine_fuzzer_job(fuzzer_name):
     # For engine fuzzer jobs like AFL, libFuzzer, Xvfb is not needed as the
     # those fuzz targets do not needed a UI.
-    return []
-
-  environment.set_value('DISPLAY', DISPLAY)
-
-  print('Creating virtual display...')
-  xvfb_runner = new_process.ProcessRunner('/usr/bin/Xvfb')
-  xvfb_process = xvfb_runner.run(additional_args=[
-      DISPLAY, '-screen', '0', '1280x1024x24', '-ac', '-nolisten', 'tcp'
-  ])
-  time.sleep(PROCESS_START_WAIT_SECONDS)
-
-  blackbox_runner = new_process.ProcessRunner('/usr/bin/blackbox')
-  blackbox_process = blackbox_runner.run()
-  time.sleep(PROCESS_START_WAIT_SECONDS)
+    return False
 
-  # Return all handles we create so they can be terminated properly at exit.
-  return [xvfb_process, blackbox_process]
+  xvfb.start_display_pool(display_count)
+  return True
 
 
 def _prepare_initial_environment(build_directory, iterations, verbose):
@@ -184,10 +243,11 @@ def _prepare_initial_environment(build_directory, iterations, verbose):
         ignore=lambda directory, contents:
         contents if directory in ignore_paths else [])
 
-  _update_directory('src/pingubot/src', 'src/bot')
-  _update_directory('configs', 'configs')
-  _update_directory('src/pingubot/resources', 'resources')
-  _update_directory('src/pingubot/working_directory','working_directory')
+  with profiler.span('copy.root_dir', 'io'):
+    _update_directory('src/pingubot/src', 'src/bot')
+    _update_directory('configs', 'configs')
+    _update_directory('src/pingubot/resources', 'resources')
+    _update_directory('src/pingubot/working_directory','working_directory')
 
 
   environment.set_value('CONFIG_DIR_OVERRIDE',
@@ -200,10 +260,10 @@ def _prepare_initial_environment(build_directory, iterations, verbose):
   local_config.ProjectConfig().set_environment()
   environment.set_bot_environment()
 
-  # Overrides that should not be set to the default values.
-  environment.set_value('APP_DIR', build_directory)
-  environment.set_value('BUILD_DIR', build_directory)
-  environment.set_value('BUILDS_DIR', build_directory)
+  # Overrides that should not be set to the default values. When the build is
+  # fetched, these are set once the test case's revision is known.
+  if build_directory:
+    _set_build_directory(build_directory)
 
   # Some functionality must be disabled when running the tool.
   environment.set_value('REPRODUCE_TOOL', True)
@@ -218,6 +278,23 @@ def _prepare_initial_environment(build_directory, iterations, verbose):
     environment.set_value('CRASH_RETRIES', iterations)
 
 
+def _set_build_directory(build_directory):
+  """Point the build related environment variables at |build_directory|."""
+  environment.set_value('APP_DIR', build_directory)
+  environment.set_value('BUILD_DIR', build_directory)
+  environment.set_value('BUILDS_DIR', build_directory)
+
+
+@profiler.profiled('build.fetch', 'network')
+def _fetch_build(testcase, testcase_related_job, cache):
+  """Fetch the test case's build into the build cache and use it."""
+  build_directory = build_cache.fetch_testcase_build(testcase,
+                                                     testcase_related_job,
+                                                     cache)
+  _set_build_directory(build_directory)
+  return build_directory
+
+
 def _verify_target_exists(build_directory):
   """Ensure that we can find the test target before running it.
 
@@ -228,6 +305,7 @@ def _verify_target_exists(build_directory):
             build_directory=build_directory))
 
 
+@profiler.profiled('environment.setup', 'setup')
 def _update_environment_for_testcase(testcase: Testcase, testcase_related_job: Job,
                                      tesetcase_related_fuzzer: Fuzzer,
                                      build_directory,
@@ -257,21 +335,29 @@ def _update_environment_for_testcase(testcase: Testcase, testcase_related_job: J
   _verify_target_exists(build_directory)
 
 
+def _get_stacktrace(result):
+  """Return the symbolized stack trace of a result, symbolizing through the
+  local symbolization cache when llvm-symbolizer is available and can resolve
+  every frame."""
+  stacktrace = symbolizer.symbolize_stacktrace(
+      result.get_stacktrace(symbolize_flag=False))
+  if stacktrace is None:
+    stacktrace = result.get_stacktrace()
+
+  return stacktrace
+
+
 def _print_stacktrace(result):
   """Display the output from a test case run."""
   print('#' * 80)
-  print(result.get_stacktrace())
+  print(_get_stacktrace(result))
   print('#' * 80)
   print()
 
 
-def _reproduce_crash(testcase_id, build_directory, iterations, disable_xvfb,
-                     verbose, disable_android_setup, application):
-  """Reproduce a crash."""
-  _prepare_initial_environment(build_directory, iterations, verbose)
-
-  # Validate the test case URL and fetch the tool's configuration.
-  #configuration = config.ReproduceToolConfiguration(testcase_id)
+@profiler.profiled('api.get_testcase_data', 'network')
+def _get_testcase_data(testcase_id):
+  """Fetch a test case along with its related job, crash and fuzzer."""
   testcase_api_client = client_factory.get_client(TestcaseApi)
   testcase = testcase_api_client.get_testcase_by_id(testcase_id=testcase_id)
   job_api_client = client_factory.get_client(JobApi)
@@ -290,6 +376,27 @@ def _reproduce_crash(testcase_id, build_directory, iterations, disable_xvfb,
         'The reproduce tool is not yet supported on {platform}.'.format(
             platform=testcase_related_job.platform))
 
+  fuzzer_api_client = client_factory.get_client(FuzzerApi)
+  tesetcase_related_fuzzer = fuzzer_api_client.get_fuzzer_by_id(testcase.fuzzer_id)
+
+  return (testcase, testcase_related_job, testcase_raelated_crash,
+          tesetcase_related_fuzzer)
+
+
+def _reproduce_crash(testcase_id, build_directory, iterations, disable_xvfb,
+                     verbose, disable_android_setup, application, jobs=1,
+                     estimate_reproducibility=False, cache=None,
+                     memory_inputs=False, member_only=False,
+                     all_devices=False, use_fork_server=False, watch=False):
+  """Reproduce a crash. With |watch|, keep re-running the attempts whenever
+  the build changes until interrupted."""
+  _prepare_initial_environment(build_directory, iterations, verbose)
+
+  # Validate the test case URL and fetch the tool's configuration.
+  #configuration = config.ReproduceToolConfiguration(testcase_id)
+  (testcase, testcase_related_job, testcase_raelated_crash,
+   tesetcase_related_fuzzer) = _get_testcase_data(testcase_id)
+
   # Print warnings for this test case.
   if testcase.one_time_crasher_flag:
     print('Warning: this test case was a one-time crash. It may not be '
@@ -298,16 +405,25 @@ def _reproduce_crash(testcase_id, build_directory, iterations, disable_xvfb,
     print('Warning: this test case is known to crash with different stack '
           'traces.')
 
-  testcase_path = prepare_testcase(testcase)
-  fuzzer_api_client = client_factory.get_client(FuzzerApi)
-  tesetcase_related_fuzzer = fuzzer_api_client.get_fuzzer_by_id(testcase.fuzzer_id)
+  testcase_path = prepare_testcase(
+      testcase, _get_testcase_directory('current-testcase', memory_inputs),
+      member_only)
+  if not build_directory:
+    build_directory = _fetch_build(testcase, testcase_related_job, cache)
 
   _update_environment_for_testcase(testcase, testcase_related_job, tesetcase_related_fuzzer, build_directory, application)
 
   # Validate that we're running on the right platform for this test case.
   platform = environment.platform().lower()
   if testcase_related_job.platform.lower() == 'android' and platform == 'linux':
-    android.prepare_environment(disable_android_setup)
+    if all_devices:
+      # Fan the attempts out with one worker per prepared device.
+      serials = android.prepare_all_devices(disable_android_setup)
+      environment.set_value('ANDROID_SERIAL', serials[0])
+      android.set_device_pool(serials)
+      jobs = len(serials)
+    else:
+      android.prepare_environment(disable_android_setup)
   elif testcase_related_job.platform.lower() == 'android' and platform != 'linux':
     raise errors.ReproduceToolUnrecoverableError(
         'The ClusterFuzz environment only supports running Android test cases '
@@ -319,84 +435,495 @@ def _reproduce_crash(testcase_id, build_directory, iterations, disable_xvfb,
         'Unable to attempt to reproduce it on {current_platform}.'.format(
             testcase_platform=testcase_related_job.platform, current_platform=platform))
 
-  x_processes = []
+  if all_devices and testcase_related_job.platform.lower() != 'android':
+    print('Warning: --all-devices only applies to Android test cases and is '
+          'ignored for this {testcase_platform} test case.'.format(
+              testcase_platform=testcase_related_job.platform))
+
+  if use_fork_server and (
+      testcase_related_job.platform.lower() != 'linux' or
+      not forkserver.is_supported(tesetcase_related_fuzzer.name)):
+    print('The fork server only supports blackbox targets on Linux. Running '
+          'without it.')
+    use_fork_server = False
+
   if not disable_xvfb:
-    _setup_x(tesetcase_related_fuzzer.name)
+    _setup_x(tesetcase_related_fuzzer.name, display_count=jobs)
   timeout = environment.get_value('TEST_TIMEOUT')
 
   print('Running testcase...')
   try:
-    result = testcase_manager.test_for_crash_with_retries(
-        testcase, testcase_path, timeout, testcase_raelated_crash, crash_retries=1)
-
-    # If we can't reproduce the crash, prompt the user to try again.
-    if not result.is_crash():
-      _print_stacktrace(result)
-      result = None
-      use_default_retries = prompts.get_boolean(
-          'Failed to find the desired crash on first run. Re-run '
-          '{crash_retries} times?'.format(
-              crash_retries=environment.get_value('CRASH_RETRIES')))
-      if use_default_retries:
-        print('Attempting to reproduce test case. This may take a while...')
-        result = testcase_manager.test_for_crash_with_retries(
-            testcase, testcase_path, timeout, testcase_raelated_crash)
-
+    if watch:
+      result = _watch_build(build_directory, testcase, testcase_path, timeout,
+                            testcase_raelated_crash, jobs, use_fork_server)
+    elif jobs > 1 or estimate_reproducibility:
+      # A single worker still runs the estimate loop.
+      result = _reproduce_crash_in_parallel(
+          testcase, testcase_path, timeout, testcase_raelated_crash, jobs,
+          estimate_reproducibility, use_fork_server)
+    else:
+      with xvfb.leased_display(), _fork_server(use_fork_server,
+                                               testcase_path) as fork_server:
+        result = _reproduce_crash_serially(testcase, testcase_path, timeout,
+                                           testcase_raelated_crash,
+                                           fork_server)
   except KeyboardInterrupt:
     print('Aborting...')
     result = None
+  finally:
+    # Terminate Xvfb and blackbox.
+    xvfb.stop_display_pool()
+
+  return result
+
+
+@contextlib.contextmanager
+def _fork_server(use_fork_server, testcase_path):
+  """Yield a running fork server if |use_fork_server| is set and it could be
+  started, otherwise None."""
+  fork_server = forkserver.try_start(testcase_path) if use_fork_server else None
+  try:
+    yield fork_server
+  finally:
+    if fork_server:
+      fork_server.stop()
+
+
+@profiler.profiled('testcase.run', 'execution')
+def _test_for_crash_with_retries(testcase,
+                                 testcase_path,
+                                 timeout,
+                                 crash,
+                                 crash_retries=None,
+                                 fork_server=None,
+                                 compare_crash=True):
+  """Run attempts through |fork_server| if there is one, otherwise exec the
+  target for each attempt. Without |compare_crash|, any crash ends the
+  attempts."""
+  if fork_server:
+    return fork_server.test_for_crash_with_retries(
+        crash, timeout, crash_retries, compare_crash=compare_crash)
+
+  if crash_retries is None:
+    return testcase_manager.test_for_crash_with_retries(
+        testcase, testcase_path, timeout, crash, compare_crash=compare_crash)
+
+  return testcase_manager.test_for_crash_with_retries(
+      testcase,
+      testcase_path,
+      timeout,
+      crash,
+      compare_crash=compare_crash,
+      crash_retries=crash_retries)
+
+
+def _reproduce_crash_serially(testcase, testcase_path, timeout, crash,
+                              fork_server=None):
+  """Run one attempt, then prompt before running the remaining attempts."""
+  result = _test_for_crash_with_retries(
+      testcase, testcase_path, timeout, crash, crash_retries=1,
+      fork_server=fork_server)
+
+  # If we can't reproduce the crash, prompt the user to try again.
+  if not result.is_crash():
+    _print_stacktrace(result)
+    result = None
+    use_default_retries = prompts.get_boolean(
+        'Failed to find the desired crash on first run. Re-run '
+        '{crash_retries} times?'.format(
+            crash_retries=environment.get_value('CRASH_RETRIES')))
+    if use_default_retries:
+      print('Attempting to reproduce test case. This may take a while...')
+      result = _test_for_crash_with_retries(
+          testcase, testcase_path, timeout, crash, fork_server=fork_server)
+
+  return result
 
-  # Terminate Xvfb and blackbox.
-  for process in x_processes:
-    process.terminate()
 
+def _reproduce_crash_in_parallel(testcase, testcase_path, timeout, crash, jobs,
+                                 estimate_reproducibility,
+                                 use_fork_server=False):
+  """Run all reproduction attempts concurrently across |jobs| workers."""
+  max_attempts = environment.get_value('CRASH_RETRIES')
+  print('Running up to {max_attempts} attempts across {jobs} jobs...'.format(
+      max_attempts=max_attempts, jobs=jobs))
+  result, estimate = parallel.run_attempts(
+      testcase,
+      testcase_path,
+      timeout,
+      crash,
+      max_attempts,
+      jobs,
+      estimate_reproducibility=estimate_reproducibility,
+      use_fork_server=use_fork_server)
+  print('Reproducibility: {estimate}.'.format(estimate=estimate))
   return result
 
 
-def _cleanup():
+def _run_watch_attempts(testcase, testcase_path, timeout, crash, jobs,
+                        use_fork_server):
+  """Run all attempts against the current build without prompting. Any crash
+  ends the attempts, so that the caller can tell whether it is |crash|."""
+  if jobs > 1:
+    result, _ = parallel.run_attempts(
+        testcase,
+        testcase_path,
+        timeout,
+        crash,
+        environment.get_value('CRASH_RETRIES'),
+        jobs,
+        use_fork_server=use_fork_server,
+        compare_crash=False)
+    return result
+
+  # The fork server is restarted for every run as the target was rebuilt.
+  with xvfb.leased_display(), _fork_server(use_fork_server,
+                                           testcase_path) as fork_server:
+    return _test_for_crash_with_retries(
+        testcase,
+        testcase_path,
+        timeout,
+        crash,
+        fork_server=fork_server,
+        compare_crash=False)
+
+
+def _watch_build(build_directory, testcase, testcase_path, timeout, crash,
+                 jobs, use_fork_server):
+  """Re-run the attempts whenever |build_directory| changes, reusing the
+  prepared environment, displays and test case. Runs until interrupted."""
+  with watcher.BuildWatcher(build_directory) as build_watcher:
+    while True:
+      start_time = time.time()
+      result = _run_watch_attempts(testcase, testcase_path, timeout, crash,
+                                   jobs, use_fork_server)
+      elapsed = time.time() - start_time
+      if result and forkserver.is_expected_crash(result, crash):
+        print('FAIL: the crash still reproduces ({elapsed:.1f}s).'.format(
+            elapsed=elapsed))
+      elif result and result.is_crash():
+        print('FAIL: the target crashes with a different state '
+              '({elapsed:.1f}s):\n{state}'.format(
+                  elapsed=elapsed, state=result.get_state()))
+      else:
+        print('PASS: the crash did not reproduce in {attempts} attempts '
+              '({elapsed:.1f}s).'.format(
+                  attempts=environment.get_value('CRASH_RETRIES'),
+                  elapsed=elapsed))
+
+      print('Watching {directory} for changes (Ctrl-C to stop)...'.format(
+          directory=build_directory))
+      changed = build_watcher.wait_for_change()
+      print('{changed} build files changed, re-running...'.format(
+          changed=changed))
+
+
+def _get_filtered_testcase_ids(job_id, fuzzer_id):
+  """Return the IDs of all test cases matching a job and/or fuzzer filter."""
+  testcase_api_client = client_factory.get_client(TestcaseApi)
+  testcases = testcase_api_client.get_testcases(job_id=job_id,
+                                                fuzzer_id=fuzzer_id)
+  return [str(testcase.id) for testcase in testcases]
+
+
+def _get_batch_testcases_directory(memory_inputs):
+  """Return the directory batch workers materialize test cases in."""
+  if memory_inputs:
+    return _get_testcase_directory('testcases', True)
+
+  return os.path.join(environment.get_value('ROOT_DIR'), 'testcases')
+
+
+def _reproduce_batch_testcase(build_directory, application, cache,
+                              memory_inputs, member_only, testcase_id):
+  """Reproduce a single test case inside a batch worker and return a report
+  that can be serialized as JSON."""
+  start_time = time.time()
+  testcase_directory = None
+  report = {
+      'testcase_id': testcase_id,
+      'job_id': None,
+      'reproduced': False,
+      'crash_state': None,
+      'expected_crash_state': None,
+      'error': None,
+  }
+
+  try:
+    (testcase, testcase_related_job, testcase_raelated_crash,
+     tesetcase_related_fuzzer) = _get_testcase_data(testcase_id)
+    report['job_id'] = str(testcase_related_job.id)
+    report['expected_crash_state'] = testcase_raelated_crash.crash_state
+
+    platform = environment.platform().lower()
+    if testcase_related_job.platform.lower() != platform:
+      raise errors.ReproduceToolUnrecoverableError(
+          'Batch mode can not reproduce {testcase_platform} test cases on '
+          '{current_platform}.'.format(
+              testcase_platform=testcase_related_job.platform,
+              current_platform=platform))
+
+    testcases_directory = _get_batch_testcases_directory(memory_inputs)
+    shell.create_directory(testcases_directory, create_intermediates=True)
+    testcase_directory = os.path.join(testcases_directory, str(testcase_id))
+    testcase_path = prepare_testcase(testcase, testcase_directory, member_only)
+    if not build_directory:
+      build_directory = _fetch_build(testcase, testcase_related_job, cache)
+    _update_environment_for_testcase(testcase, testcase_related_job,
+                                     tesetcase_related_fuzzer,
+                                     build_directory, application)
+
+    with xvfb.leased_display():
+      result = _test_for_crash_with_retries(
+          testcase, testcase_path, environment.get_value('TEST_TIMEOUT'),
+          testcase_raelated_crash)
+    report['reproduced'] = result.is_crash()
+    if result.is_crash():
+      report['crash_state'] = result.get_state()
+  except Exception as e:
+    report['error'] = str(e)
+  finally:
+    if testcase_directory:
+      shell.remove_directory(testcase_directory)
+
+  report['duration_seconds'] = round(time.time() - start_time, 3)
+  return report
+
+
+def _reproduce_batch(testcase_ids, build_directory, args, cache):
+  """Reproduce many test cases against the same build and stream a JSONL
+  report with one line per test case."""
+  _prepare_initial_environment(build_directory, args.iterations, args.verbose)
+
+  if not args.disable_xvfb:
+    _setup_x(None, display_count=args.workers)
+
+  print('Reproducing {count} test cases across {workers} workers...'.format(
+      count=len(testcase_ids), workers=args.workers), file=sys.stderr)
+  reproduce_function = functools.partial(_reproduce_batch_testcase,
+                                         build_directory, args.application,
+                                         cache, args.memory_inputs,
+                                         args.member_only)
+  try:
+    results = batch.run(
+        reproduce_function,
+        testcase_ids,
+        args.workers,
+        args.output,
+        quiet=not args.verbose)
+  except KeyboardInterrupt:
+    print('Aborting...', file=sys.stderr)
+    results = None
+  finally:
+    xvfb.stop_display_pool()
+
+  if results is not None:
+    reproduced_count = sum(1 for result in results if result['reproduced'])
+    error_count = sum(1 for result in results if result['error'])
+    print('Reproduced {reproduced}/{total} test cases ({errors} errors).'.format(
+        reproduced=reproduced_count, total=len(results), errors=error_count),
+          file=sys.stderr)
+
+
+def _get_testcase_ids(args):
+  """Collect the test case IDs to reproduce from all supported sources."""
+  testcase_ids = batch.read_testcase_ids(args.testcase, args.testcase_file)
+  if args.job or args.fuzzer:
+    for testcase_id in _get_filtered_testcase_ids(args.job, args.fuzzer):
+      if testcase_id not in testcase_ids:
+        testcase_ids.append(testcase_id)
+
+  return testcase_ids
+
+
+def _is_batch(args):
+  """Whether the arguments ask for more than a single test case."""
+  return (len(args.testcase) != 1 or args.testcase_file or args.job or
+          args.fuzzer)
+
+
+@profiler.profiled('cleanup', 'cleanup')
+def cleanup():
   """Clean up after running the tool."""
+  xvfb.stop_display_pool()
+  # Memory backed inputs would otherwise hold on to RAM after the run.
+  memory_backed_root = _get_memory_backed_root()
+  if os.path.exists(memory_backed_root):
+    shell.remove_directory(memory_backed_root)
   temp_directory = environment.get_value('ROOT_DIR')
   assert 'tmp' in temp_directory
   shell.remove_directory(temp_directory)
 
 
-def execute(args):
-  """Attempt to reproduce a crash then report on the result."""
+def _reproduce_differential(testcase_id, build_directories, args):
+  """Reproduce a test case against several builds, e.g. the ASan, UBSan and
+  MSan variants of a job, concurrently and print a merged report."""
+  try:
+    (testcase, _, testcase_raelated_crash, _,
+     testcase_path) = setup_testcase_run(
+         testcase_id,
+         build_directories[0],
+         args.verbose,
+         args.application,
+         disable_xvfb=args.disable_xvfb,
+         display_count=len(build_directories),
+         memory_inputs=args.memory_inputs,
+         member_only=args.member_only)
+
+    print('Running testcase against {count} builds...'.format(
+        count=len(build_directories)))
+    reports = differential.run(testcase, testcase_path, testcase_raelated_crash,
+                               build_directories, args.iterations,
+                               use_build_directory)
+  except errors.ReproduceToolUnrecoverableError as exception:
+    print(exception)
+    return
+  except KeyboardInterrupt:
+    print('Aborting...')
+    return
+  finally:
+    cleanup()
+
+  print(differential.format_report(reports,
+                                   testcase_raelated_crash.crash_state))
+
+
+@profiler.profiled('initialize', 'setup')
+def initialize():
+  """Initialize the fuzzing engines and API clients used by the tool."""
   # Initialize fuzzing engines.
   init.run()
-  
+
   # Initialize API clients
   api_client_init.run(environment.get_value("PINGUAPI_HOST"), environment.get_value("PINGUAPI_KEY"))
 
 
-  # Prepare the emulator if needed.
-  emulator_process = None
-  if args.emulator:
-    print('Starting emulator...')
-    emulator_process = android.start_emulator()
+def setup_testcase_run(testcase_id, build_directory, verbose, application,
+                       cache=None, disable_xvfb=False, display_count=1,
+                       memory_inputs=False, member_only=False):
+  """Download a test case and prepare the environment to run it against a
+  build on this host, fetching the build into |cache| if no build directory
+  is given. |memory_inputs| and |member_only| are passed on to
+  prepare_testcase. Android test cases are not supported.
+
+  Returns the test case, its job, crash and fuzzer, and the test case path."""
+  _prepare_initial_environment(build_directory, None, verbose)
+  (testcase, testcase_related_job, testcase_raelated_crash,
+   tesetcase_related_fuzzer) = _get_testcase_data(testcase_id)
+
+  platform = environment.platform().lower()
+  if testcase_related_job.platform.lower() != platform:
+    raise errors.ReproduceToolUnrecoverableError(
+        'Unable to run {testcase_platform} test cases on '
+        '{current_platform}.'.format(
+            testcase_platform=testcase_related_job.platform,
+            current_platform=platform))
+
+  testcase_path = prepare_testcase(
+      testcase, _get_testcase_directory('current-testcase', memory_inputs),
+      member_only)
+  if not build_directory:
+    build_directory = _fetch_build(testcase, testcase_related_job, cache)
+  _update_environment_for_testcase(testcase, testcase_related_job,
+                                   tesetcase_related_fuzzer, build_directory,
+                                   application)
+
+  if not disable_xvfb:
+    _setup_x(tesetcase_related_fuzzer.name, display_count=display_count)
+
+  return (testcase, testcase_related_job, testcase_raelated_crash,
+          tesetcase_related_fuzzer, testcase_path)
+
+
+def use_build_directory(build_directory):
+  """Point an environment prepared by setup_testcase_run at another build."""
+  _set_build_directory(build_directory)
+  build_utils.set_environment_vars(
+      [environment.get_value('FUZZER_DIR'), build_directory])
+  _verify_target_exists(build_directory)
+
+
+def execute(args):
+  """Attempt to reproduce a crash then report on the result."""
+  initialize()
+
+
+  if not args.build_dir and not args.fetch_build:
+    print('Either --build-dir or --fetch-build must be specified.')
+    return
+
+  cache = None
+  if args.fetch_build:
+    cache = build_cache.BuildCache(max_size_gb=args.build_cache_size)
 
   # The current working directory may change while we're running.
-  absolute_build_dir = os.path.abspath(args.build_dir)
-  try:
-    result = _reproduce_crash(args.testcase, absolute_build_dir,
-                              args.iterations, args.disable_xvfb, args.verbose,
-                              args.disable_android_setup, args.application)
-  except errors.ReproduceToolUnrecoverableError as exception:
-    print(exception)
+  absolute_build_dirs = [
+      os.path.abspath(build_dir) for build_dir in args.build_dir
+  ]
+  absolute_build_dir = absolute_build_dirs[0] if absolute_build_dirs else None
+
+  if args.watch and (len(absolute_build_dirs) != 1 or _is_batch(args)):
+    print('--watch needs a single --build-dir and a single test case.')
     return
-  finally:
-    if emulator_process:
-      emulator_process.terminate()
 
-  if not result:
+  if len(absolute_build_dirs) > 1:
+    if _is_batch(args):
+      print('Several build directories can only be used with a single test '
+            'case.')
+      return
+
+    _reproduce_differential(args.testcase[0], absolute_build_dirs, args)
     return
 
-  _print_stacktrace(result)
+  if _is_batch(args):
+    try:
+      testcase_ids = _get_testcase_ids(args)
+    except errors.ReproduceToolUnrecoverableError as exception:
+      print(exception)
+      return
 
-  if result.is_crash():
-    status_message = 'Test case reproduced successfully.'
-  else:
-    status_message = 'Unable to reproduce the desired crash.'
-  print(status_message)
+    if not testcase_ids:
+      print('No test cases to reproduce.')
+      return
+
+    _reproduce_batch(testcase_ids, absolute_build_dir, args, cache)
+    cleanup()
+    return
+
+  if args.emulator_count > 1 and not (args.emulator and args.all_devices):
+    print('--emulator-count needs --emulator and --all-devices to spread the '
+          'attempts across the emulators.')
+    return
+
+  # Prepare the emulators if needed.
+  if args.emulator:
+    print('Starting emulator...')
+    try:
+      serials = android.start_emulator_pool(args.emulator_count)
+    except errors.ReproduceToolUnrecoverableError as exception:
+      print(exception)
+      return
+
+    if not environment.get_value('ANDROID_SERIAL'):
+      environment.set_value('ANDROID_SERIAL', serials[0])
 
-  _cleanup()
+  try:
+    result = _reproduce_crash(args.testcase[0], absolute_build_dir,
+                              args.iterations, args.disable_xvfb, args.verbose,
+                              args.disable_android_setup, args.application,
+                              args.jobs, args.estimate_reproducibility, cache,
+                              args.memory_inputs, args.member_only,
+                              args.all_devices, args.fork_server,
+                              args.watch)
+    if result:
+      _print_stacktrace(result)
+      if result.is_crash():
+        status_message = 'Test case reproduced successfully.'
+      else:
+        status_message = 'Unable to reproduce the desired crash.'
+      print(status_message)
+  except errors.ReproduceToolUnrecoverableError as exception:
+    print(exception)
+  finally:
+    android.stop_emulator_pool()
+    cleanup()
@@ -14,6 +14,10 @@
 
 """Android emulator installation and management."""
 
+import atexit
+import contextlib
+import hashlib
+import multiprocessing
 import os
 import time
 
@@ -21,31 +25,251 @@ from pingu_sdk.platforms.android import adb
 from pingu_sdk.platforms.android import device
 from pingu_sdk.system import environment
 from pingu_sdk.system  import new_process
+from local.butler import profiler
 from local.butler.reproduce_tool import errors
 from local.butler.reproduce_tool import prompts
 
 ADB_DEVICES_SEPARATOR_STRING = 'List of devices attached'
 EMULATOR_RELATIVE_PATH = os.path.join('local', 'bin', 'android-sdk', 'emulator',
                                       'emulator')
+EMULATOR_AVD_NAME = 'TestImage'
+EMULATOR_SNAPSHOT_NAME = 'pingu-reproduce'
+EMULATOR_FIRST_PORT = 5554
+EMULATOR_LAST_PORT = 5682
+EMULATOR_BOOT_TIMEOUT = 300
+EMULATOR_BOOT_POLL_INTERVAL = 1
 
+_emulator_pool = None
 
-def start_emulator():
-  """Return a ProcessRunner configured to start the Android emulator."""
-  root_dir = environment.get_value('ROOT_DIR')
+# Pool of devices shared by this process and the workers it forks.
+_device_pool = None
 
-  runner = new_process.ProcessRunner(
-      os.path.join(root_dir, EMULATOR_RELATIVE_PATH),
-      ['-avd', 'TestImage', '-writable-system', '-partition-size', '2048'])
-  emulator_process = runner.run()
 
-  # If we run adb commands too soon after the emulator starts, we may see
-  # flake or errors. Delay a short while to account for this.
-  # TODO(mbarbella): This is slow and flaky, but wait-for-device isn't usable if
-  # another device is connected (as we don't know the serial yet). Find a better
-  # solution.
-  time.sleep(30)
+def _run_adb(serial, *args, timeout=None):
+  """Run an adb command against a specific device."""
+  adb_runner = new_process.ProcessRunner(adb.get_adb_path())
+  return adb_runner.run_and_wait(
+      additional_args=['-s', serial] + list(args), timeout=timeout)
+
+
+def _get_avd_directory():
+  """Return the directory of the emulator AVD, looked up like the emulator
+  itself does."""
+  avd_home = environment.get_value('ANDROID_AVD_HOME')
+  if not avd_home:
+    emulator_home = (environment.get_value('ANDROID_EMULATOR_HOME') or
+                     os.path.join(os.path.expanduser('~'), '.android'))
+    avd_home = os.path.join(emulator_home, 'avd')
+
+  return os.path.join(avd_home, EMULATOR_AVD_NAME + '.avd')
+
+
+def has_snapshot():
+  """Whether the AVD has the snapshot emulators quick boot from."""
+  return os.path.isdir(
+      os.path.join(_get_avd_directory(), 'snapshots', EMULATOR_SNAPSHOT_NAME))
+
+
+class Emulator(object):
+  """An Android emulator bound to a fixed console port, and so to a known
+  serial."""
+
+  def __init__(self, port, read_only=False):
+    self.port = port
+    self.serial = 'emulator-{port}'.format(port=port)
+    self._read_only = read_only
+    self._process = None
+    self._has_snapshot = False
+
+  def start(self):
+    """Start the emulator, quick booting from our snapshot if there is one.
+    Call wait_until_ready before using the device."""
+    root_dir = environment.get_value('ROOT_DIR')
+    arguments = [
+        '-avd', EMULATOR_AVD_NAME, '-writable-system', '-partition-size',
+        '2048', '-port',
+        str(self.port), '-snapshot', EMULATOR_SNAPSHOT_NAME,
+        '-no-snapshot-save'
+    ]
+    if self._read_only:
+      # Needed to run several instances of the same AVD at once.
+      arguments.append('-read-only')
+
+    runner = new_process.ProcessRunner(
+        os.path.join(root_dir, EMULATOR_RELATIVE_PATH), arguments)
+    self._process = runner.run()
+
+  def wait_until_ready(self):
+    """Block until the emulator has finished booting."""
+    deadline = time.time() + EMULATOR_BOOT_TIMEOUT
+    result = _run_adb(
+        self.serial, 'wait-for-device', timeout=EMULATOR_BOOT_TIMEOUT)
+    if result.return_code:
+      raise errors.ReproduceToolUnrecoverableError(
+          'Emulator {serial} did not come online.'.format(serial=self.serial))
+
+    while True:
+      result = _run_adb(self.serial, 'shell', 'getprop', 'sys.boot_completed')
+      if not result.return_code and result.output.strip() == '1':
+        break
+      if self._process.poll() is not None:
+        raise errors.ReproduceToolUnrecoverableError(
+            'Emulator {serial} exited while booting.'.format(
+                serial=self.serial))
+      if time.time() > deadline:
+        raise errors.ReproduceToolUnrecoverableError(
+            'Emulator {serial} did not boot within {timeout} seconds.'.format(
+                serial=self.serial, timeout=EMULATOR_BOOT_TIMEOUT))
+      time.sleep(EMULATOR_BOOT_POLL_INTERVAL)
+
+    # Read-only instances can't save snapshots.
+    if not self._read_only:
+      self._save_snapshot_if_missing()
+
+  def _save_snapshot_if_missing(self):
+    """Save a booted snapshot after a cold boot so later runs quick boot."""
+    result = _run_adb(self.serial, 'emu', 'avd', 'snapshot', 'list')
+    if EMULATOR_SNAPSHOT_NAME in result.output:
+      return
+
+    print('Saving emulator snapshot for quick boot...')
+    _run_adb(self.serial, 'emu', 'avd', 'snapshot', 'save',
+             EMULATOR_SNAPSHOT_NAME)
+
+  def terminate(self):
+    """Stop the emulator."""
+    if self._process:
+      self._process.terminate()
+      # The AVD stays locked until the emulator has exited.
+      self._process.wait()
+      self._process = None
+
+
+class EmulatorPool(object):
+  """A set of emulators booted together."""
+
+  def __init__(self, size):
+    used_serials = set(get_devices())
+    self.emulators = []
+    for port in range(EMULATOR_FIRST_PORT, EMULATOR_LAST_PORT + 1, 2):
+      if len(self.emulators) == size:
+        break
+      emulator = Emulator(port, read_only=size > 1)
+      if emulator.serial not in used_serials:
+        self.emulators.append(emulator)
+
+    if len(self.emulators) < size:
+      raise errors.ReproduceToolUnrecoverableError(
+          'Not enough free emulator ports for {size} emulators.'.format(
+              size=size))
+
+  @property
+  def serials(self):
+    return [emulator.serial for emulator in self.emulators]
+
+  def _create_snapshot(self):
+    """Boot a single writable instance so that it saves the snapshot the
+    read-only instances quick boot from."""
+    emulator = Emulator(self.emulators[0].port)
+    try:
+      emulator.start()
+      emulator.wait_until_ready()
+    finally:
+      emulator.terminate()
+
+  def start(self):
+    """Boot all emulators at once and wait for each of them to be ready."""
+    if len(self.emulators) > 1 and not has_snapshot():
+      self._create_snapshot()
+
+    try:
+      for emulator in self.emulators:
+        emulator.start()
+      for emulator in self.emulators:
+        emulator.wait_until_ready()
+    except Exception:
+      self.stop()
+      raise
+
+  def stop(self):
+    for emulator in self.emulators:
+      emulator.terminate()
+
+
+class DevicePool(object):
+  """Android devices or emulators that are leased one at a time."""
+
+  def __init__(self, serials):
+    self.serials = list(serials)
+    self.reset()
+
+  def reset(self):
+    """Make every device available again. Workers that were killed while
+    holding a lease never return it and may leave the queue locked, so the
+    queue is replaced. Only call this once no worker is left."""
+    self._available = multiprocessing.get_context('fork').Queue()
+    for serial in self.serials:
+      self._available.put(serial)
+
+  @contextlib.contextmanager
+  def lease(self):
+    """Lease a device and point ANDROID_SERIAL at it until released."""
+    serial = self._available.get()
+    previous_serial = environment.get_value('ANDROID_SERIAL')
+    environment.set_value('ANDROID_SERIAL', serial)
+    try:
+      yield serial
+    finally:
+      if previous_serial:
+        environment.set_value('ANDROID_SERIAL', previous_serial)
+      else:
+        environment.remove_key('ANDROID_SERIAL')
+      self._available.put(serial)
+
+
+@profiler.profiled('process.start.emulator', 'process')
+def start_emulator_pool(size=1):
+  """Boot a pool of emulators. Returns their serials."""
+  global _emulator_pool
+  stop_emulator_pool()
+
+  pool = EmulatorPool(size)
+  pool.start()
+  _emulator_pool = pool
+  atexit.register(stop_emulator_pool)
+  return pool.serials
+
+
+def stop_emulator_pool():
+  """Stop the emulator pool, if any. Safe to call more than once."""
+  global _emulator_pool
+  if _emulator_pool:
+    _emulator_pool.stop()
+    _emulator_pool = None
+
+
+def set_device_pool(serials):
+  """Share |serials| with this process and the workers it forks afterwards,
+  so that each attempt leases its own device."""
+  global _device_pool
+  _device_pool = DevicePool(serials)
 
-  return emulator_process
+
+def reset_device_pool():
+  """Reclaim the devices leased by workers that were killed."""
+  if _device_pool:
+    _device_pool.reset()
+
+
+@contextlib.contextmanager
+def leased_device():
+  """Lease a device from the shared pool, or do nothing if no pool is set."""
+  if not _device_pool:
+    yield None
+    return
+
+  with _device_pool.lease() as serial:
+    yield serial
 
 
 def get_devices():
@@ -107,3 +331,109 @@ def prepare_environment(disable_android_setup):
       apk_path, should_initialize_device=not disable_android_setup)
 
   device.push_testcases_to_device()
+
+
+def _get_file_hash(file_path):
+  """Return the SHA-256 of a local file."""
+  sha256 = hashlib.sha256()
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      sha256.update(chunk)
+
+  return sha256.hexdigest()
+
+
+def _get_installed_apk_hash(serial, package_name):
+  """Return the SHA-256 of the APK installed for |package_name| on a device,
+  or None if it is not installed."""
+  result = _run_adb(serial, 'shell', 'pm', 'path', package_name)
+  if result.return_code:
+    return None
+
+  for line in result.output.splitlines():
+    if line.startswith('package:') and line.endswith('base.apk'):
+      apk_path = line[len('package:'):]
+      break
+  else:
+    return None
+
+  result = _run_adb(serial, 'shell', 'sha256sum', apk_path)
+  if result.return_code or not result.output.strip():
+    return None
+
+  return result.output.split()[0]
+
+
+def _prepare_device(serial, apk_hash, disable_android_setup):
+  """Install the build on one device, unless the same APK is already
+  installed, and push the test cases to it. Runs in its own process as the
+  device helpers target ANDROID_SERIAL."""
+  environment.set_value('ANDROID_SERIAL', serial)
+  apk_path = environment.get_value('APP_PATH')
+  package_name = environment.get_value('PKG_NAME')
+  try:
+    if package_name and _get_installed_apk_hash(serial,
+                                                package_name) == apk_hash:
+      print('{serial}: build is already installed.'.format(serial=serial))
+      device.update_build(
+          apk_path,
+          force_update=False,
+          should_initialize_device=not disable_android_setup)
+    else:
+      print('{serial}: installing build...'.format(serial=serial))
+      device.update_build(
+          apk_path, should_initialize_device=not disable_android_setup)
+
+    device.push_testcases_to_device()
+  except Exception as e:
+    return serial, str(e)
+
+  return serial, None
+
+
+@profiler.profiled('android.prepare_devices', 'setup')
+def prepare_all_devices(disable_android_setup):
+  """Prepare every attached device or emulator in parallel. Returns the
+  serials of the devices that are ready to run the test case."""
+  environment.set_value('OS_OVERRIDE', 'ANDROID')
+
+  serials = get_devices()
+  if not serials:
+    raise errors.ReproduceToolUnrecoverableError(
+        'No connected Android devices were detected. Run with the -e '
+        'argument to use an emulator.')
+
+  print('Warning: this tool will make changes to settings on the connected '
+        'Android devices with serials {serials} that could result in data '
+        'loss.'.format(serials=', '.join(serials)))
+  willing_to_continue = prompts.get_boolean(
+      'Are you sure you want to continue?')
+  if not willing_to_continue:
+    raise errors.ReproduceToolUnrecoverableError(
+        'Bailing out to avoid changing settings on the connected devices.')
+
+  apk_path = environment.get_value('APP_PATH')
+  if not apk_path:
+    raise errors.ReproduceToolUnrecoverableError(
+        'APP_PATH is not set, so there is no build to install on the '
+        'devices. Make sure the job sets APP_PATH for Android builds.')
+
+  apk_hash = _get_file_hash(apk_path)
+  with multiprocessing.get_context('fork').Pool(len(serials)) as pool:
+    results = pool.starmap(
+        _prepare_device,
+        [(serial, apk_hash, disable_android_setup) for serial in serials])
+
+  ready_serials = []
+  for serial, error in results:
+    if error:
+      print('Skipping {serial}, failed to prepare it: {error}'.format(
+          serial=serial, error=error))
+    else:
+      ready_serials.append(serial)
+
+  if not ready_serials:
+    raise errors.ReproduceToolUnrecoverableError(
+        'Unable to prepare any of the connected devices.')
+
+  return ready_serials
@@ -0,0 +1,112 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batch reproduction of many test cases for the reproduce tool."""
+
+import json
+import multiprocessing
+import os
+import sys
+
+from local.butler.reproduce_tool import errors
+from local.butler.reproduce_tool import parallel
+
+STDOUT_OUTPUT = '-'
+
+
+def read_testcase_ids(testcase_ids, testcase_file=None):
+  """Return a de-duplicated list of test case IDs from the command line and
+  from an optional file with one ID per line."""
+  all_testcase_ids = list(testcase_ids)
+  if testcase_file:
+    try:
+      with open(testcase_file) as f:
+        for line in f:
+          line = line.split('#', 1)[0].strip()
+          if line:
+            all_testcase_ids.append(line)
+    except IOError as e:
+      raise errors.ReproduceToolUnrecoverableError(
+          'Unable to read test case IDs from {path}: {error}'.format(
+              path=testcase_file, error=e))
+
+  unique_testcase_ids = []
+  for testcase_id in all_testcase_ids:
+    if testcase_id not in unique_testcase_ids:
+      unique_testcase_ids.append(testcase_id)
+
+  return unique_testcase_ids
+
+
+def _initialize_worker(quiet):
+  """Set up a batch worker. Its console output is discarded if |quiet|, and
+  sent to stderr otherwise so that it never mixes with the report on
+  stdout."""
+  parallel.initialize_worker()
+  sys.stdout.flush()
+  if not quiet:
+    os.dup2(2, 1)
+    return
+
+  devnull = os.open(os.devnull, os.O_WRONLY)
+  os.dup2(devnull, 1)
+  os.close(devnull)
+
+
+class ResultWriter(object):
+  """Stream one JSON line per test case result."""
+
+  def __init__(self, output_path):
+    if output_path == STDOUT_OUTPUT:
+      self._file = sys.stdout
+      self._owns_file = False
+    else:
+      self._file = open(output_path, 'w')
+      self._owns_file = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    if self._owns_file:
+      self._file.close()
+
+  def write(self, result):
+    """Write a single result and flush it so that it can be tailed."""
+    self._file.write(json.dumps(result, sort_keys=True) + '\n')
+    self._file.flush()
+
+
+def run(reproduce_function, testcase_ids, workers, output_path, quiet=True):
+  """Run |reproduce_function| for every test case across a bounded pool of
+  |workers| processes and stream the results to |output_path|.
+
+  Each test case gets a fresh worker process forked from the prepared
+  environment, so per-job environment changes never leak between test
+  cases. Returns the list of results."""
+  results = []
+  pool = multiprocessing.get_context('fork').Pool(
+      workers,
+      initializer=_initialize_worker,
+      initargs=(quiet,),
+      maxtasksperchild=1)
+  try:
+    with ResultWriter(output_path) as writer:
+      for result in pool.imap_unordered(reproduce_function, testcase_ids):
+        writer.write(result)
+        results.append(result)
+  finally:
+    parallel.terminate_pool(pool)
+
+  return results
@@ -0,0 +1,81 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""K-ary revision bisection for the reproduce tool."""
+
+from local.butler.reproduce_tool import errors
+
+
+def _pick_probes(candidates, ways):
+  """Pick up to |ways| evenly spaced revisions that split |candidates| into
+  ranges of nearly equal size."""
+  count = min(ways, len(candidates))
+  indexes = {(len(candidates) + 1) * (i + 1) // (count + 1) - 1
+             for i in range(count)}
+  return [candidates[index] for index in sorted(indexes)]
+
+
+def find_change(revisions, test_revisions, ways):
+  """Find where behaviour changes across |revisions|, sorted in ascending
+  order, the first of which is expected to show the old behaviour and the
+  last the new one.
+
+  |test_revisions| is called with a list of revisions to test concurrently
+  and returns a dict mapping each of them to True if it shows the new
+  behaviour, False if it shows the old one and None if it could not be
+  tested. Each round tests up to |ways| revisions, narrowing the range to
+  about 1/(|ways| + 1) of its size. Returns the last revision with the old
+  behaviour and the first one with the new behaviour."""
+  if len(revisions) < 2:
+    raise errors.ReproduceToolUnrecoverableError(
+        'At least two builds are needed to bisect.')
+
+  before = revisions[0]
+  after = revisions[-1]
+  candidates = revisions[1:-1]
+
+  # Check the range ends in the first round, alongside the first probes.
+  probes = _pick_probes(candidates, ways)
+  results = test_revisions([before, after] + probes)
+  if results[before] is not False:
+    raise errors.ReproduceToolUnrecoverableError(
+        'Revision {revision} does not show the old behaviour.'.format(
+            revision=before))
+  if results[after] is not True:
+    raise errors.ReproduceToolUnrecoverableError(
+        'Revision {revision} does not show the new behaviour.'.format(
+            revision=after))
+
+  untestable = set()
+  while True:
+    for revision in probes:
+      if results[revision] is None:
+        untestable.add(revision)
+      elif results[revision]:
+        after = revision
+        break
+      else:
+        before = revision
+
+    candidates = [
+        revision for revision in candidates
+        if before < revision < after and revision not in untestable
+    ]
+    print('Narrowed the range to {before}:{after} ({count} builds '
+          'left).'.format(before=before, after=after, count=len(candidates)))
+    if not candidates:
+      return before, after
+
+    probes = _pick_probes(candidates, ways)
+    results = test_revisions(probes)
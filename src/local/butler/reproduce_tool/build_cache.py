@@ -0,0 +1,502 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local build cache and build downloads for the reproduce tool."""
+
+import concurrent.futures
+import contextlib
+import fcntl
+import json
+import os
+import re
+import shutil
+import tarfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from xml.etree import ElementTree
+
+from pingu_sdk.system import archive
+from pingu_sdk.system import environment
+from pingu_sdk.system import shell
+from local.butler.reproduce_tool import errors
+
+CONFIG_DIRECTORY = os.path.join(
+    os.path.expanduser('~'), '.config', 'bot')
+DEFAULT_CACHE_DIRECTORY = os.path.join(CONFIG_DIRECTORY, 'build-cache')
+DEFAULT_CACHE_SIZE_GB = 20
+
+BUILD_BUCKET_PATH_ENV = 'RELEASE_BUILD_BUCKET_PATH'
+COMPLETE_MARKER = '.complete'
+# Builds hold a shared lock on this sibling file for as long as they are in
+# use, so that eviction skips them.
+IN_USE_SUFFIX = '.in-use'
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+DOWNLOAD_CONNECTIONS = 8
+DOWNLOAD_TIMEOUT = 60
+READ_BUFFER_SIZE = 1024 * 1024
+REVISION_PATTERN = re.compile(r'\([^)]*\)')
+S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz',
+                  '.txz')
+
+
+def get_build_url(build_bucket_path, revision):
+  """Return the URL of the build for |revision| given a bucket path pattern
+  such as http://127.0.0.1:9000/test/test-([0-9]+).zip."""
+  if not REVISION_PATTERN.search(build_bucket_path):
+    raise errors.ReproduceToolUnrecoverableError(
+        'Build bucket path {path} does not contain a revision pattern.'.format(
+            path=build_bucket_path))
+
+  return REVISION_PATTERN.sub(str(revision), build_bucket_path, count=1)
+
+
+def get_job_build_bucket_path(job):
+  """Return the release build bucket path pattern of a job."""
+  job_environment = environment.parse_environment_definition(
+      job.environment_string or '')
+  build_bucket_path = job_environment.get(BUILD_BUCKET_PATH_ENV)
+  if not build_bucket_path:
+    raise errors.ReproduceToolUnrecoverableError(
+        'Job {job} does not define {variable}, unable to fetch its '
+        'builds.'.format(job=job.id, variable=BUILD_BUCKET_PATH_ENV))
+
+  return build_bucket_path
+
+
+def list_build_revisions(build_bucket_path):
+  """Return the sorted revisions of all builds matching a bucket path pattern
+  such as http://127.0.0.1:9000/test/test-([0-9]+).zip, listed with S3
+  ListObjectsV2 requests."""
+  parsed_url = urllib.parse.urlparse(build_bucket_path)
+  bucket, _, key_pattern = parsed_url.path.lstrip('/').partition('/')
+  revision_match = REVISION_PATTERN.search(key_pattern)
+  if not bucket or not revision_match:
+    raise errors.ReproduceToolUnrecoverableError(
+        'Build bucket path {path} does not contain a revision pattern.'.format(
+            path=build_bucket_path))
+
+  key_regex = re.compile(key_pattern)
+  revisions = set()
+  query = {'list-type': '2', 'prefix': key_pattern[:revision_match.start()]}
+  while True:
+    url = '{scheme}://{netloc}/{bucket}?{query}'.format(
+        scheme=parsed_url.scheme,
+        netloc=parsed_url.netloc,
+        bucket=bucket,
+        query=urllib.parse.urlencode(query))
+    try:
+      with _open_url(url) as response:
+        root = ElementTree.parse(response).getroot()
+    except (urllib.error.URLError, ElementTree.ParseError) as e:
+      raise errors.ReproduceToolUnrecoverableError(
+          'Unable to list builds in {url}: {error}'.format(url=url, error=e))
+
+    for contents in root.iter(S3_NAMESPACE + 'Contents'):
+      key_match = key_regex.fullmatch(contents.findtext(S3_NAMESPACE + 'Key'))
+      if key_match and key_match.group(1).isdigit():
+        revisions.add(int(key_match.group(1)))
+
+    if root.findtext(S3_NAMESPACE + 'IsTruncated') != 'true':
+      break
+    query['continuation-token'] = root.findtext(S3_NAMESPACE +
+                                                'NextContinuationToken')
+
+  return sorted(revisions)
+
+
+def _is_tar_archive(path):
+  """Whether the archive can be unpacked from a stream."""
+  return path.lower().endswith(TAR_EXTENSIONS)
+
+
+def _open_url(url, byte_range=None, method='GET'):
+  """Open a URL, optionally requesting an inclusive byte range."""
+  request = urllib.request.Request(url, method=method)
+  if byte_range:
+    request.add_header('Range', 'bytes={}-{}'.format(*byte_range))
+
+  return urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+
+
+class _DownloadState(object):
+  """Tracks which chunks of a ranged download are on disk so that an
+  interrupted download can be resumed."""
+
+  def __init__(self, state_path, url, size, etag):
+    self._state_path = state_path
+    self._lock = threading.Condition()
+    self.size = size
+    self.chunk_count = (size + DOWNLOAD_CHUNK_SIZE - 1) // DOWNLOAD_CHUNK_SIZE
+    self.completed = set()
+    self.failed = False
+    self._identity = {'url': url, 'size': size, 'etag': etag}
+
+    try:
+      with open(state_path) as f:
+        saved_state = json.load(f)
+      if saved_state.get('identity') == self._identity:
+        self.completed = set(saved_state['completed'])
+    except (IOError, ValueError, KeyError):
+      pass
+
+  def chunk_range(self, index):
+    """Inclusive byte range of a chunk."""
+    start = index * DOWNLOAD_CHUNK_SIZE
+    return start, min(start + DOWNLOAD_CHUNK_SIZE, self.size) - 1
+
+  def missing_chunks(self):
+    """Chunks that still need to be downloaded."""
+    return [i for i in range(self.chunk_count) if i not in self.completed]
+
+  def mark_completed(self, index):
+    """Record a downloaded chunk and wake up any streaming reader."""
+    with self._lock:
+      self.completed.add(index)
+      with open(self._state_path, 'w') as f:
+        json.dump({
+            'identity': self._identity,
+            'completed': sorted(self.completed)
+        }, f)
+      self._lock.notify_all()
+
+  def mark_failed(self):
+    """Wake up any streaming reader so it can bail out."""
+    with self._lock:
+      self.failed = True
+      self._lock.notify_all()
+
+  def _contiguous_bytes(self):
+    """Number of bytes available from the start of the file."""
+    index = 0
+    while index in self.completed:
+      index += 1
+
+    return min(index * DOWNLOAD_CHUNK_SIZE, self.size)
+
+  def wait_for(self, offset):
+    """Block until the byte at |offset| is on disk. Returns the number of
+    contiguous bytes available."""
+    with self._lock:
+      while True:
+        available = self._contiguous_bytes()
+        if available > offset or available == self.size:
+          return available
+        if self.failed:
+          raise errors.ReproduceToolUnrecoverableError('Build download failed.')
+        self._lock.wait()
+
+
+class _StreamingReader(object):
+  """File-like object reading a partially downloaded file in order, blocking
+  until the data it needs has arrived."""
+
+  def __init__(self, path, state):
+    self._file = open(path, 'rb')
+    self._state = state
+    self._offset = 0
+
+  def read(self, size=-1):
+    if self._offset >= self._state.size:
+      return b''
+
+    available = self._state.wait_for(self._offset)
+    if size < 0:
+      size = available - self._offset
+    size = min(size, available - self._offset)
+
+    self._file.seek(self._offset)
+    data = self._file.read(size)
+    self._offset += len(data)
+    return data
+
+  def close(self):
+    self._file.close()
+
+
+def _download_chunk(url, part_path, state, index):
+  """Download a single chunk into its place in the partial file."""
+  start, end = state.chunk_range(index)
+  with _open_url(url, byte_range=(start, end)) as response:
+    if response.status != 206:
+      raise errors.ReproduceToolUnrecoverableError(
+          'Server ignored the range request for {url}.'.format(url=url))
+
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+      offset = start
+      while True:
+        data = response.read(READ_BUFFER_SIZE)
+        if not data:
+          break
+        os.pwrite(fd, data, offset)
+        offset += len(data)
+    finally:
+      os.close(fd)
+
+  if offset != end + 1:
+    raise errors.ReproduceToolUnrecoverableError(
+        'Incomplete chunk received for {url}.'.format(url=url))
+
+  state.mark_completed(index)
+
+
+def _download_ranged(url, archive_path, size, etag, unpack_directory,
+                     connections):
+  """Download with parallel ranged GETs, resuming a previous partial download
+  if there is one. Tar archives are unpacked while they download."""
+  part_path = archive_path + '.part'
+  state = _DownloadState(archive_path + '.state', url, size, etag)
+  if not os.path.exists(part_path) or os.path.getsize(part_path) != size:
+    state.completed = set()
+    with open(part_path, 'wb') as f:
+      f.truncate(size)
+
+  missing_chunks = state.missing_chunks()
+  if len(missing_chunks) != state.chunk_count:
+    print('Resuming build download ({done}/{total} chunks present)...'.format(
+        done=state.chunk_count - len(missing_chunks), total=state.chunk_count))
+
+  stream_unpack = _is_tar_archive(url)
+  with concurrent.futures.ThreadPoolExecutor(connections + 1) as executor:
+    unpack_future = None
+    if stream_unpack:
+      unpack_future = executor.submit(_unpack_stream,
+                                      _StreamingReader(part_path, state),
+                                      unpack_directory)
+
+    chunk_futures = [
+        executor.submit(_download_chunk, url, part_path, state, index)
+        for index in missing_chunks
+    ]
+    try:
+      for future in concurrent.futures.as_completed(chunk_futures):
+        future.result()
+    except Exception:
+      for future in chunk_futures:
+        future.cancel()
+      state.mark_failed()
+      raise
+
+    if unpack_future:
+      unpack_future.result()
+
+  os.rename(part_path, archive_path)
+  os.remove(archive_path + '.state')
+  return stream_unpack
+
+
+def _unpack_stream(reader, unpack_directory):
+  """Unpack a tar stream as it is read."""
+  try:
+    with tarfile.open(fileobj=reader, mode='r|*') as tar:
+      tar.extractall(unpack_directory)
+  finally:
+    reader.close()
+
+
+def download_build(url, archive_path, unpack_directory,
+                   connections=DOWNLOAD_CONNECTIONS):
+  """Download a build archive and unpack it into |unpack_directory|."""
+  print('Downloading build from {url}...'.format(url=url))
+  with _open_url(url, method='HEAD') as response:
+    size = int(response.headers.get('Content-Length') or 0)
+    accepts_ranges = response.headers.get('Accept-Ranges') == 'bytes'
+    etag = response.headers.get('ETag')
+
+  if accepts_ranges and size:
+    unpacked = _download_ranged(url, archive_path, size, etag,
+                                unpack_directory, connections)
+  elif _is_tar_archive(url):
+    with _open_url(url) as response:
+      _unpack_stream(response, unpack_directory)
+    unpacked = True
+  else:
+    with _open_url(url) as response, open(archive_path, 'wb') as f:
+      shutil.copyfileobj(response, f, READ_BUFFER_SIZE)
+    unpacked = False
+
+  if not unpacked:
+    print('Unpacking build...')
+    archive.unpack(archive_path, unpack_directory, trusted=True)
+
+
+def _get_directory_size(path):
+  """Total size of the files under |path|."""
+  total_size = 0
+  for root, _, filenames in os.walk(path):
+    for filename in filenames:
+      file_path = os.path.join(root, filename)
+      if not os.path.islink(file_path):
+        total_size += os.path.getsize(file_path)
+
+  return total_size
+
+
+class BuildCache(object):
+  """Size-bounded least recently used cache of unpacked builds, keyed by job
+  and revision."""
+
+  def __init__(self, cache_directory=DEFAULT_CACHE_DIRECTORY,
+               max_size_gb=DEFAULT_CACHE_SIZE_GB):
+    self.cache_directory = cache_directory
+    self.max_size_bytes = int(max_size_gb * 1024 * 1024 * 1024)
+    self._in_use = {}
+    shell.create_directory(cache_directory, create_intermediates=True)
+
+  def _build_directory(self, job_name, revision):
+    return os.path.join(self.cache_directory, str(job_name), str(revision))
+
+  @contextlib.contextmanager
+  def _lock(self, name):
+    """Serialize work on a cache entry across threads and processes."""
+    lock_path = os.path.join(self.cache_directory, name + '.lock')
+    with open(lock_path, 'w') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  def _hold(self, build_directory):
+    """Mark |build_directory| as in use until it is released or this process
+    exits. Forked workers inherit the lock."""
+    if build_directory in self._in_use:
+      return
+
+    shell.create_directory(
+        os.path.dirname(build_directory), create_intermediates=True)
+    lock_file = open(build_directory + IN_USE_SUFFIX, 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_SH)
+    self._in_use[build_directory] = lock_file
+
+  def release(self, build_directory):
+    """Let a build returned by fetch be evicted again."""
+    lock_file = self._in_use.pop(build_directory, None)
+    if lock_file:
+      lock_file.close()
+
+  def get(self, job_name, revision):
+    """Return the cached build directory, or None if it is not cached."""
+    build_directory = self._build_directory(job_name, revision)
+    marker_path = os.path.join(build_directory, COMPLETE_MARKER)
+    if not os.path.exists(marker_path):
+      return None
+
+    # The marker's modification time is the entry's last use.
+    os.utime(marker_path)
+    return build_directory
+
+  def fetch(self, job_name, revision, url):
+    """Return the build directory for a job and revision, downloading the
+    build if it is not cached yet. The build stays in use, and so is never
+    evicted, until it is released or this process exits."""
+    # Held before looking the build up so that it can't be evicted in
+    # between.
+    self._hold(self._build_directory(job_name, revision))
+    build_directory = self.get(job_name, revision)
+    if build_directory:
+      print('Using cached build {directory}.'.format(directory=build_directory))
+      return build_directory
+
+    entry_name = '{job}-{revision}'.format(job=job_name, revision=revision)
+    with self._lock(entry_name):
+      # Another process may have fetched it while we waited for the lock.
+      build_directory = self.get(job_name, revision)
+      if build_directory:
+        return build_directory
+
+      build_directory = self._build_directory(job_name, revision)
+      staging_directory = build_directory + '.staging'
+      shell.remove_directory(staging_directory, recreate=True)
+      shell.create_directory(
+          os.path.dirname(build_directory), create_intermediates=True)
+
+      archive_path = os.path.join(
+          self.cache_directory, entry_name + '-' + os.path.basename(url))
+      download_build(url, archive_path, staging_directory)
+      if os.path.exists(archive_path):
+        os.remove(archive_path)
+
+      size = _get_directory_size(staging_directory)
+      with open(os.path.join(staging_directory, COMPLETE_MARKER), 'w') as f:
+        json.dump({'url': url, 'size': size}, f)
+
+      shell.remove_directory(build_directory)
+      os.rename(staging_directory, build_directory)
+
+    self.evict()
+    return build_directory
+
+  def _entries(self):
+    """Return (last use, size, path) for every complete cache entry."""
+    entries = []
+    for job_name in os.listdir(self.cache_directory):
+      job_directory = os.path.join(self.cache_directory, job_name)
+      if not os.path.isdir(job_directory):
+        continue
+
+      for revision in os.listdir(job_directory):
+        build_directory = os.path.join(job_directory, revision)
+        marker_path = os.path.join(build_directory, COMPLETE_MARKER)
+        try:
+          with open(marker_path) as f:
+            size = json.load(f)['size']
+          entries.append((os.path.getmtime(marker_path), size, build_directory))
+        except (IOError, ValueError, KeyError):
+          continue
+
+    return entries
+
+  def _remove_unused(self, build_directory):
+    """Remove |build_directory| unless a process uses it. Returns whether it
+    was removed."""
+    with open(build_directory + IN_USE_SUFFIX, 'w') as lock_file:
+      try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        return False
+
+      print('Evicting cached build {directory}.'.format(
+          directory=build_directory))
+      shell.remove_directory(build_directory)
+      return True
+
+  def evict(self):
+    """Remove the least recently used builds until the cache fits within its
+    size bound. Builds in use are skipped, so the cache may stay above its
+    bound while they are used."""
+    entries = sorted(self._entries())
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, build_directory in entries:
+      if total_size <= self.max_size_bytes:
+        break
+
+      if self._remove_unused(build_directory):
+        total_size -= size
+
+
+def fetch_testcase_build(testcase, job, cache):
+  """Fetch the build a test case crashed on into |cache| and return its
+  directory."""
+  revision = testcase.crash_revision
+  if not revision:
+    raise errors.ReproduceToolUnrecoverableError(
+        'Test case {testcase} has no crash revision, unable to fetch its '
+        'build.'.format(testcase=testcase.id))
+
+  url = get_build_url(get_job_build_bucket_path(job), revision)
+  return cache.fetch(job.id, revision, url)
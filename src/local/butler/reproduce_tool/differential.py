@@ -0,0 +1,177 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Differential reproduction of a test case across several builds, such as
+the ASan, UBSan and MSan variants of a job."""
+
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+
+from pingu_sdk import testcase_manager
+from pingu_sdk.system import environment
+from pingu_sdk.system import shell
+from local.butler.reproduce_tool import forkserver
+from local.butler.reproduce_tool import parallel
+from local.butler.reproduce_tool import symbolizer
+from local.butler.reproduce_tool import xvfb
+
+SANITIZER_PATTERNS = [
+    ('ASan', re.compile(r'ERROR: AddressSanitizer')),
+    ('HWASan', re.compile(r'ERROR: HWAddressSanitizer')),
+    ('LSan', re.compile(r'ERROR: LeakSanitizer')),
+    ('MSan', re.compile(r'(ERROR|WARNING): MemorySanitizer')),
+    ('TSan', re.compile(r'WARNING: ThreadSanitizer')),
+    ('UBSan', re.compile(r'runtime error:|ERROR: UndefinedBehaviorSanitizer')),
+]
+NO_SANITIZER = '-'
+
+# State shared with forked workers. Set right before the pool is created so
+# that it is inherited rather than pickled.
+_differential_context = None
+
+
+def detect_sanitizers(output):
+  """Return the names of the sanitizers that reported an error in |output|."""
+  return [
+      name for name, pattern in SANITIZER_PATTERNS if pattern.search(output)
+  ]
+
+
+def _run_build(build_directory):
+  """Run the test case against a single build in a worker and return its
+  report."""
+  (testcase, testcase_path, crash, iterations, use_build_directory,
+   scratch_root) = _differential_context
+  report = {
+      'build_directory': build_directory,
+      'sanitizers': [],
+      'crashed': False,
+      'matches_expected': False,
+      'crash_type': None,
+      'crash_state': None,
+      'stacktrace': '',
+      'error': None,
+  }
+
+  scratch_directory = None
+  try:
+    use_build_directory(build_directory)
+
+    inputs_directory = environment.get_value('FUZZ_INPUTS')
+    scratch_directory = os.path.join(scratch_root,
+                                     'worker-{}'.format(os.getpid()))
+    shutil.copytree(inputs_directory, scratch_directory)
+    environment.set_value('FUZZ_INPUTS', scratch_directory)
+    build_testcase_path = os.path.join(
+        scratch_directory, os.path.relpath(testcase_path, inputs_directory))
+
+    # Every build reports its own crash, which may differ from the expected
+    # one, e.g. when another sanitizer fires first.
+    with xvfb.leased_display():
+      result = testcase_manager.test_for_crash_with_retries(
+          testcase,
+          build_testcase_path,
+          environment.get_value('TEST_TIMEOUT'),
+          crash,
+          compare_crash=False,
+          crash_retries=iterations)
+
+    report['stacktrace'] = result.get_stacktrace(symbolize_flag=False)
+    report['sanitizers'] = detect_sanitizers(result.output or '')
+    report['crashed'] = result.is_crash()
+    if result.is_crash():
+      report['matches_expected'] = forkserver.is_expected_crash(result, crash)
+      report['crash_type'] = result.get_type()
+      report['crash_state'] = result.get_state()
+  except Exception as e:
+    report['error'] = str(e)
+  finally:
+    if scratch_directory:
+      shell.remove_directory(scratch_directory)
+
+  return report
+
+
+def run(testcase, testcase_path, crash, build_directories, iterations,
+        use_build_directory):
+  """Run the test case against all |build_directories| concurrently, with up
+  to |iterations| attempts each, until a build crashes in any way. |use_build_directory| points the prepared
+  environment at a build. Returns one report per build, in order."""
+  global _differential_context
+
+  scratch_root = tempfile.mkdtemp(
+      prefix='differential-',
+      dir=os.path.dirname(environment.get_value('FUZZ_INPUTS')))
+  _differential_context = (testcase, testcase_path, crash, iterations,
+                           use_build_directory, scratch_root)
+
+  pool = multiprocessing.get_context('fork').Pool(
+      len(build_directories),
+      initializer=parallel.initialize_worker,
+      maxtasksperchild=1)
+  try:
+    return pool.map(_run_build, build_directories)
+  finally:
+    parallel.terminate_pool(pool)
+    _differential_context = None
+    shell.remove_directory(scratch_root)
+
+
+def _format_state(crash_state):
+  """Show a multi-line crash state on a single line."""
+  return ' / '.join(line for line in (crash_state or '').splitlines() if line)
+
+
+def format_report(reports, expected_crash_state):
+  """Return a merged report of which sanitizers fired on which build and
+  with which crash states, followed by each build's stack trace."""
+  lines = ['Expected crash state: {state}'.format(
+      state=_format_state(expected_crash_state)), '']
+
+  name_width = max(len(report['build_directory']) for report in reports)
+  row_format = ('{build:<' + str(name_width) + '}  {sanitizers:<12}  '
+                '{crashed:<7}  {expected:<8}  {crash_type:<24}  {crash_state}')
+  lines.append(
+      row_format.format(
+          build='Build',
+          sanitizers='Sanitizers',
+          crashed='Crashed',
+          expected='Expected',
+          crash_type='Crash type',
+          crash_state='Crash state'))
+  for report in reports:
+    lines.append(
+        row_format.format(
+            build=report['build_directory'],
+            sanitizers=','.join(report['sanitizers']) or NO_SANITIZER,
+            crashed='yes' if report['crashed'] else 'no',
+            expected='yes' if report['matches_expected'] else 'no',
+            crash_type=report['crash_type'] or NO_SANITIZER,
+            crash_state=(_format_state(report['crash_state']) or
+                         report['error'] or NO_SANITIZER)))
+
+  for report in reports:
+    if not report['stacktrace']:
+      continue
+
+    stacktrace = symbolizer.symbolize_stacktrace(report['stacktrace'])
+    lines.extend([
+        '', '#' * 80, report['build_directory'], '#' * 80,
+        stacktrace if stacktrace is not None else report['stacktrace']
+    ])
+
+  return '\n'.join(lines)
@@ -0,0 +1,285 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fork server execution of blackbox targets for the reproduce tool.
+
+The target is started once with a preloaded shim that stops it right before
+main(). Every attempt then forks a fresh child from that point instead of
+exec'ing the target from scratch."""
+
+import hashlib
+import os
+import select
+import shlex
+import shutil
+import signal
+import struct
+import subprocess
+import tempfile
+import time
+
+from pingu_sdk import testcase_manager
+from pingu_sdk.crash_analysis.crash_comparer import CrashComparer
+from pingu_sdk.crash_analysis.crash_result import CrashResult
+from pingu_sdk.system import environment
+from local.butler.reproduce_tool import errors
+
+CONFIG_DIRECTORY = os.path.join(
+    os.path.expanduser('~'), '.config', 'bot')
+SHIM_DIRECTORY = os.path.join(CONFIG_DIRECTORY, 'forkserver')
+SHIM_SOURCE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'forkserver_shim.c')
+
+DESCRIPTORS_ENV = 'PINGU_FORKSERVER_FDS'
+OUTPUT_DIRECTORY_ENV = 'PINGU_FORKSERVER_OUTPUT_DIR'
+
+STARTUP_TIMEOUT = 60
+SHUTDOWN_TIMEOUT = 5
+INT32 = struct.Struct('=i')
+UINT32 = struct.Struct('=I')
+
+
+def is_supported(fuzzer_name):
+  """Whether test cases of |fuzzer_name| can run through a fork server. Only
+  blackbox targets on Linux are supported."""
+  return (environment.platform() == 'LINUX' and
+          not environment.is_engine_fuzzer_job(fuzzer_name))
+
+
+def build_shim():
+  """Compile the shim once per source revision and return its path."""
+  with open(SHIM_SOURCE_PATH, 'rb') as f:
+    source_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+
+  shim_path = os.path.join(SHIM_DIRECTORY,
+                           'forkserver-{}.so'.format(source_hash))
+  if os.path.exists(shim_path):
+    return shim_path
+
+  compiler = environment.get_value('CC') or shutil.which('cc')
+  if not compiler:
+    raise errors.ReproduceToolUnrecoverableError(
+        'A C compiler is required to build the fork server shim.')
+
+  os.makedirs(SHIM_DIRECTORY, exist_ok=True)
+  # Compile to a private path first so that concurrent builds never load a
+  # partially written shim.
+  temporary_path = '{path}.{pid}'.format(path=shim_path, pid=os.getpid())
+  process = subprocess.run(
+      [
+          compiler, '-shared', '-fPIC', '-O2', '-o', temporary_path,
+          SHIM_SOURCE_PATH, '-ldl'
+      ],
+      stdout=subprocess.PIPE,
+      stderr=subprocess.STDOUT,
+      universal_newlines=True)
+  if process.returncode:
+    raise errors.ReproduceToolUnrecoverableError(
+        'Failed to build the fork server shim:\n{output}'.format(
+            output=process.stdout))
+
+  os.replace(temporary_path, shim_path)
+  return shim_path
+
+
+def _decode_wait_status(status):
+  """Convert a wait status to a return code, negative for signals like
+  subprocess does."""
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+
+  return os.WEXITSTATUS(status)
+
+
+def is_expected_crash(result, crash):
+  """Whether |result| reproduces |crash| the way test_for_crash_with_retries
+  decides it."""
+  if not result.is_crash():
+    return False
+
+  if crash.flaky_stack:
+    return True
+
+  if result.is_security_issue() != crash.security_flag:
+    return False
+
+  return CrashComparer(result.get_state(), crash.crash_state).is_similar()
+
+
+class ForkServer(object):
+  """A target stopped before main() that forks one child per attempt."""
+
+  def __init__(self, testcase_path, output_directory=None):
+    self._testcase_path = testcase_path
+    self._output_directory = output_directory
+    self._owns_output_directory = not output_directory
+    self._process = None
+    self._control_fd = None
+    self._status_fd = None
+    self._attempt = 0
+
+  def _read_int(self, timeout):
+    """Read a single integer from the status pipe. Returns None on timeout."""
+    data = b''
+    deadline = None if timeout is None else time.time() + timeout
+    while len(data) < INT32.size:
+      remaining = None if deadline is None else max(0, deadline - time.time())
+      readable, _, _ = select.select([self._status_fd], [], [], remaining)
+      if not readable:
+        return None
+
+      chunk = os.read(self._status_fd, INT32.size - len(data))
+      if not chunk:
+        raise errors.ReproduceToolUnrecoverableError(
+            'The fork server exited unexpectedly.')
+      data += chunk
+
+    return INT32.unpack(data)[0]
+
+  def start(self):
+    """Launch the target and wait until it reaches main()."""
+    shim_path = build_shim()
+    if not self._output_directory:
+      self._output_directory = tempfile.mkdtemp(prefix='forkserver-')
+
+    control_read, control_write = os.pipe()
+    status_read, status_write = os.pipe()
+
+    env = os.environ.copy()
+    env['LD_PRELOAD'] = ' '.join(
+        filter(None, [shim_path, env.get('LD_PRELOAD')]))
+    env[DESCRIPTORS_ENV] = '{},{}'.format(control_read, status_write)
+    env[OUTPUT_DIRECTORY_ENV] = self._output_directory
+
+    command = testcase_manager.get_command_line_for_application(
+        self._testcase_path)
+    try:
+      self._process = subprocess.Popen(
+          shlex.split(command),
+          env=env,
+          stdin=subprocess.DEVNULL,
+          stdout=subprocess.DEVNULL,
+          stderr=subprocess.DEVNULL,
+          pass_fds=(control_read, status_write))
+    finally:
+      os.close(control_read)
+      os.close(status_write)
+
+    self._control_fd = control_write
+    self._status_fd = status_read
+    try:
+      hello = self._read_int(STARTUP_TIMEOUT)
+    except errors.ReproduceToolUnrecoverableError:
+      hello = None
+
+    if hello is None:
+      self.stop()
+      raise errors.ReproduceToolUnrecoverableError(
+          'The target did not start a fork server. It may be statically '
+          'linked.')
+
+  def run(self, timeout, testcase_data=None):
+    """Run a single attempt, optionally with new test case contents, and
+    return its CrashResult."""
+    if testcase_data is not None:
+      with open(self._testcase_path, 'wb') as f:
+        f.write(testcase_data)
+
+    self._attempt += 1
+    os.write(self._control_fd, UINT32.pack(self._attempt))
+    child_pid = self._read_int(STARTUP_TIMEOUT)
+    if child_pid is None:
+      raise errors.ReproduceToolUnrecoverableError(
+          'The fork server stopped responding.')
+
+    start_time = time.time()
+    status = self._read_int(timeout)
+    if status is None:
+      try:
+        os.kill(child_pid, signal.SIGKILL)
+      except OSError:
+        pass
+      status = self._read_int(None)
+    crash_time = time.time() - start_time
+
+    log_path = os.path.join(self._output_directory,
+                            'attempt-{}.log'.format(self._attempt))
+    output = ''
+    if os.path.exists(log_path):
+      with open(log_path, errors='replace') as f:
+        output = f.read()
+      os.remove(log_path)
+
+    return CrashResult(_decode_wait_status(status), crash_time, output)
+
+  def test_for_crash_with_retries(self,
+                                  crash,
+                                  timeout,
+                                  crash_retries=None,
+                                  compare_crash=True):
+    """Fork server counterpart of testcase_manager.test_for_crash_with_retries.
+    Stops at the first attempt that reproduces |crash|, or at the first crash
+    of any kind without |compare_crash|."""
+    if crash_retries is None:
+      crash_retries = environment.get_value('CRASH_RETRIES')
+
+    result = None
+    for _ in range(crash_retries):
+      result = self.run(timeout)
+      if not compare_crash and result.is_crash():
+        return result
+      if is_expected_crash(result, crash):
+        return result
+
+    if result and result.is_crash():
+      # A different crash does not count as reproducing this one.
+      return CrashResult(0, result.crash_time, '')
+
+    return result
+
+  def stop(self):
+    """Shut the fork server down. Closing the control pipe makes it exit."""
+    if self._control_fd is not None:
+      os.close(self._control_fd)
+      self._control_fd = None
+
+    if self._process:
+      try:
+        self._process.wait(timeout=SHUTDOWN_TIMEOUT)
+      except subprocess.TimeoutExpired:
+        self._process.kill()
+        self._process.wait()
+      self._process = None
+
+    if self._status_fd is not None:
+      os.close(self._status_fd)
+      self._status_fd = None
+
+    if self._owns_output_directory and self._output_directory:
+      shutil.rmtree(self._output_directory, ignore_errors=True)
+      self._output_directory = None
+
+
+def try_start(testcase_path, output_directory=None):
+  """Start a fork server for |testcase_path|. Returns None if the target can
+  not run under one, in which case attempts exec the target as usual."""
+  fork_server = ForkServer(testcase_path, output_directory)
+  try:
+    fork_server.start()
+  except errors.ReproduceToolUnrecoverableError as exception:
+    print('{exception} Running without the fork server.'.format(
+        exception=exception))
+    return None
+
+  return fork_server
@@ -0,0 +1,117 @@
+// Copyright 2024 IOActive
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+// Fork server shim for the reproduce tool, loaded with LD_PRELOAD.
+//
+// It wraps the target's main() so that dynamic linking and static
+// initializers run once. Right before main() would read the input, the
+// process turns into a fork server: for every attempt number received on the
+// control descriptor it forks a child that runs main() with its output sent to
+// a per-attempt log file, and it reports the child's pid and wait status back
+// on the status descriptor. Both descriptors are passed in the environment;
+// without them the target runs normally.
+
+#define _GNU_SOURCE
+#include <dlfcn.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+#define DESCRIPTORS_ENV "PINGU_FORKSERVER_FDS"
+#define OUTPUT_DIRECTORY_ENV "PINGU_FORKSERVER_OUTPUT_DIR"
+
+typedef int (*main_function)(int, char **, char **);
+typedef int (*libc_start_main_function)(main_function, int, char **,
+                                        void (*)(void), void (*)(void),
+                                        void (*)(void), void *);
+
+static main_function real_main;
+
+static int write_all(int fd, const void *data, size_t size) {
+  return write(fd, data, size) == (ssize_t)size ? 0 : -1;
+}
+
+static void redirect_output(const char *directory, uint32_t attempt) {
+  char path[4096];
+  snprintf(path, sizeof(path), "%s/attempt-%u.log", directory, attempt);
+  int fd = open(path, O_WRONLY | O_CREAT | O_TRUNC, 0600);
+  if (fd < 0) return;
+  dup2(fd, STDOUT_FILENO);
+  dup2(fd, STDERR_FILENO);
+  close(fd);
+}
+
+static int read_all(int fd, void *data, size_t size) {
+  return read(fd, data, size) == (ssize_t)size ? 0 : -1;
+}
+
+static void run_fork_server(void) {
+  const char *descriptors = getenv(DESCRIPTORS_ENV);
+  const char *output_directory_value = getenv(OUTPUT_DIRECTORY_ENV);
+  int control_fd, status_fd;
+  if (!descriptors || !output_directory_value ||
+      sscanf(descriptors, "%d,%d", &control_fd, &status_fd) != 2)
+    return;  // Not started by the reproduce tool, run normally.
+
+  // Keep processes started by the target from becoming fork servers too.
+  char output_directory[4096];
+  snprintf(output_directory, sizeof(output_directory), "%s",
+           output_directory_value);
+  unsetenv(DESCRIPTORS_ENV);
+  unsetenv(OUTPUT_DIRECTORY_ENV);
+
+  uint32_t hello = 0;
+  if (write_all(status_fd, &hello, sizeof(hello))) return;
+
+  for (;;) {
+    uint32_t attempt;
+    if (read_all(control_fd, &attempt, sizeof(attempt))) _exit(0);
+
+    pid_t child = fork();
+    if (child < 0) _exit(1);
+    if (child == 0) {
+      close(control_fd);
+      close(status_fd);
+      redirect_output(output_directory, attempt);
+      return;
+    }
+
+    int32_t child_pid = child;
+    if (write_all(status_fd, &child_pid, sizeof(child_pid))) _exit(1);
+
+    int status;
+    if (waitpid(child, &status, 0) < 0) _exit(1);
+    int32_t child_status = status;
+    if (write_all(status_fd, &child_status, sizeof(child_status))) _exit(1);
+  }
+}
+
+static int wrapped_main(int argc, char **argv, char **envp) {
+  run_fork_server();
+  return real_main(argc, argv, envp);
+}
+
+int __libc_start_main(main_function main, int argc, char **argv,
+                      void (*init)(void), void (*fini)(void),
+                      void (*rtld_fini)(void), void *stack_end) {
+  libc_start_main_function real_libc_start_main =
+      (libc_start_main_function)dlsym(RTLD_NEXT, "__libc_start_main");
+  real_main = main;
+  return real_libc_start_main(wrapped_main, argc, argv, init, fini, rtld_fini,
+                              stack_end);
+}
@@ -15,6 +15,9 @@
 """HTTP utility functions for the reproduce tool."""
 
 import os
+import random
+import threading
+import time
 import webbrowser
 
 import httplib2
@@ -25,7 +28,11 @@ from pingu_sdk.system import shell
 from local.butler.reproduce_tool import prompts
 
 GET_METHOD = 'GET'
+HEAD_METHOD = 'HEAD'
 POST_METHOD = 'POST'
+# Only these are retried after a failure, as other requests may have had an
+# effect before failing.
+IDEMPOTENT_METHODS = (GET_METHOD, HEAD_METHOD)
 
 CONFIG_DIRECTORY = os.path.join(
     os.path.expanduser('~'), '.config', 'bot')
@@ -33,6 +40,27 @@ CONFIG_DIRECTORY = os.path.join(
 AUTHORIZATION_CACHE_FILE = os.path.join(CONFIG_DIRECTORY, 'authorization-cache')
 AUTHORIZATION_HEADER = 'x-bot-authorization'
 
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+
+_cached_authorization = None
+_thread_local = threading.local()
+# Responses to authorized requests, only ever kept in memory.
+_http_cache = {}
+
+
+class _MemoryCache(object):
+  """httplib2 cache backed by |_http_cache| rather than files."""
+
+  def get(self, key):
+    return _http_cache.get(key)
+
+  def set(self, key, value):
+    _http_cache[key] = value
+
+  def delete(self, key):
+    _http_cache.pop(key, None)
+
 
 class SuppressOutput(object):
   """Suppress stdout and stderr.
@@ -52,12 +80,33 @@ class SuppressOutput(object):
     return True
 
 
+def _read_cached_authorization():
+  """Return the cached authorization, reading the cache file only once."""
+  global _cached_authorization
+  if _cached_authorization is None:
+    _cached_authorization = utils.read_data_from_file(
+        AUTHORIZATION_CACHE_FILE, eval_data=False) or ''
+
+  return _cached_authorization
+
+
+def _write_cached_authorization(authorization):
+  """Update the in-memory and on-disk authorization cache."""
+  global _cached_authorization
+  if authorization == _cached_authorization:
+    return
+
+  _cached_authorization = authorization
+  shell.create_directory(
+      os.path.dirname(AUTHORIZATION_CACHE_FILE), create_intermediates=True)
+  utils.write_data_to_file(authorization, AUTHORIZATION_CACHE_FILE)
+
+
 def _get_authorization(force_reauthorization, configuration):
   """Get the value for an oauth authorization header."""
   # Try to read from cache unless we need to reauthorize.
   if not force_reauthorization:
-    cached_authorization = utils.read_data_from_file(
-        AUTHORIZATION_CACHE_FILE, eval_data=False)
+    cached_authorization = _read_cached_authorization()
     if cached_authorization:
       return cached_authorization
 
@@ -73,40 +122,79 @@ def _get_authorization(force_reauthorization, configuration):
   return 'VerificationCode {code}'.format(code=verification_code)
 
 
+def _get_http():
+  """Return this thread's HTTP client.
+
+  Clients are reused so that connections are kept alive between requests.
+  They negotiate gzip and revalidate cached GET responses with ETag and
+  Last-Modified conditional requests."""
+  http = getattr(_thread_local, 'http', None)
+  if not http:
+    http = httplib2.Http(cache=_MemoryCache())
+    _thread_local.http = http
+
+  return http
+
+
+def _reset_after_fork():
+  """Forked workers must not share the parent's open connections."""
+  global _thread_local
+  _thread_local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _send(url, method, headers, body):
+  """Send a request, retrying server errors and connection failures of
+  idempotent requests with exponential backoff. Other requests are only
+  retried when the connection was refused, as they were never sent then."""
+  http = _get_http()
+  idempotent = method in IDEMPOTENT_METHODS
+  for retry_number in range(MAX_RETRIES + 1):
+    last_retry = retry_number == MAX_RETRIES
+    try:
+      response, content = http.request(
+          url, method=method, headers=headers, body=body)
+      if response.status < 500 or last_retry or not idempotent:
+        return response, content
+    except ConnectionRefusedError:
+      if last_retry:
+        raise
+    except (httplib2.HttpLib2Error, OSError):
+      if last_retry or not idempotent:
+        raise
+
+    delay = RETRY_BACKOFF_SECONDS * (2**retry_number)
+    time.sleep(delay + random.uniform(0, delay))
+
+
 def request(url,
             body=None,
             method=POST_METHOD,
             force_reauthorization=False,
             configuration=None):
   """Make an HTTP request to the specified URL."""
-  if configuration:
-    authorization = _get_authorization(force_reauthorization, configuration)
-    headers = {
-        'User-Agent': 'bot-reproduce',
-        'Authorization': authorization
-    }
-  else:
-    headers = {}
-
-  http = httplib2.Http()
-  request_body = json_utils.dumps(body) if body is not None else ''
-  response, content = http.request(
-      url, method=method, headers=headers, body=request_body)
+  request_body = json_utils.dumps(body) if body is not None else None
 
   # If the server returns 401 we may need to reauthenticate. Try the request
   # a second time if this happens.
-  if response.status == 401 and not force_reauthorization:
-    return request(
-        url,
-        body,
-        method=method,
-        force_reauthorization=True,
-        configuration=configuration)
+  while True:
+    if configuration:
+      authorization = _get_authorization(force_reauthorization, configuration)
+      headers = {
+          'User-Agent': 'bot-reproduce',
+          'Authorization': authorization
+      }
+    else:
+      headers = {}
+
+    response, content = _send(url, method, headers, request_body)
+    if response.status != 401 or force_reauthorization:
+      break
+    force_reauthorization = True
 
   if AUTHORIZATION_HEADER in response:
-    shell.create_directory(
-        os.path.dirname(AUTHORIZATION_CACHE_FILE), create_intermediates=True)
-    utils.write_data_to_file(response[AUTHORIZATION_HEADER],
-                             AUTHORIZATION_CACHE_FILE)
+    _write_cached_authorization(response[AUTHORIZATION_HEADER])
 
   return response, content
@@ -0,0 +1,248 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parallel delta debugging test case minimizer for the reproduce tool."""
+
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from pingu_sdk import testcase_manager
+from pingu_sdk.system import environment
+from pingu_sdk.system import shell
+from local.butler.reproduce_tool import errors
+from local.butler.reproduce_tool import forkserver
+from local.butler.reproduce_tool import parallel
+from local.butler.reproduce_tool import xvfb
+
+# Test cases are reduced line by line first, then byte by byte if they are
+# small enough for that to finish in reasonable time.
+LINES = 'lines'
+BYTES = 'bytes'
+GRANULARITIES = [LINES, BYTES]
+MAX_BYTES_GRANULARITY_SIZE = 16 * 1024
+
+# State shared with forked workers. Set right before the pool is created so
+# that it is inherited rather than pickled.
+_minimize_context = None
+
+# Per worker test case path, display lease and optional fork server, set up
+# on the worker's first candidate.
+_worker_state = None
+
+
+def _tokenize(data, granularity):
+  """Split test case contents into the units that are removed."""
+  if granularity == LINES:
+    return data.splitlines(keepends=True)
+
+  return [data[i:i + 1] for i in range(len(data))]
+
+
+def _split(tokens, count):
+  """Split |tokens| into |count| chunks of nearly equal size."""
+  chunks = []
+  start = 0
+  for index in range(count):
+    end = start + (len(tokens) - start) // (count - index)
+    chunks.append(tokens[start:end])
+    start = end
+
+  return chunks
+
+
+def _get_worker_state():
+  """Give this worker its own copy of the inputs to write candidates to."""
+  global _worker_state
+  if _worker_state:
+    return _worker_state
+
+  testcase_path, scratch_root, use_fork_server = _minimize_context[1:4]
+  inputs_directory = environment.get_value('FUZZ_INPUTS')
+  scratch_directory = os.path.join(scratch_root,
+                                   'worker-{}'.format(os.getpid()))
+  shutil.copytree(inputs_directory, scratch_directory)
+  environment.set_value('FUZZ_INPUTS', scratch_directory)
+  worker_testcase_path = os.path.join(
+      scratch_directory, os.path.relpath(testcase_path, inputs_directory))
+
+  # Workers are terminated rather than shut down, so the lease is held until
+  # the end of the run.
+  display_lease = xvfb.leased_display()
+  display_lease.__enter__()
+
+  fork_server = None
+  if use_fork_server:
+    output_directory = os.path.join(scratch_directory, 'forkserver')
+    os.mkdir(output_directory)
+    fork_server = forkserver.try_start(worker_testcase_path, output_directory)
+
+  _worker_state = (worker_testcase_path, display_lease, fork_server)
+  return _worker_state
+
+
+def _test_candidate(candidate):
+  """Whether |candidate| still reproduces the expected crash."""
+  testcase, _, _, _, timeout, crash, attempts = _minimize_context
+  testcase_path, _, fork_server = _get_worker_state()
+
+  if fork_server:
+    for _ in range(attempts):
+      if forkserver.is_expected_crash(
+          fork_server.run(timeout, testcase_data=candidate), crash):
+        return True
+    return False
+
+  with open(testcase_path, 'wb') as f:
+    f.write(candidate)
+  result = testcase_manager.test_for_crash_with_retries(
+      testcase, testcase_path, timeout, crash, crash_retries=attempts)
+  return forkserver.is_expected_crash(result, crash)
+
+
+class Minimizer(object):
+  """Delta debugging (ddmin) that tests the candidates of each step
+  concurrently and never tests the same contents twice."""
+
+  def __init__(self, pool, batch_size):
+    self._pool = pool
+    self._batch_size = batch_size
+    self._tested = {}
+    self.tests = 0
+    self.cache_hits = 0
+
+  def _run_batch(self, batch):
+    """Test a batch of (index, key, data) candidates at once. Returns the
+    index of the smallest one that reproduces, or None."""
+    results = self._pool.map(_test_candidate, [data for _, _, data in batch])
+    self.tests += len(batch)
+
+    reproducing = None
+    for (index, key, data), reproduces in zip(batch, results):
+      self._tested[key] = reproduces
+      if reproduces and (not reproducing or len(data) < reproducing[1]):
+        reproducing = (index, len(data))
+
+    return reproducing[0] if reproducing else None
+
+  def find_reproducing(self, candidates):
+    """Return the index of a candidate that reproduces the crash, or None.
+
+    Candidates are tested in order, |batch_size| untested ones at a time, so
+    that work stops shortly after the first reduction is found."""
+    batch = []
+    batch_keys = set()
+    for index, tokens in enumerate(candidates):
+      data = b''.join(tokens)
+      key = hashlib.sha256(data).digest()
+      if key in self._tested:
+        self.cache_hits += 1
+        if self._tested[key]:
+          return index
+        continue
+
+      if key in batch_keys:
+        self.cache_hits += 1
+        continue
+
+      batch.append((index, key, data))
+      batch_keys.add(key)
+      if len(batch) == self._batch_size:
+        reproducing = self._run_batch(batch)
+        if reproducing is not None:
+          return reproducing
+        batch = []
+        batch_keys = set()
+
+    if batch:
+      return self._run_batch(batch)
+
+    return None
+
+  def _ddmin(self, tokens):
+    """Reduce |tokens| to a 1-minimal list that still reproduces."""
+    granularity = 2
+    while len(tokens) >= 2:
+      chunks = _split(tokens, granularity)
+      candidates = list(chunks)
+      if granularity > 2:
+        candidates.extend(
+            sum(chunks[:index] + chunks[index + 1:], [])
+            for index in range(granularity))
+
+      index = self.find_reproducing(candidates)
+      if index is None:
+        if granularity >= len(tokens):
+          break
+        granularity = min(len(tokens), granularity * 2)
+        continue
+
+      tokens = candidates[index]
+      if index < len(chunks):
+        granularity = 2
+      else:
+        granularity = max(granularity - 1, 2)
+      print('Reduced to {size} bytes.'.format(size=len(b''.join(tokens))))
+
+    return tokens
+
+  def minimize(self, data):
+    """Return the smallest contents found that still reproduce."""
+    if self.find_reproducing([[data]]) is None:
+      raise errors.ReproduceToolUnrecoverableError(
+          'The test case does not reproduce the expected crash.')
+
+    for granularity in GRANULARITIES:
+      if granularity == BYTES and len(data) > MAX_BYTES_GRANULARITY_SIZE:
+        continue
+
+      print('Minimizing {size} bytes by {granularity}...'.format(
+          size=len(data), granularity=granularity))
+      data = b''.join(self._ddmin(_tokenize(data, granularity)))
+
+    return data
+
+
+def run(testcase, testcase_path, timeout, crash, workers, attempts=1,
+        use_fork_server=False):
+  """Minimize the test case at |testcase_path| across |workers| processes.
+
+  Each candidate is tried up to |attempts| times. Returns the minimized
+  contents and the Minimizer for its statistics."""
+  global _minimize_context
+
+  with open(testcase_path, 'rb') as f:
+    data = f.read()
+
+  # Keep the scratch copies on the same storage as the inputs, which may be
+  # memory backed.
+  scratch_root = tempfile.mkdtemp(
+      prefix='minimize-',
+      dir=os.path.dirname(environment.get_value('FUZZ_INPUTS')))
+  _minimize_context = (testcase, testcase_path, scratch_root, use_fork_server,
+                       timeout, crash, attempts)
+
+  pool = multiprocessing.get_context('fork').Pool(
+      workers, initializer=parallel.initialize_worker)
+  minimizer = Minimizer(pool, workers)
+  try:
+    data = minimizer.minimize(data)
+  finally:
+    parallel.terminate_pool(pool)
+    _minimize_context = None
+    shell.remove_directory(scratch_root)
+
+  return data, minimizer
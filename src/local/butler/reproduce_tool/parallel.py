@@ -0,0 +1,266 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parallel reproduction attempts for the reproduce tool."""
+
+import math
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+
+from pingu_sdk import testcase_manager
+from pingu_sdk.system import environment
+from pingu_sdk.system import shell
+from local.butler import profiler
+from local.butler.reproduce_tool import android
+from local.butler.reproduce_tool import forkserver
+from local.butler.reproduce_tool import xvfb
+
+# z-score for a two-sided 95% confidence interval.
+CONFIDENCE_Z = 1.96
+
+# When estimating reproducibility, stop once the confidence interval is at
+# most this wide, but never before a minimum number of attempts.
+ESTIMATE_INTERVAL_WIDTH = 0.2
+MIN_ESTIMATE_ATTEMPTS = 10
+
+# State shared with forked workers. Set right before the pool is created so
+# that it is inherited rather than pickled.
+_attempt_context = None
+
+# Fork server owned by a worker for its whole life, or False if the target
+# could not run under one. Only used in fork server mode.
+_worker_fork_server = None
+_worker_display_lease = None
+
+
+class ReproducibilityEstimate(object):
+  """Running estimate of how often a test case reproduces."""
+
+  def __init__(self):
+    self.attempts = 0
+    self.crashes = 0
+    self.devices = {}
+
+  def add(self, is_crash, device=None):
+    """Record the outcome of a single attempt, optionally made on a specific
+    device."""
+    self.attempts += 1
+    if is_crash:
+      self.crashes += 1
+
+    if device:
+      device_estimate = self.devices.setdefault(device,
+                                                ReproducibilityEstimate())
+      device_estimate.add(is_crash)
+
+  @property
+  def rate(self):
+    """Observed reproducibility rate."""
+    if not self.attempts:
+      return 0.0
+
+    return self.crashes / self.attempts
+
+  def interval(self):
+    """Return the Wilson score interval for the reproducibility rate."""
+    if not self.attempts:
+      return 0.0, 1.0
+
+    n = self.attempts
+    p = self.rate
+    z2 = CONFIDENCE_Z * CONFIDENCE_Z
+    denominator = 1 + z2 / n
+    center = (p + z2 / (2 * n)) / denominator
+    half_width = CONFIDENCE_Z * math.sqrt(p * (1 - p) / n + z2 /
+                                          (4 * n * n)) / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+  def is_precise(self):
+    """Whether enough attempts were made to stop estimating."""
+    if self.attempts < MIN_ESTIMATE_ATTEMPTS:
+      return False
+
+    lower, upper = self.interval()
+    return upper - lower <= ESTIMATE_INTERVAL_WIDTH
+
+  def __str__(self):
+    lower, upper = self.interval()
+    summary = ('{crashes}/{attempts} attempts crashed ({rate:.0%}, 95% CI '
+               '{lower:.0%}-{upper:.0%})').format(
+                   crashes=self.crashes,
+                   attempts=self.attempts,
+                   rate=self.rate,
+                   lower=lower,
+                   upper=upper)
+    for device, device_estimate in sorted(self.devices.items()):
+      summary += '\n  {device}: {crashes}/{attempts} attempts crashed'.format(
+          device=device,
+          crashes=device_estimate.crashes,
+          attempts=device_estimate.attempts)
+
+    return summary
+
+
+def initialize_worker():
+  """Make each worker a process group leader so that the targets it starts
+  can be killed along with it."""
+  os.setpgrp()
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _get_worker_fork_server(testcase_path, scratch_root):
+  """Start this worker's fork server on its first attempt.
+
+  The server runs on a private copy of the inputs and keeps a display leased
+  for as long as the worker lives, since both are fixed when the target
+  starts."""
+  global _worker_fork_server, _worker_display_lease
+  if _worker_fork_server is not None:
+    return _worker_fork_server
+
+  inputs_directory = environment.get_value('FUZZ_INPUTS')
+  scratch_directory = os.path.join(scratch_root,
+                                   'worker-{}'.format(os.getpid()))
+  shutil.copytree(inputs_directory, scratch_directory)
+  environment.set_value('FUZZ_INPUTS', scratch_directory)
+  worker_testcase_path = os.path.join(
+      scratch_directory, os.path.relpath(testcase_path, inputs_directory))
+
+  output_directory = os.path.join(scratch_directory, 'forkserver')
+  os.mkdir(output_directory)
+
+  # Workers are terminated rather than shut down, so the lease is held until
+  # the end of the run.
+  _worker_display_lease = xvfb.leased_display()
+  _worker_display_lease.__enter__()
+  _worker_fork_server = forkserver.try_start(worker_testcase_path,
+                                             output_directory)
+  if not _worker_fork_server:
+    # Fall back to regular attempts, which lease a display each time.
+    _worker_display_lease.__exit__(None, None, None)
+    environment.set_value('FUZZ_INPUTS', inputs_directory)
+    _worker_fork_server = False
+
+  return _worker_fork_server
+
+
+def _run_attempt(attempt_number):
+  """Run a single attempt in its own scratch copy of the inputs directory, or
+  through the worker's fork server in fork server mode."""
+  (testcase, testcase_path, timeout, crash, scratch_root, use_fork_server,
+   compare_crash) = _attempt_context
+
+  if use_fork_server:
+    fork_server = _get_worker_fork_server(testcase_path, scratch_root)
+    if fork_server:
+      with profiler.span('testcase.run', 'execution'):
+        return None, fork_server.test_for_crash_with_retries(
+            crash, timeout, crash_retries=1, compare_crash=compare_crash)
+
+  inputs_directory = environment.get_value('FUZZ_INPUTS')
+  scratch_directory = os.path.join(scratch_root,
+                                   'attempt-{}'.format(attempt_number))
+  with profiler.span('copy.inputs', 'io'):
+    shutil.copytree(inputs_directory, scratch_directory)
+  attempt_testcase_path = os.path.join(
+      scratch_directory, os.path.relpath(testcase_path, inputs_directory))
+
+  environment.set_value('FUZZ_INPUTS', scratch_directory)
+  try:
+    with xvfb.leased_display(), android.leased_device() as device:
+      with profiler.span('testcase.run', 'execution'):
+        result = testcase_manager.test_for_crash_with_retries(
+            testcase,
+            attempt_testcase_path,
+            timeout,
+            crash,
+            compare_crash=compare_crash,
+            crash_retries=1)
+  finally:
+    environment.set_value('FUZZ_INPUTS', inputs_directory)
+    shell.remove_directory(scratch_directory)
+
+  return device, result
+
+
+def terminate_pool(pool):
+  """Stop all workers and any target processes they are still running."""
+  for child in multiprocessing.active_children():
+    try:
+      os.killpg(child.pid, signal.SIGKILL)
+    except OSError:
+      pass
+
+  pool.terminate()
+  pool.join()
+  # Killed workers never released their leases.
+  xvfb.reset_display_pool()
+  android.reset_device_pool()
+
+
+def run_attempts(testcase,
+                 testcase_path,
+                 timeout,
+                 crash,
+                 max_attempts,
+                 jobs,
+                 estimate_reproducibility=False,
+                 use_fork_server=False,
+                 compare_crash=True):
+  """Run up to |max_attempts| attempts across |jobs| workers.
+
+  Stops at the first attempt that reproduces the expected crash, or any crash
+  without |compare_crash|, unless |estimate_reproducibility| is set, in which
+  case attempts continue until the reproducibility estimate is precise enough.
+  With |use_fork_server|, each worker runs its attempts through its own fork
+  server. Returns a tuple of the most relevant result and the
+  ReproducibilityEstimate."""
+  global _attempt_context
+
+  # Keep the scratch copies on the same storage as the inputs, which may be
+  # memory backed.
+  scratch_root = tempfile.mkdtemp(
+      prefix='attempts-',
+      dir=os.path.dirname(environment.get_value('FUZZ_INPUTS')))
+  _attempt_context = (testcase, testcase_path, timeout, crash, scratch_root,
+                      use_fork_server, compare_crash)
+
+  estimate = ReproducibilityEstimate()
+  crash_result = None
+  last_result = None
+  pool = multiprocessing.get_context('fork').Pool(
+      jobs, initializer=initialize_worker)
+  try:
+    for device, result in pool.imap_unordered(_run_attempt,
+                                              range(max_attempts)):
+      estimate.add(result.is_crash(), device)
+      if result.is_crash():
+        crash_result = crash_result or result
+      else:
+        last_result = result
+
+      if estimate_reproducibility:
+        if estimate.is_precise():
+          break
+      elif crash_result:
+        break
+  finally:
+    terminate_pool(pool)
+    _attempt_context = None
+    shell.remove_directory(scratch_root)
+
+  return crash_result or last_result, estimate
@@ -0,0 +1,306 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cached stack trace symbolization for the reproduce tool."""
+
+import atexit
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import subprocess
+import threading
+import time
+
+from pingu_sdk.system import environment
+
+CONFIG_DIRECTORY = os.path.join(
+    os.path.expanduser('~'), '.config', 'bot')
+CACHE_PATH = os.path.join(CONFIG_DIRECTORY, 'symbolization-cache.sqlite')
+MAX_CACHE_ENTRIES = 1000000
+
+# Unsymbolized sanitizer frame, e.g.
+#   #3 0x55d1c2 (/out/fuzzer+0x4f1c3a) (BuildId: 4e2a...)
+FRAME_REGEX = re.compile(r'^(?P<prefix>\s*#(?P<number>\d+)\s+'
+                         r'(?P<address>0x[0-9a-fA-F]+))\s+'
+                         r'\((?P<module>[^()]+?)\+(?P<offset>0x[0-9a-fA-F]+)\)'
+                         r'(?:\s+\(BuildId: (?P<build_id>[0-9a-fA-F]+)\))?\s*$')
+
+ELF_MAGIC = b'\x7fELF'
+NT_GNU_BUILD_ID = 3
+SHT_NOTE = 7
+
+_symbolizer = None
+
+
+def _read_elf_build_id(path):
+  """Return the GNU build ID of an ELF file, or None."""
+  with open(path, 'rb') as f:
+    header = f.read(64)
+    if len(header) < 52 or header[:4] != ELF_MAGIC:
+      return None
+
+    is_64_bit = header[4] == 2
+    endian = '<' if header[5] == 1 else '>'
+    if is_64_bit:
+      section_offset, = struct.unpack_from(endian + 'Q', header, 0x28)
+      section_size, section_count = struct.unpack_from(endian + 'HH', header,
+                                                       0x3A)
+    else:
+      section_offset, = struct.unpack_from(endian + 'I', header, 0x20)
+      section_size, section_count = struct.unpack_from(endian + 'HH', header,
+                                                       0x2E)
+
+    for index in range(section_count):
+      f.seek(section_offset + index * section_size)
+      section = f.read(section_size)
+      section_type, = struct.unpack_from(endian + 'I', section, 4)
+      if section_type != SHT_NOTE:
+        continue
+
+      if is_64_bit:
+        offset, size = struct.unpack_from(endian + 'QQ', section, 0x18)
+      else:
+        offset, size = struct.unpack_from(endian + 'II', section, 0x10)
+
+      f.seek(offset)
+      notes = f.read(size)
+      position = 0
+      while position + 12 <= len(notes):
+        name_size, description_size, note_type = struct.unpack_from(
+            endian + 'III', notes, position)
+        position += 12
+        name = notes[position:position + name_size]
+        position += (name_size + 3) & ~3
+        description = notes[position:position + description_size]
+        position += (description_size + 3) & ~3
+        if note_type == NT_GNU_BUILD_ID and name.rstrip(b'\0') == b'GNU':
+          return description.hex()
+
+  return None
+
+
+def _get_file_hash(path):
+  """Return the SHA-256 of a file."""
+  sha256 = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      sha256.update(chunk)
+
+  return sha256.hexdigest()
+
+
+class SymbolizationCache(object):
+  """Persistent cache of symbolized frames keyed by (build ID or binary hash,
+  module offset), with least recently used eviction."""
+
+  def __init__(self, path=CACHE_PATH, max_entries=MAX_CACHE_ENTRIES):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    self._max_entries = max_entries
+    self._connection = sqlite3.connect(path, check_same_thread=False)
+    self._connection.execute(
+        'CREATE TABLE IF NOT EXISTS frames (module_id TEXT, offset TEXT, '
+        'symbolized TEXT, last_used REAL, PRIMARY KEY (module_id, offset))')
+    self._connection.execute(
+        'CREATE INDEX IF NOT EXISTS frames_last_used ON frames (last_used)')
+    self._lock = threading.Lock()
+
+  def get(self, module_id, offset):
+    with self._lock:
+      row = self._connection.execute(
+          'SELECT symbolized FROM frames WHERE module_id = ? AND offset = ?',
+          (module_id, offset)).fetchone()
+      if not row:
+        return None
+
+      self._connection.execute(
+          'UPDATE frames SET last_used = ? WHERE module_id = ? AND offset = ?',
+          (time.time(), module_id, offset))
+      return row[0]
+
+  def put(self, module_id, offset, symbolized):
+    with self._lock:
+      self._connection.execute(
+          'INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?)',
+          (module_id, offset, symbolized, time.time()))
+
+  def commit(self):
+    """Persist pending changes and evict the least recently used entries
+    above the size bound."""
+    with self._lock:
+      count, = self._connection.execute('SELECT COUNT(*) FROM frames').fetchone()
+      if count > self._max_entries:
+        self._connection.execute(
+            'DELETE FROM frames WHERE rowid IN (SELECT rowid FROM frames '
+            'ORDER BY last_used LIMIT ?)', (count - self._max_entries,))
+      self._connection.commit()
+
+  def close(self):
+    self.commit()
+    self._connection.close()
+
+
+class Symbolizer(object):
+  """llvm-symbolizer kept running in batch mode, backed by a cache."""
+
+  def __init__(self, symbolizer_path, cache):
+    self._symbolizer_path = symbolizer_path
+    self._cache = cache
+    self._process = None
+    self._module_ids = {}
+
+  def _get_module_id(self, module_path, build_id=None):
+    """Identify a module by its build ID, or by its content hash if it has
+    none. Lookups are memoized per path, size and modification time."""
+    if build_id:
+      return build_id
+
+    try:
+      stat = os.stat(module_path)
+    except OSError:
+      return None
+
+    key = (module_path, stat.st_size, stat.st_mtime)
+    if key not in self._module_ids:
+      self._module_ids[key] = (
+          _read_elf_build_id(module_path) or _get_file_hash(module_path))
+
+    return self._module_ids[key]
+
+  def _ensure_process(self):
+    if self._process and self._process.poll() is None:
+      return
+
+    self._process = subprocess.Popen(
+        [
+            self._symbolizer_path, '--inlining', '--demangle',
+            '--functions=linkage'
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+        bufsize=1)
+
+  def _symbolize_with_process(self, module_path, offset):
+    """Ask the warm llvm-symbolizer for (function, location) pairs of a
+    module offset, innermost inlined frame first."""
+    self._ensure_process()
+    self._process.stdin.write('"{module}" {offset}\n'.format(
+        module=module_path, offset=offset))
+    self._process.stdin.flush()
+
+    lines = []
+    while True:
+      line = self._process.stdout.readline()
+      if not line or not line.strip():
+        break
+      lines.append(line.strip())
+
+    return [(lines[i], lines[i + 1]) for i in range(0, len(lines) - 1, 2)]
+
+  def symbolize_frame(self, match):
+    """Return symbolized lines for a frame, or None if unknown."""
+    module_path = match.group('module')
+    offset = match.group('offset')
+    module_id = self._get_module_id(module_path, match.group('build_id'))
+    if not module_id:
+      return None
+
+    symbolized = self._cache.get(module_id, offset)
+    if symbolized is None:
+      frames = self._symbolize_with_process(module_path, offset)
+      if not frames or frames[0][0] == '??':
+        return None
+
+      symbolized = '\n'.join(
+          '{function} {location}'.format(function=function, location=location)
+          for function, location in frames)
+      self._cache.put(module_id, offset, symbolized)
+
+    prefix = match.group('prefix')
+    return [
+        '{prefix} in {frame}'.format(prefix=prefix, frame=frame)
+        for frame in symbolized.splitlines()
+    ]
+
+  def symbolize_stacktrace(self, stacktrace):
+    """Symbolize all unsymbolized sanitizer frames of a stack trace. Returns
+    None if any frame could not be symbolized."""
+    symbolized_lines = []
+    complete = True
+    for line in stacktrace.splitlines():
+      match = FRAME_REGEX.match(line)
+      frames = self.symbolize_frame(match) if match else None
+      if match and not frames:
+        complete = False
+      symbolized_lines.extend(frames or [line])
+
+    self._cache.commit()
+    if not complete:
+      return None
+
+    return '\n'.join(symbolized_lines)
+
+  def close(self):
+    if self._process:
+      self._process.stdin.close()
+      self._process.wait()
+      self._process = None
+    self._cache.close()
+
+
+def _get_symbolizer_path():
+  """Return the llvm-symbolizer to use, if any."""
+  symbolizer_path = environment.get_llvm_symbolizer_path()
+  if symbolizer_path and os.path.exists(symbolizer_path):
+    return symbolizer_path
+
+  return shutil.which('llvm-symbolizer')
+
+
+def get_symbolizer():
+  """Return the shared symbolizer, starting it on first use. Returns None if
+  llvm-symbolizer is not available."""
+  global _symbolizer
+  if _symbolizer:
+    return _symbolizer
+
+  symbolizer_path = _get_symbolizer_path()
+  if not symbolizer_path:
+    return None
+
+  _symbolizer = Symbolizer(symbolizer_path, SymbolizationCache())
+  atexit.register(_close_symbolizer)
+  return _symbolizer
+
+
+def _close_symbolizer():
+  global _symbolizer
+  if _symbolizer:
+    _symbolizer.close()
+    _symbolizer = None
+
+
+def symbolize_stacktrace(stacktrace):
+  """Symbolize a stack trace through the cache. Returns None if no symbolizer
+  is available or a frame could not be symbolized, so that callers fall back
+  to the full symbolization of the result."""
+  symbolizer = get_symbolizer()
+  if not symbolizer:
+    return None
+
+  return symbolizer.symbolize_stacktrace(stacktrace)
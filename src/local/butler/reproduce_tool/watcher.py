@@ -0,0 +1,272 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Build directory watching for the reproduce tool's watch mode."""
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import os
+import select
+import struct
+import time
+
+# Wait for the build to be quiet for this long before re-running, so that a
+# rebuild writing many files triggers a single run.
+DEBOUNCE_SECONDS = 2
+POLL_INTERVAL_SECONDS = 1
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+ROOT_LOST_MASK = IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED
+INOTIFY_EVENT = struct.Struct('iIII')
+READ_BUFFER_SIZE = 64 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class _InotifyWatcher(object):
+  """Recursive inotify watch of a directory tree. A rebuild may replace the
+  whole tree, in which case it is watched again once it is back."""
+
+  def __init__(self, directory):
+    self._directory = directory
+    self._root_watch = None
+    self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self._fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    self._add_watches()
+
+  def _add_watches(self):
+    """Watch every directory of the tree. Watching an already watched
+    directory again is a no-op. Raises OSError with ENOSPC once the
+    max_user_watches limit is reached."""
+    for root, _, _ in os.walk(self._directory):
+      watch = self._libc.inotify_add_watch(self._fd, os.fsencode(root),
+                                           WATCH_MASK)
+      if watch < 0:
+        error = ctypes.get_errno()
+        # Directories that a rebuild removed meanwhile.
+        if error in (errno.ENOENT, errno.ENOTDIR):
+          continue
+        raise OSError(error, 'inotify_add_watch failed')
+
+      if root == self._directory:
+        self._root_watch = watch
+
+  def _read_events(self):
+    """Consume pending events, watching directories created meanwhile."""
+    new_directories = False
+    while True:
+      try:
+        data = os.read(self._fd, READ_BUFFER_SIZE)
+      except BlockingIOError:
+        break
+
+      offset = 0
+      while offset < len(data):
+        watch, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+        offset += INOTIFY_EVENT.size + name_length
+        if watch == self._root_watch and mask & ROOT_LOST_MASK:
+          self._root_watch = None
+        if mask & IN_Q_OVERFLOW or (mask & IN_ISDIR and
+                                    mask & (IN_CREATE | IN_MOVED_TO)):
+          new_directories = True
+
+    if new_directories and self._root_watch is not None:
+      self._add_watches()
+
+  def _wait_for_root(self, timeout):
+    """Poll for the tree to be back after it was removed, then watch it
+    again. Counts as a change, since the rebuild is still going on."""
+    interval = POLL_INTERVAL_SECONDS
+    if timeout is not None:
+      interval = min(interval, timeout)
+    time.sleep(interval)
+
+    if os.path.isdir(self._directory):
+      self._add_watches()
+    return True
+
+  def wait(self, timeout):
+    """Wait up to |timeout| seconds (forever if None) for changes. Returns
+    whether anything changed."""
+    if self._root_watch is None:
+      return self._wait_for_root(timeout)
+
+    readable, _, _ = select.select([self._fd], [], [], timeout)
+    if not readable:
+      return False
+
+    self._read_events()
+    return True
+
+  def close(self):
+    os.close(self._fd)
+
+
+class _PollingWatcher(object):
+  """Fallback watcher comparing file sizes and modification times."""
+
+  def __init__(self, directory):
+    self._directory = directory
+    self._snapshot = self._take_snapshot()
+
+  def _take_snapshot(self):
+    snapshot = {}
+    for root, _, files in os.walk(self._directory):
+      for name in files:
+        path = os.path.join(root, name)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+
+    return snapshot
+
+  def wait(self, timeout):
+    deadline = None if timeout is None else time.time() + timeout
+    while deadline is None or time.time() < deadline:
+      interval = POLL_INTERVAL_SECONDS
+      if deadline is not None:
+        interval = min(interval, max(0, deadline - time.time()))
+      time.sleep(interval)
+
+      snapshot = self._take_snapshot()
+      if snapshot != self._snapshot:
+        self._snapshot = snapshot
+        return True
+
+    return False
+
+  def close(self):
+    pass
+
+
+class _BuildFingerprint(object):
+  """Content hash of a build, rehashing only files whose size or
+  modification time changed since the last update."""
+
+  def __init__(self, directory):
+    self._directory = directory
+    self._files = {}
+
+  def _hash_file(self, path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+  def update(self):
+    """Return the current fingerprint and the number of files that changed."""
+    files = {}
+    changed = 0
+    for root, _, names in os.walk(self._directory):
+      for name in names:
+        path = os.path.join(root, name)
+        try:
+          stat = os.stat(path)
+          key = (stat.st_size, stat.st_mtime_ns)
+          previous = self._files.get(path)
+          if previous and previous[0] == key:
+            files[path] = previous
+            continue
+
+          files[path] = (key, self._hash_file(path))
+        except OSError:
+          # Removed or unreadable mid-build, the next update will see it.
+          continue
+
+        if not previous or previous[1] != files[path][1]:
+          changed += 1
+
+    changed += len(set(self._files) - set(files))
+    self._files = files
+
+    digest = hashlib.sha256()
+    for path in sorted(files):
+      digest.update(os.path.relpath(path, self._directory).encode('utf-8'))
+      digest.update(files[path][1].encode('utf-8'))
+    return digest.hexdigest(), changed
+
+
+class BuildWatcher(object):
+  """Watches a build directory for rebuilds."""
+
+  def __init__(self, directory, debounce_seconds=DEBOUNCE_SECONDS):
+    self._directory = directory
+    self._debounce_seconds = debounce_seconds
+    try:
+      self._watcher = _InotifyWatcher(directory)
+    except (AttributeError, OSError) as e:
+      print('Unable to use inotify ({error}), polling for changes '
+            'instead.'.format(error=e))
+      self._watcher = _PollingWatcher(directory)
+
+    self._fingerprint = _BuildFingerprint(directory)
+    self._last_fingerprint, _ = self._fingerprint.update()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def _wait(self, timeout):
+    """Wait for a change, switching to polling if inotify fails, e.g. with
+    ENOSPC once a growing build reaches max_user_watches."""
+    try:
+      return self._watcher.wait(timeout)
+    except OSError as e:
+      print('Unable to keep watching with inotify ({error}), polling for '
+            'changes instead.'.format(error=e))
+      self._watcher.close()
+      self._watcher = _PollingWatcher(self._directory)
+      return True
+
+  def wait_for_change(self):
+    """Block until the build is quiet after a change to its contents. Returns
+    the number of files that changed."""
+    while True:
+      self._wait(None)
+      while self._wait(self._debounce_seconds):
+        pass
+
+      fingerprint, changed = self._fingerprint.update()
+      if fingerprint != self._last_fingerprint:
+        self._last_fingerprint = fingerprint
+        return changed
+
+      print('Build contents are unchanged, not re-running.')
+
+  def close(self):
+    self._watcher.close()
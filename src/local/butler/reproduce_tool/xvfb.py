@@ -0,0 +1,196 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Virtual display management for the reproduce tool."""
+
+import atexit
+import contextlib
+import multiprocessing
+import os
+import socket
+import time
+
+from pingu_sdk.system import environment
+from pingu_sdk.system import new_process
+from local.butler.reproduce_tool import errors
+
+BLACKBOX_PATH = '/usr/bin/blackbox'
+XVFB_PATH = '/usr/bin/Xvfb'
+X11_SOCKET_DIRECTORY = '/tmp/.X11-unix'
+X11_LOCK_FILE_PATTERN = '/tmp/.X{number}-lock'
+
+FIRST_DISPLAY_NUMBER = 99
+DISPLAY_READY_TIMEOUT = 10
+READY_POLL_INTERVAL = 0.05
+SCREEN_GEOMETRY = '1280x1024x24'
+
+# Pool of displays shared by this process and the workers it forks.
+_display_pool = None
+
+
+def _get_socket_path(display_number):
+  return os.path.join(X11_SOCKET_DIRECTORY, 'X{}'.format(display_number))
+
+
+def _is_display_in_use(display_number):
+  """Whether another X server already owns a display number."""
+  return (os.path.exists(_get_socket_path(display_number)) or
+          os.path.exists(X11_LOCK_FILE_PATTERN.format(number=display_number)))
+
+
+def _is_display_ready(display_number):
+  """Whether the X server accepts connections on its socket."""
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(_get_socket_path(display_number))
+    return True
+  except OSError:
+    return False
+  finally:
+    sock.close()
+
+
+class VirtualDisplay(object):
+  """An Xvfb display with a blackbox window manager."""
+
+  def __init__(self, display_number):
+    self.display_number = display_number
+    self.name = ':{}'.format(display_number)
+    self._processes = []
+
+  def start(self):
+    """Start Xvfb. Call wait_until_ready before using the display."""
+    xvfb_runner = new_process.ProcessRunner(XVFB_PATH)
+    self._processes.append(
+        xvfb_runner.run(additional_args=[
+            self.name, '-screen', '0', SCREEN_GEOMETRY, '-ac', '-nolisten',
+            'tcp'
+        ]))
+
+  def wait_until_ready(self):
+    """Block until Xvfb accepts connections, then start the window manager."""
+    xvfb_process = self._processes[0]
+    deadline = time.time() + DISPLAY_READY_TIMEOUT
+    while not _is_display_ready(self.display_number):
+      if xvfb_process.poll() is not None:
+        raise errors.ReproduceToolUnrecoverableError(
+            'Xvfb exited before display {name} was ready.'.format(
+                name=self.name))
+      if time.time() > deadline:
+        raise errors.ReproduceToolUnrecoverableError(
+            'Display {name} was not ready after {timeout} seconds.'.format(
+                name=self.name, timeout=DISPLAY_READY_TIMEOUT))
+      time.sleep(READY_POLL_INTERVAL)
+
+    blackbox_runner = new_process.ProcessRunner(BLACKBOX_PATH)
+    self._processes.append(
+        blackbox_runner.run(extra_env={'DISPLAY': self.name}))
+
+  def stop(self):
+    """Terminate the window manager and Xvfb."""
+    for process in reversed(self._processes):
+      process.terminate()
+    self._processes = []
+
+
+class DisplayPool(object):
+  """Pre-started virtual displays that are leased one at a time."""
+
+  def __init__(self, size):
+    self._displays = []
+    self._available = multiprocessing.get_context('fork').Queue()
+
+    display_number = FIRST_DISPLAY_NUMBER
+    while len(self._displays) < size:
+      if not _is_display_in_use(display_number):
+        self._displays.append(VirtualDisplay(display_number))
+      display_number += 1
+
+  def start(self):
+    """Start all displays at once and wait for each of them to be ready."""
+    try:
+      for display in self._displays:
+        display.start()
+      for display in self._displays:
+        display.wait_until_ready()
+    except Exception:
+      self.stop()
+      raise
+
+    self.reset()
+
+  def reset(self):
+    """Make every display available again. Workers that were killed while
+    holding a lease never return it and may leave the queue locked, so the
+    queue is replaced. Only call this once no worker is left."""
+    self._available = multiprocessing.get_context('fork').Queue()
+    for display in self._displays:
+      self._available.put(display.name)
+
+  def stop(self):
+    for display in self._displays:
+      display.stop()
+
+  @contextlib.contextmanager
+  def lease(self):
+    """Lease a display and point DISPLAY at it until it is released."""
+    name = self._available.get()
+    previous_name = environment.get_value('DISPLAY')
+    environment.set_value('DISPLAY', name)
+    try:
+      yield name
+    finally:
+      if previous_name:
+        environment.set_value('DISPLAY', previous_name)
+      else:
+        environment.remove_key('DISPLAY')
+      self._available.put(name)
+
+
+def start_display_pool(size):
+  """Start the shared display pool. Workers forked afterwards lease from it."""
+  global _display_pool
+  stop_display_pool()
+
+  print('Creating {count} virtual display(s)...'.format(count=size))
+  pool = DisplayPool(size)
+  pool.start()
+  _display_pool = pool
+  atexit.register(stop_display_pool)
+
+
+def stop_display_pool():
+  """Stop the shared display pool, if any. Safe to call more than once."""
+  global _display_pool
+  if _display_pool:
+    _display_pool.stop()
+    _display_pool = None
+
+
+def reset_display_pool():
+  """Reclaim the displays leased by workers that were killed."""
+  if _display_pool:
+    _display_pool.reset()
+
+
+@contextlib.contextmanager
+def leased_display():
+  """Lease a display from the shared pool, or do nothing if no pool is
+  running (e.g. Xvfb is disabled or not needed)."""
+  if not _display_pool:
+    yield None
+    return
+
+  with _display_pool.lease() as name:
+    yield name
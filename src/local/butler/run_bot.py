@@ -12,17 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""run_bot.py run a PinguCrew bot locally."""
+"""run_bot.py run PinguCrew bots locally."""
+import compileall
+import hashlib
 import os
 import shlex
+import shutil
 import signal
+import stat
 import sys
+import tempfile
+from local.butler import bot_logs
 from local.butler import common
 from local.butler import constants
+from local.butler import profiler
+from local.butler import supervisor
 from src.local.butler import appengine
 
 _fuzzBot_handle = None
 
+SNAPSHOTS_DIRECTORY = 'snapshots'
+BOTS_DIRECTORY = 'bots'
+
 
 def _setup_bot_directory(args):
     """Set up the bot directory."""
@@ -70,11 +81,182 @@ def _setup_bot_directory(args):
         os.path.join(working_directory))
 
 
-def _setup_environment_and_configs(args):
-    """Set up environment variables and configuration files."""
-    bot_dir = os.path.abspath(os.path.join(args.directory, 'working_directory'))
+def get_bot_sources(src_root_dir):
+    """Return the source directories of a bot, with their paths relative to
+    the bot's root."""
+    return [
+        (os.path.join(src_root_dir, 'src', 'bot'), os.path.join('src', 'bot')),
+        (os.path.join(src_root_dir, 'src', 'bot', 'startup'),
+         os.path.join('src', 'startup')),
+        (os.path.join(src_root_dir, 'config'), 'config'),
+        (os.path.join(src_root_dir, 'third_party'), 'third_party'),
+        (os.path.join(src_root_dir, 'resources'), 'resources'),
+    ]
+
+
+def _get_sources_digest(sources):
+    """Hash the paths, sizes and modification times of the sources."""
+    digest = hashlib.sha256()
+    for source, destination in sources:
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                file_stat = os.stat(path)
+                digest.update('{}\0{}\0{}\0{}\n'.format(
+                    destination, os.path.relpath(path, source),
+                    file_stat.st_size, file_stat.st_mtime_ns).encode('utf-8'))
+
+    return digest.hexdigest()[:16]
+
+
+def _make_read_only(directory):
+    """Remove write permissions from everything under |directory|."""
+    write_bits = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+    for root, dirs, files in os.walk(directory, topdown=False):
+        for name in files + dirs:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                os.chmod(path, os.stat(path).st_mode & ~write_bits)
+
+    os.chmod(directory, os.stat(directory).st_mode & ~write_bits)
+
+
+def _remove_read_only(directory):
+    """Restore the owner's write permission under |directory|, then remove
+    it."""
+    for root, dirs, _ in os.walk(directory):
+        for name in dirs:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                os.chmod(path, os.stat(path).st_mode | stat.S_IWUSR)
+    os.chmod(directory, os.stat(directory).st_mode | stat.S_IWUSR)
+    shutil.rmtree(directory)
+
+
+def _get_used_snapshots(directory):
+    """Return the real paths of the snapshots that bots under |directory|
+    link to."""
+    bots_dir = os.path.join(directory, BOTS_DIRECTORY)
+    if not os.path.isdir(bots_dir):
+        return set()
+
+    used = set()
+    for name in os.listdir(bots_dir):
+        resources_link = os.path.join(bots_dir, name, 'working_directory',
+                                      'resources')
+        if os.path.islink(resources_link):
+            used.add(os.path.dirname(os.path.realpath(resources_link)))
+    return used
+
+
+def _prune_source_snapshots(directory, keep):
+    """Remove the snapshots under |directory| that no bot uses, except
+    |keep|. Snapshots still being staged are left alone."""
+    snapshots_dir = os.path.join(directory, SNAPSHOTS_DIRECTORY)
+    used = _get_used_snapshots(directory)
+    used.add(os.path.realpath(keep))
+    for name in os.listdir(snapshots_dir):
+        path = os.path.join(snapshots_dir, name)
+        if name.startswith('.staging-') or os.path.realpath(path) in used:
+            continue
+        print('Removing unused source snapshot %s...' % name)
+        _remove_read_only(path)
+
+
+def _create_source_snapshot(directory):
+    """Create the immutable source snapshot shared by all bots of this host,
+    re-using it if the sources have not changed. Returns its path."""
+    sources = get_bot_sources(os.environ['ROOT_DIR'])
+    snapshots_dir = os.path.join(directory, SNAPSHOTS_DIRECTORY)
+    os.makedirs(snapshots_dir, exist_ok=True)
+    snapshot_dir = os.path.join(snapshots_dir, _get_sources_digest(sources))
+    if os.path.exists(snapshot_dir):
+        print('Source snapshot already exists. Re-using...')
+        return snapshot_dir
+
+    print('Creating new source snapshot...')
+    staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=snapshots_dir)
+    for source, destination in sources:
+        if os.path.exists(source):
+            shutil.copytree(source, os.path.join(staging_dir, destination))
+
+    # Bots can't write bytecode into the read-only snapshot, so compile it
+    # once up front.
+    compileall.compile_dir(staging_dir, quiet=1)
+    _make_read_only(staging_dir)
+    os.rename(staging_dir, snapshot_dir)
+    _prune_source_snapshots(directory, snapshot_dir)
+    return snapshot_dir
+
+
+def _setup_bot_working_directory(bot_directory, snapshot_dir):
+    """Set up the private working directory of a bot sharing |snapshot_dir|.
+    Returns its path."""
+    working_directory = os.path.abspath(
+        os.path.join(bot_directory, 'working_directory'))
+    os.makedirs(working_directory, exist_ok=True)
+
+    template_dir = os.path.join(os.environ['ROOT_DIR'], 'working_directory')
+    if os.path.exists(template_dir):
+        common.update_dir(template_dir, working_directory)
+
+    resources_dir = os.path.join(snapshot_dir, 'resources')
+    resources_link = os.path.join(working_directory, 'resources')
+    if (os.path.exists(resources_dir) and
+            os.path.realpath(resources_link) != os.path.realpath(resources_dir)):
+        if os.path.isdir(resources_link) and not os.path.islink(resources_link):
+            shutil.rmtree(resources_link)
+        common.symlink(resources_dir, resources_link)
+
+    return working_directory
+
+
+def _get_bot_environment(bot_dir, name):
+    """Return the environment variables that differ between bots."""
+    tmpdir = os.path.join(bot_dir, 'bot_tmpdir')
+    if not os.path.exists(tmpdir):
+        os.mkdir(tmpdir)
+
+    return {
+        'BOT_DIR': bot_dir,
+        'BOT_NAME': name,
+        'TMPDIR': tmpdir,
+        'BOT_TMPDIR': tmpdir,
+    }
+
+
+def _get_max_fuzz_threads():
+    """Return MAX_FUZZ_THREADS from the bot configuration."""
+    import yaml
+
+    config_path = os.path.join(os.environ['ROOT_DIR'], 'config', 'bot',
+                               'config.yaml')
+    with open(config_path) as f:
+        config = yaml.safe_load(f) or {}
+
+    return max(1, int(config.get('MAX_FUZZ_THREADS', 1)))
+
+
+def _get_bot_cpus(count, threads_per_bot):
+    """Split the usable cores into one set of |threads_per_bot| cores per bot,
+    wrapping around when there are more bots than cores."""
+    cpus = sorted(os.sched_getaffinity(0))
+    if count * threads_per_bot > len(cpus):
+        print('Warning: {count} bots with {threads} fuzzing threads each '
+              'oversubscribe the {cpus} available cores.'.format(
+                  count=count, threads=threads_per_bot, cpus=len(cpus)))
+
+    threads_per_bot = min(threads_per_bot, len(cpus))
+    return [{
+        cpus[(index * threads_per_bot + offset) % len(cpus)]
+        for offset in range(threads_per_bot)
+    } for index in range(count)]
 
-    root_source = os.path.abspath(os.path.join(args.directory))
+
+def _setup_environment_and_configs(args, root_source):
+    """Set up environment variables and configuration files."""
+    root_source = os.path.abspath(root_source)
     # Matches startup scripts.
     if not args.testing:
         os.environ['PYTHONPATH'] = ''
@@ -90,21 +272,11 @@ def _setup_environment_and_configs(args):
         sys.path.insert(0, os.path.join(root_source, 'src/third_party'))
 
     os.environ['ROOT_DIR'] = os.path.abspath(os.path.join(root_source))
-    
-    os.environ['BOT_DIR'] = bot_dir
-    if not os.getenv('BOT_NAME'):
-        os.environ['BOT_NAME'] = args.name
 
     os.environ['LD_LIBRARY_PATH'] = '{0}:{1}'.format(
         os.path.join(root_source, 'src', 'bot',
                      'scripts'), os.getenv('LD_LIBRARY_PATH', ''))
 
-    tmpdir = os.path.join(bot_dir, 'bot_tmpdir')
-    if not os.path.exists(tmpdir):
-        os.mkdir(tmpdir)
-    os.environ['TMPDIR'] = tmpdir
-    os.environ['BOT_TMPDIR'] = tmpdir
-
     os.environ['KILL_STALE_INSTANCES'] = 'False'
     os.environ['LOCAL_DEVELOPMENT'] = 'True'
     #os.environ['DATASTORE_EMULATOR_HOST'] = constants.DATASTORE_EMULATOR_HOST
@@ -127,16 +299,85 @@ def _setup_environment_and_configs(args):
         os.environ['ANDROID_SERIAL'] = args.android_serial
 
 
-def execute(args):
-    """Run the bot."""
-    
-    bot_path = os.path.join(os.environ['ROOT_DIR'], 'src/bot')
-    # Do this everytime as a past deployment might have changed these.
-    appengine.sync_dirs(src_dir_py=os.environ['ROOT_DIR'], sub_configs=['bot', 'suppressions'])
+def create_bot(args, command, snapshot_dir, index, cpus=None):
+    """Return supervised bot number |index| running from |snapshot_dir|."""
+    name = '%s-%d' % (os.getenv('BOT_NAME') or args.name, index)
+    with profiler.span('copy.bot_directory', 'io'):
+        bot_dir = _setup_bot_working_directory(
+            os.path.join(args.directory, BOTS_DIRECTORY, name), snapshot_dir)
 
-    _setup_bot_directory(args)
-    _setup_environment_and_configs(args)
-    
+    if cpus:
+        print('Bot %s will run on cores %s.' % (
+            name, ','.join(str(cpu) for cpu in sorted(cpus))))
+    return supervisor.SupervisedProcess(
+        name, command,
+        extra_environments=_get_bot_environment(bot_dir, name),
+        cpus=cpus)
+
+
+def get_bot_cpus(count):
+    """Return the cores each of |count| bots of this host is pinned to."""
+    return _get_bot_cpus(count, _get_max_fuzz_threads())
+
+
+def _get_bots(args, command, snapshot_dir):
+    """Return |args.count| supervised bots sharing |snapshot_dir|."""
+    bot_cpus = get_bot_cpus(args.count)
+    return [
+        create_bot(args, command, snapshot_dir, index, bot_cpus[index])
+        for index in range(args.count)
+    ]
+
+
+def supervise(args, bots, on_poll=None):
+    """Run |bots| until stopped, restarting them when they exit. |on_poll| is
+    passed on to the supervisor and may add or remove bots."""
+    limits = supervisor.Limits(
+        max_rss_mb=args.max_rss_mb,
+        max_open_fds=args.max_open_fds,
+        max_child_processes=args.max_child_processes,
+        max_cpu_percent=args.max_cpu_percent)
+    bot_supervisor = supervisor.Supervisor(
+        bots, limits=limits, metrics_path=args.metrics_file,
+        metric_prefix='pingu_bot')
+
+    upload_bucket = None
+    if args.upload_logs:
+        upload_bucket = os.getenv('FUZZ_LOGS_BUCKET')
+        if not upload_bucket:
+            print('FUZZ_LOGS_BUCKET is not set, bot logs will not be uploaded.')
+    log_pipeline = bot_logs.LogPipeline(
+        args.log_dir or os.path.join(args.directory, 'logs'),
+        segment_size=args.log_segment_mb * 1024 * 1024,
+        # Echo by default when someone is watching.
+        echo=(sys.stdout.isatty()
+              if args.echo_logs is None else args.echo_logs),
+        upload_bucket=upload_bucket)
+    bot_supervisor.output_handler = log_pipeline.handle_output
+
+    signal.signal(signal.SIGTERM, bot_supervisor.stop)
+    try:
+        with profiler.span('bot.run', 'execution'):
+            bot_supervisor.run(on_poll)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_pipeline.close()
+    print('Bot has been stopped. Exit.')
+
+
+def _make_paths_absolute(args):
+    # The current working directory changes before the bots start.
+    args.directory = os.path.abspath(args.directory)
+    if args.metrics_file:
+        args.metrics_file = os.path.abspath(args.metrics_file)
+    if args.log_dir:
+        args.log_dir = os.path.abspath(args.log_dir)
+
+
+def _get_bot_command(args):
+    """Change into the bot sources and return the command running a bot."""
+    bot_path = os.path.join(os.environ['ROOT_DIR'], 'src/bot')
     if args.testing:
         os.chdir(bot_path)
         os.environ['BASE_DIR'] = bot_path
@@ -149,18 +390,45 @@ def execute(args):
 
     assert run_interpreter
     command_line = '%s %s ' % (run_interpreter, 'startup/run.py')
-    command = shlex.split(command_line, posix=True)
+    return shlex.split(command_line, posix=True)
 
-    try:
-        proc = common.execute_async(command)
 
-        def _stop_handler(*_):
-            print('Bot has been stopped. Exit.')
-            proc.kill()
+def prepare_shared_bots(args):
+    """Create the source snapshot shared by several bots and set up their
+    common environment. Returns the bot command and the snapshot path."""
+    _make_paths_absolute(args)
+    # Do this everytime as a past deployment might have changed these.
+    with profiler.span('copy.sync_dirs', 'io'):
+        appengine.sync_dirs(src_dir_py=os.environ['ROOT_DIR'], sub_configs=['bot', 'suppressions'])
 
-        signal.signal(signal.SIGTERM, _stop_handler)
-        common.process_proc_output(proc)
-        proc.wait()
+    with profiler.span('copy.source_snapshot', 'io'):
+        snapshot_dir = _create_source_snapshot(args.directory)
+    _setup_environment_and_configs(args, snapshot_dir)
+    return _get_bot_command(args), snapshot_dir
 
-    except KeyboardInterrupt:
-        _stop_handler()
+
+def execute(args):
+    """Run the bot, or |args.count| bots sharing one source snapshot."""
+    if args.count > 1:
+        if args.android_serial:
+            print('--android-serial can only be used with a single bot.')
+            return
+
+        command, snapshot_dir = prepare_shared_bots(args)
+        bots = _get_bots(args, command, snapshot_dir)
+    else:
+        _make_paths_absolute(args)
+        # Do this everytime as a past deployment might have changed these.
+        with profiler.span('copy.sync_dirs', 'io'):
+            appengine.sync_dirs(src_dir_py=os.environ['ROOT_DIR'], sub_configs=['bot', 'suppressions'])
+
+        with profiler.span('copy.bot_directory', 'io'):
+            _setup_bot_directory(args)
+        _setup_environment_and_configs(args, args.directory)
+        command = _get_bot_command(args)
+        os.environ.update(_get_bot_environment(
+            os.path.abspath(os.path.join(args.directory, 'working_directory')),
+            os.getenv('BOT_NAME') or args.name))
+        bots = [supervisor.SupervisedProcess(os.environ['BOT_NAME'], command)]
+
+    supervise(args, bots)
@@ -14,81 +14,206 @@
 
 
 """run_server.py run the Clusterfuzz server locally."""
+import concurrent.futures
+import importlib.util
 import os
 import shlex
+import signal
 import sys
 import threading
-import time
 import pika
 from src.local.butler import appengine
 from src.local.butler import common
 from src.local.butler import constants
+from local.butler import profiler
+from local.butler import queues
+from local.butler import service_health
+from local.butler import supervisor
+
+# docker-compose services of the stack, keyed like service_health probes.
+SERVICES = ['database', 'queue', 'minio']
+WSGI_APPLICATION = 'PinguBackend.wsgi:application'
+CELERY_APP = 'PinguBackend'
+
+
+def _get_running_services():
+  """Return the docker-compose services that are currently running."""
+  _, output = common.execute(
+      ['/bin/bash', '-c', 'docker-compose ps --services --filter status=running'],
+      print_output=False,
+      exit_on_error=False,
+      cwd=os.environ['ROOT_DIR'])
+  return set(output.decode('utf-8').split())
+
+
+def _start_services(probes, recreate):
+  """Start the stack's containers, reusing the running ones that are
+  healthy unless |recreate| is set."""
+  healthy = set()
+  if not recreate:
+    running = _get_running_services()
+    healthy = {
+        service for service in SERVICES
+        if service in running and probes[service]()
+    }
+  if healthy:
+    print('Reusing healthy containers: {}.'.format(', '.join(sorted(healthy))))
+
+  services = ' '.join(service for service in SERVICES if service not in healthy)
+  if not services:
+    return
+
+  # Shout down the other containers to ensure they start correctly
+  with profiler.span('process.docker_compose_down', 'process'):
+    common.execute(
+      command=['/bin/bash', '-c', 'docker-compose rm --stop --force ' + services],
+      cwd=os.environ['ROOT_DIR'])
+
+  with profiler.span('process.docker_compose_up', 'process'):
+    common.execute(
+      command=['/bin/bash', '-c', 'docker-compose up ' + services + ' --no-log-prefix -d'],
+      cwd=os.environ['ROOT_DIR'])
+
+
+def _wait_until_healthy(service, probes):
+  with profiler.span('bootstrap.wait_for_' + service, 'setup'):
+    service_health.wait_until_healthy(service, probes[service])
+
+
+def _bootstrap_database(probes, db_config, system_admin_config):
+  """Create the databases, migrate them and load the initial data."""
+  from src.backend.src.bootstrap import bootstrap_db, create_admin_user, load_initial_data
+
+  _wait_until_healthy('database', probes)
+  # Boostrap DB
+  with profiler.span('bootstrap.database', 'setup'):
+    bootstrap_db.create_databases(db_config)
+    bootstrap_db.apply_migrations()
+  # Boostrap super user
+  with profiler.span('bootstrap.admin_user', 'setup'):
+    create_admin_user.create_admin_user(system_admin_config)
+  # Boostrap default DB data
+  with profiler.span('bootstrap.initial_data', 'setup'):
+    load_initial_data.setup_templates()
+    load_initial_data.setup_fuzzers()
+
+
+def _bootstrap_queues(probes):
+  _wait_until_healthy('queue', probes)
+  # Boosttrap Queues with their options, reconciling existing ones.
+  with profiler.span('bootstrap.queues', 'setup'):
+    queues.reconcile(
+        queues.load_config(os.path.join(os.environ['ROOT_DIR'], 'config')))
+
+
+def _bootstrap(probes, db_config, system_admin_config):
+  """Run the independent bootstrap steps concurrently, each as soon as the
+  service it needs is healthy."""
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    futures = [
+        executor.submit(_bootstrap_database, probes, db_config,
+                        system_admin_config),
+        executor.submit(_bootstrap_queues, probes),
+        executor.submit(_wait_until_healthy, 'minio', probes),
+    ]
+    for future in futures:
+      future.result()
+
+
+def _get_dev_processes(args):
+  """Return the Django dev server and the Celery runner."""
+  # Django run server command
+  command_line = f"python manage.py runserver --settings {args.django_settings}"
+  return [
+      supervisor.SupervisedProcess(
+          'server', shlex.split(command_line, posix=True),
+          cwd=os.environ['ROOT_DIR']),
+      # Celery async beat and worker
+      supervisor.SupervisedProcess(
+          'celery', ['./celery_runner.sh'], cwd=os.environ['ROOT_DIR']),
+  ]
+
+
+def _get_prod_processes(args):
+  """Return a multi-worker WSGI server sized to the CPU count, and the Celery
+  worker and beat processes."""
+  workers = args.workers or 2 * len(os.sched_getaffinity(0)) + 1
+  system_env = service_health.load_service_env('system')
+  bind = '{host}:{port}'.format(
+      host=system_env.get('BACKEND_HOST', '0.0.0.0'),
+      port=system_env.get('BACKEND_PORT', 8086))
+  print('Serving on {bind} with {workers} workers.'.format(
+      bind=bind, workers=workers))
+
+  celery = [sys.executable, '-m', 'celery', '-A', CELERY_APP]
+  return [
+      supervisor.SupervisedProcess(
+          'server', [
+              sys.executable, '-m', 'gunicorn', WSGI_APPLICATION, '--workers',
+              str(workers), '--bind', bind, '--log-level', args.log_level,
+              '--access-logfile', '-'
+          ],
+          cwd=os.environ['ROOT_DIR']),
+      supervisor.SupervisedProcess(
+          'celery-worker', celery + ['worker', '--loglevel', args.log_level],
+          cwd=os.environ['ROOT_DIR']),
+      supervisor.SupervisedProcess(
+          'celery-beat', celery + ['beat', '--loglevel', args.log_level],
+          cwd=os.environ['ROOT_DIR']),
+  ]
 
 
 def execute(args):
   """Run the server."""
   if not args.skip_install_deps:
-    common.install_dependencies(packages=["backend"], )
+    with profiler.span('install.dependencies', 'install'):
+      common.install_dependencies(packages=["backend"], )
+
+  if args.prod and not importlib.util.find_spec('gunicorn'):
+    print('gunicorn is needed for --prod. Install it with '
+          '`pip install gunicorn`.')
+    return
 
   # Do this everytime as a past deployment might have changed these.
-  appengine.sync_dirs(src_dir_py=os.path.join('src', 'backend'), sub_configs=['redis', 'system', 'database', 'minio'])
+  with profiler.span('copy.sync_dirs', 'io'):
+    appengine.sync_dirs(src_dir_py=os.path.join('src', 'backend'), sub_configs=['redis', 'system', 'database', 'minio'])
 
   # TODO: Clean DB and Butckets if needed.
   #if args.bootstrap or args.clean:
   os.chdir(os.environ['ROOT_DIR'])
-  from src.backend.src.bootstrap import bootstrap_db, create_admin_user, load_initial_data, bootstrap_queues
-  _redis_config = bootstrap_queues.load_config()
+  from src.backend.src.bootstrap import bootstrap_db, create_admin_user
   _db_config = bootstrap_db.load_config()
   _system_admin_config = create_admin_user.load_config()
 
-  # Shout down all dockers to ensure everything starts correctly
-  common.execute(
-    command=['/bin/bash', '-c', 'docker-compose down database queue minio'],
-    cwd=os.environ['ROOT_DIR'])
-
   # Run Bucket server, redis and mongo DB
-  common.execute(
-    command=['/bin/bash', '-c', 'docker-compose up database queue minio --no-log-prefix -d'],
-    cwd=os.environ['ROOT_DIR'])
-  
+  probes = service_health.get_probes()
+  _start_services(probes, args.recreate_containers)
+
   if args.bootstrap:
-    time.sleep(10)
-    # Boostrap DB
-    bootstrap_db.create_databases(_db_config)
-    bootstrap_db.apply_migrations()
-    # Boosttrap Queues
-    bootstrap_queues.setup_queues(_redis_config)
-    # Boostrap super user
-    create_admin_user.create_admin_user(_system_admin_config)
-    # Boostrap default DB data
-    load_initial_data.setup_templates()
-    load_initial_data.setup_fuzzers()
-    
-    
+    _bootstrap(probes, _db_config, _system_admin_config)
+  else:
+    for service in SERVICES:
+      _wait_until_healthy(service, probes)
 
   os.environ['APPLICATION_ID'] = constants.TEST_APP_ID
   os.environ['LOCAL_DEVELOPMENT'] = 'True'
   os.environ['PINGU_ENV'] = 'dev'
-  try:
-    # Django run server command
-    command_line = f"python manage.py runserver --settings PinguBackend.settings.development"
-    command = shlex.split(command_line, posix=True)
+  os.environ['DJANGO_SETTINGS_MODULE'] = args.django_settings
 
-    common.execute(
-      command,
-      cwd=os.environ['ROOT_DIR']
-    )
-    
-    # Celery async beat and worker
-    celery_command = f"./celery_runner.sh"
-    
-    common.execute(
-      celery_command,
-      cwd=os.environ['ROOT_DIR']
-    )
-    
+  if args.prod:
+    processes = _get_prod_processes(args)
+  else:
+    processes = _get_dev_processes(args)
+
+  # Signals and shutdown of every server process are handled here.
+  server_supervisor = supervisor.Supervisor(
+      processes, metric_prefix='pingu_server')
+  signal.signal(signal.SIGTERM, server_supervisor.stop)
+  try:
+    with profiler.span('server.run', 'execution'):
+      server_supervisor.run()
   except KeyboardInterrupt:
-    print('Server has been stopped. Exit.')
-    #cron_server.terminate()
-    # Shout down all dockers to ensure everything starts correctly
-    common.execute(['/bin/bash', '-c', 'docker-compose down'])
+    pass
+
+  # The containers are left running so that the next start reuses them.
+  print('Server has been stopped. Exit.')
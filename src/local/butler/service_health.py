@@ -0,0 +1,128 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Readiness probes for the services of the local PinguCrew stack."""
+
+import functools
+import os
+import socket
+import struct
+import time
+import urllib.error
+import urllib.request
+
+PROBE_TIMEOUT = 2
+WAIT_TIMEOUT = 120
+WAIT_INTERVAL = 0.5
+POSTGRES_PROTOCOL_VERSION = 196608
+# SQLSTATE field of "the database system is starting up".
+POSTGRES_STARTING_UP = b'C57P03\0'
+AMQP_PROTOCOL_HEADER = b'AMQP\x00\x00\x09\x01'
+AMQP_FRAME_METHOD = 1
+
+
+def load_service_env(sub_config):
+  """Return the env section of a service's config.yaml, as synced into
+  ROOT_DIR by appengine.sync_dirs."""
+  import yaml
+
+  config_path = os.path.join(os.environ['ROOT_DIR'], 'config', sub_config,
+                             'config.yaml')
+  with open(config_path) as f:
+    return (yaml.safe_load(f) or {}).get('env') or {}
+
+
+def resolve_host(host):
+  """Docker service names only resolve inside the compose network, so fall
+  back to the ports published on this host."""
+  try:
+    socket.getaddrinfo(host, None)
+    return host
+  except socket.gaierror:
+    return '127.0.0.1'
+
+
+def probe_postgres(host, port, user):
+  """Whether Postgres accepts sessions. A ready server answers a startup
+  message with an authentication request, or an error other than still
+  starting up."""
+  parameters = b'user\0%s\0database\0postgres\0\0' % user.encode('utf-8')
+  message = struct.pack('!ii', 8 + len(parameters),
+                        POSTGRES_PROTOCOL_VERSION) + parameters
+  try:
+    with socket.create_connection((host, port), timeout=PROBE_TIMEOUT) as sock:
+      sock.sendall(message)
+      response = sock.recv(4096)
+  except OSError:
+    return False
+
+  if response[:1] == b'R':
+    return True
+  return response[:1] == b'E' and POSTGRES_STARTING_UP not in response
+
+
+def probe_rabbitmq(host, port):
+  """Whether RabbitMQ accepts AMQP connections, i.e. answers the protocol
+  header with a Connection.Start method frame."""
+  try:
+    with socket.create_connection((host, port), timeout=PROBE_TIMEOUT) as sock:
+      sock.sendall(AMQP_PROTOCOL_HEADER)
+      response = sock.recv(7)
+  except OSError:
+    return False
+
+  return len(response) == 7 and response[0] == AMQP_FRAME_METHOD
+
+
+def probe_minio(host, port):
+  """Whether MinIO reports itself ready to serve requests."""
+  url = 'http://%s:%d/minio/health/ready' % (host, port)
+  try:
+    with urllib.request.urlopen(url, timeout=PROBE_TIMEOUT) as response:
+      return response.status == 200
+  except (OSError, urllib.error.URLError):
+    return False
+
+
+def get_probes():
+  """Return the probe of each docker-compose service of the stack."""
+  database = load_service_env('database')
+  queue = load_service_env('redis')
+  minio = load_service_env('minio')
+  return {
+      'database':
+          functools.partial(probe_postgres,
+                            resolve_host(database.get('POSTGRES_HOST',
+                                                       'localhost')),
+                            int(database.get('POSTGRES_PORT', 5432)),
+                            database.get('POSTGRES_USER', 'postgres')),
+      'queue':
+          functools.partial(probe_rabbitmq,
+                            resolve_host(queue.get('QUEUE_HOST', 'localhost')),
+                            int(queue.get('QUEUE_PORT', 5672))),
+      'minio':
+          functools.partial(probe_minio,
+                            resolve_host(minio.get('MINIO_HOST', 'localhost')),
+                            int(minio.get('MINIO_API_PORT', 9000))),
+  }
+
+
+def wait_until_healthy(name, probe, timeout=WAIT_TIMEOUT):
+  """Poll |probe| until it succeeds, or raise after |timeout| seconds."""
+  deadline = time.time() + timeout
+  while not probe():
+    if time.time() > deadline:
+      raise RuntimeError('The {name} service did not become healthy within '
+                         '{timeout} seconds.'.format(name=name, timeout=timeout))
+    time.sleep(WAIT_INTERVAL)
@@ -0,0 +1,106 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""storage.py talks to the MinIO object store of a PinguCrew deployment."""
+import hashlib
+import io
+import os
+
+# User metadata holding the SHA-256 of an uploaded file, so that unchanged
+# files can be skipped without downloading them.
+SHA256_METADATA = 'sha256'
+# Canned ACL header for objects that bots read without credentials.
+PUBLIC_READ_METADATA = {'x-amz-acl': 'public-read'}
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_client():
+    """Return a MinIO client configured from the MINIO_* environment
+    variables."""
+    try:
+        import minio
+    except ImportError:
+        raise RuntimeError('The minio package is needed to access buckets. '
+                           'Install it with `pip install minio`.')
+
+    return minio.Minio(
+        '%s:%s' % (os.getenv('MINIO_HOST', 'localhost'),
+                   os.getenv('MINIO_API_PORT', '9000')),
+        access_key=os.getenv('MINIO_ACCESS_KEY'),
+        secret_key=os.getenv('MINIO_SECRET_KEY'),
+        secure=os.getenv('MINIO_SECURE', 'False').lower() == 'true')
+
+
+def upload_file(client, bucket_name, object_name, path,
+                content_type='application/octet-stream',
+                metadata=None,
+                part_size=0,
+                parallel_parts=1):
+    """Upload the file at |path| to |bucket_name|/|object_name|. Files larger
+    than |part_size| are uploaded in parts, |parallel_parts| at a time."""
+    client.fput_object(bucket_name, object_name, path,
+                       content_type=content_type,
+                       metadata=metadata,
+                       part_size=part_size,
+                       num_parallel_uploads=parallel_parts)
+
+
+def upload_data(client, bucket_name, object_name, data,
+                content_type='application/octet-stream',
+                metadata=None):
+    """Upload the bytes |data| to |bucket_name|/|object_name|. A single PUT
+    replaces an object atomically, readers see either the old or the new
+    content."""
+    client.put_object(bucket_name, object_name, io.BytesIO(data), len(data),
+                      content_type=content_type,
+                      metadata=metadata)
+
+
+def download_file(client, bucket_name, object_name, path):
+    """Download |bucket_name|/|object_name| to |path|."""
+    client.fget_object(bucket_name, object_name, path)
+
+
+def download_data(client, bucket_name, object_name):
+    """Return the content of |bucket_name|/|object_name|."""
+    response = client.get_object(bucket_name, object_name)
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def get_file_sha256(path):
+    """Return the hex SHA-256 of the file at |path|."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_object_sha256(client, bucket_name, object_name):
+    """Return the SHA-256 recorded when |object_name| was uploaded, or None
+    if the object does not exist or was uploaded without one."""
+    from minio.error import S3Error
+
+    try:
+        stat = client.stat_object(bucket_name, object_name)
+    except S3Error as e:
+        if e.code in ('NoSuchKey', 'NoSuchObject'):
+            return None
+        raise
+
+    return stat.metadata.get('x-amz-meta-' + SHA256_METADATA)
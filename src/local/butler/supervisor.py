@@ -0,0 +1,395 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""supervisor.py keeps long running local processes such as bots alive and
+watches their resource use."""
+import os
+import random
+import signal
+import subprocess
+import threading
+import time
+
+from local.butler import common
+
+POLL_INTERVAL = 1
+SAMPLE_INTERVAL = 10
+# Consecutive samples over a limit before a process tree is killed, so that
+# short spikes are tolerated.
+LIMIT_STRIKES = 3
+BASE_BACKOFF = 5
+MAX_BACKOFF = 300
+# A process that ran at least this long before exiting is restarted without
+# backoff.
+STABLE_RUN_TIME = 600
+# Seconds processes get to exit gracefully when the supervisor stops.
+STOP_TIMEOUT = 10
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+METRICS = [
+    ('up', 'Whether the process is running.'),
+    ('cpu_percent', 'CPU use of the process tree, in percent of one core.'),
+    ('rss_bytes', 'Resident memory of the process tree, summed per process.'),
+    ('open_fds', 'Open file descriptors of the process tree.'),
+    ('child_processes', 'Number of descendant processes.'),
+    ('restarts_total', 'Number of times the process was restarted.'),
+    ('limit_kills_total', 'Number of times the process tree was killed for '
+     'going over a resource limit.'),
+]
+
+
+def _read_stat(pid):
+    """Return the parent pid, CPU ticks and start time of |pid|, or None if it
+    is gone."""
+    try:
+        with open('/proc/%d/stat' % pid, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    # The command name in parentheses may itself contain spaces.
+    fields = data[data.rindex(b')') + 2:].split()
+    return int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[19])
+
+
+def _get_process_tree(root_pid):
+    """Return {pid: (cpu_ticks, start_time)} for |root_pid| and all of its
+    descendants."""
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            stat = _read_stat(int(entry))
+            if stat:
+                stats[int(entry)] = stat
+
+    children = {}
+    for pid, (parent_pid, _, _) in stats.items():
+        children.setdefault(parent_pid, []).append(pid)
+
+    tree = {}
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        if pid in stats:
+            tree[pid] = stats[pid][1:]
+            pending.extend(children.get(pid, []))
+
+    return tree
+
+
+def _get_rss_bytes(pid):
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def _count_open_fds(pid):
+    try:
+        return len(os.listdir('/proc/%d/fd' % pid))
+    except OSError:
+        return 0
+
+
+def _kill_processes(processes):
+    """SIGKILL the {pid: (cpu_ticks, start_time)} processes that still run,
+    skipping pids that were reused by another process since."""
+    for pid, (_, start_time) in processes.items():
+        stat = _read_stat(pid)
+        if not stat or stat[2] != start_time:
+            continue
+
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def _get_backoff(failures):
+    """Return the jittered delay before restarting after |failures|
+    consecutive failures."""
+    delay = min(MAX_BACKOFF, BASE_BACKOFF * 2**failures)
+    return random.uniform(delay / 2, delay)
+
+
+def _stop_processes(processes):
+    """Terminate |processes|, then kill the ones that did not exit within
+    STOP_TIMEOUT."""
+    for process in processes:
+        process.terminate()
+
+    deadline = time.time() + STOP_TIMEOUT
+    for process in processes:
+        process.wait_or_kill(max(0, deadline - time.time()))
+
+
+def print_output(name, proc):
+    """Print the output of the process |name| line by line."""
+    for line in iter(proc.stdout.readline, b''):
+        print('%s| %s' % (name, line.rstrip().decode('utf-8', errors='replace')))
+
+
+class Limits(object):
+    """Resource limits of a process tree. A limit of None is not enforced."""
+
+    def __init__(self,
+                 max_rss_mb=None,
+                 max_open_fds=None,
+                 max_child_processes=None,
+                 max_cpu_percent=None):
+        self.limits = {
+            'rss_bytes': max_rss_mb and max_rss_mb * 1024 * 1024,
+            'open_fds': max_open_fds,
+            'child_processes': max_child_processes,
+            'cpu_percent': max_cpu_percent,
+        }
+
+    def check(self, sample):
+        """Return a description of the limit |sample| is over, or None."""
+        for metric, limit in self.limits.items():
+            if limit is not None and sample[metric] > limit:
+                return '%s %d is over the limit of %d' % (metric, sample[metric],
+                                                          limit)
+
+        return None
+
+
+class SupervisedProcess(object):
+    """A process that is restarted whenever it exits."""
+
+    def __init__(self,
+                 name,
+                 command,
+                 extra_environments=None,
+                 cwd=None,
+                 cpus=None,
+                 output_handler=print_output):
+        self.name = name
+        self.command = command
+        self.extra_environments = extra_environments
+        self.cwd = cwd
+        self.cpus = cpus
+        self.output_handler = output_handler
+        self.proc = None
+        self.sample = None
+        self.restarts = 0
+        self.limit_kills = 0
+        self._failures = 0
+        self._started_at = None
+        self._restart_at = None
+        self._tree = {}
+        self._sampled_at = None
+        self._strikes = 0
+
+    def start(self):
+        self.proc = common.execute_async(
+            self.command,
+            extra_environments=self.extra_environments,
+            cwd=self.cwd)
+        if self.cpus:
+            os.sched_setaffinity(self.proc.pid, self.cpus)
+
+        self._started_at = time.time()
+        self._restart_at = None
+        self._tree = {}
+        self._sampled_at = None
+        self._strikes = 0
+        self.sample = None
+        threading.Thread(
+            target=self.output_handler, args=(self.name, self.proc),
+            daemon=True).start()
+
+    def poll(self):
+        """Restart the process if it is due, or schedule a restart if it
+        exited."""
+        if self.proc is None:
+            if time.time() >= self._restart_at:
+                self.restarts += 1
+                self.start()
+            return
+
+        if self.proc.poll() is None:
+            return
+
+        # Descendants that outlived the process were reparented away from it,
+        # kill the ones seen in the last sample so they can't leak.
+        _kill_processes(self._tree)
+        if time.time() - self._started_at >= STABLE_RUN_TIME:
+            self._failures = 0
+
+        delay = _get_backoff(self._failures)
+        self._failures += 1
+        self._restart_at = time.time() + delay
+        print('%s exited with code %d, restarting in %.0f seconds.' %
+              (self.name, self.proc.returncode, delay))
+        self.proc = None
+        self.sample = None
+
+    def sample_resources(self):
+        """Sample the resource use of the process tree from /proc."""
+        now = time.time()
+        tree = _get_process_tree(self.proc.pid)
+        cpu_percent = 0
+        if self._sampled_at:
+            ticks = 0
+            for pid, (cpu_ticks, start_time) in tree.items():
+                previous = self._tree.get(pid)
+                if previous and previous[1] == start_time:
+                    ticks += cpu_ticks - previous[0]
+                else:
+                    ticks += cpu_ticks
+            cpu_percent = 100 * ticks / CLOCK_TICKS / (now - self._sampled_at)
+
+        self._tree = tree
+        self._sampled_at = now
+        self.sample = {
+            'cpu_percent': cpu_percent,
+            'rss_bytes': sum(_get_rss_bytes(pid) for pid in tree),
+            'open_fds': sum(_count_open_fds(pid) for pid in tree),
+            'child_processes': max(0, len(tree) - 1),
+        }
+        return self.sample
+
+    def enforce(self, limits):
+        """Kill the process tree if it stayed over |limits| for too long."""
+        violation = limits.check(self.sample)
+        self._strikes = self._strikes + 1 if violation else 0
+        if self._strikes < LIMIT_STRIKES:
+            return
+
+        print('Killing %s: %s.' % (self.name, violation))
+        self.limit_kills += 1
+        self._strikes = 0
+        _kill_processes(self._tree)
+
+    def terminate(self):
+        """Ask the process to exit."""
+        if self.proc is None:
+            return
+
+        self._tree = _get_process_tree(self.proc.pid)
+        self.proc.terminate()
+
+    def wait_or_kill(self, timeout):
+        """Wait up to |timeout| seconds for a terminated process to exit,
+        then kill whatever is left of its tree."""
+        if self.proc is None:
+            return
+
+        try:
+            self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            pass
+        _kill_processes(self._tree)
+        self.proc.wait()
+
+
+class Supervisor(object):
+    """Runs processes, restarts them with jittered exponential backoff, and
+    samples and limits their resource use."""
+
+    def __init__(self,
+                 processes,
+                 limits=None,
+                 metrics_path=None,
+                 metric_prefix='pingu_process',
+                 sample_interval=SAMPLE_INTERVAL,
+                 output_handler=None):
+        self.processes = processes
+        self.limits = limits or Limits()
+        self.metrics_path = metrics_path
+        self.metric_prefix = metric_prefix
+        self.sample_interval = sample_interval
+        # Overrides the output handler of every process when set.
+        self.output_handler = output_handler
+        self._stopped = False
+
+    def _start(self, process):
+        if self.output_handler:
+            process.output_handler = self.output_handler
+        process.start()
+
+    def add(self, process):
+        """Start |process| and supervise it."""
+        self._start(process)
+        self.processes.append(process)
+
+    def remove(self, processes):
+        """Stop |processes| gracefully and stop supervising them."""
+        for process in processes:
+            self.processes.remove(process)
+        _stop_processes(processes)
+
+    def _sample(self):
+        for process in self.processes:
+            if process.proc is None:
+                continue
+
+            process.sample_resources()
+            process.enforce(self.limits)
+
+        if self.metrics_path:
+            self._write_metrics()
+
+    def _write_metrics(self):
+        """Write the samples in the Prometheus text format, atomically so that
+        a textfile collector never reads a partial file."""
+        lines = []
+        for metric, description in METRICS:
+            name = '%s_%s' % (self.metric_prefix, metric)
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' %
+                         (name,
+                          'counter' if metric.endswith('_total') else 'gauge'))
+            for process in self.processes:
+                values = dict(
+                    process.sample or {},
+                    up=int(process.proc is not None),
+                    restarts_total=process.restarts,
+                    limit_kills_total=process.limit_kills)
+                if metric in values:
+                    lines.append('%s{name="%s"} %s' %
+                                 (name, process.name, values[metric]))
+
+        temporary_path = self.metrics_path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temporary_path, self.metrics_path)
+
+    def run(self, on_poll=None):
+        """Run until stop() is called, then stop all processes. |on_poll| is
+        called after every poll and may add or remove processes."""
+        try:
+            for process in self.processes:
+                self._start(process)
+
+            next_sample = time.time() + self.sample_interval
+            while not self._stopped:
+                for process in self.processes:
+                    process.poll()
+                if on_poll:
+                    on_poll(self)
+
+                if time.time() >= next_sample:
+                    self._sample()
+                    next_sample = time.time() + self.sample_interval
+                time.sleep(POLL_INTERVAL)
+        finally:
+            _stop_processes(self.processes)
+
+    def stop(self, *_):
+        """Stop supervising. Safe to use as a signal handler."""
+        self._stopped = True
@@ -15,6 +15,7 @@
 import json
 import configparser
 import multiprocessing
+import os
 import pika
 
 
@@ -70,6 +71,9 @@ class PythonTemplateVerifier(object):
         connection = pika.BlockingConnection(
             pika.ConnectionParameters(self.config['DEFAULT']['queue_host']))
         channel = connection.channel()
+        # Set by butler from the prefetch option of the queue.
+        channel.basic_qos(
+            prefetch_count=int(os.environ.get('QUEUE_PREFETCH_COUNT', 1)))
         channel.basic_consume(self._on_test_case,
                               self.config['DEFAULT']['in_queue'])
         try:
@@ -0,0 +1,110 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the autoscale scaling policy."""
+import pytest
+
+from local.butler import autoscale
+
+
+class FakeApi(object):
+
+    def __init__(self, queues):
+        self.queues = queues
+
+    def get_queues(self):
+        return self.queues
+
+
+def test_get_queue_load():
+    api = FakeApi({
+        'a': {'messages_ready': 3, 'messages_unacknowledged': 1,
+              'consumers': 2},
+        'b': {'messages_ready': 4, 'messages_unacknowledged': 2,
+              'consumers': 5},
+        'dead': {'messages_ready': 100},
+    })
+    assert autoscale.get_queue_load(api, ['a', 'b', 'missing']) == (7, 3, 5)
+
+
+def test_invalid_bounds():
+    with pytest.raises(ValueError):
+        autoscale.ScalingPolicy(3, 2)
+    with pytest.raises(ValueError):
+        autoscale.ScalingPolicy(-1, 2)
+
+
+def test_wanted_count_deducts_remote_consumers():
+    policy = autoscale.ScalingPolicy(0, 10, messages_per_process=10)
+    assert policy.get_wanted_count(55, 0, 2, 2) == 6
+    # Three consumers belong to other hosts.
+    assert policy.get_wanted_count(55, 0, 5, 2) == 3
+
+
+def test_wanted_count_is_bounded():
+    policy = autoscale.ScalingPolicy(1, 4, messages_per_process=10)
+    assert policy.get_wanted_count(0, 0, 0, 2) == 1
+    assert policy.get_wanted_count(1000, 0, 0, 2) == 4
+
+
+def test_wanted_count_keeps_busy_processes():
+    policy = autoscale.ScalingPolicy(0, 10, messages_per_process=10)
+    assert policy.get_wanted_count(0, 4, 4, 4) == 4
+    # Two of the unacknowledged messages are held by remote consumers.
+    assert policy.get_wanted_count(0, 4, 6, 4) == 2
+    # Prefetched messages don't keep more processes than are running.
+    assert policy.get_wanted_count(0, 20, 3, 3) == 3
+
+
+def test_scale_up_waits_for_polls():
+    policy = autoscale.ScalingPolicy(0, 10, scale_up_polls=2, cooldown=0)
+    assert policy.decide(50, 0, 1, 1, now=0) == 1
+    assert policy.decide(50, 0, 1, 1, now=1) == 5
+
+
+def test_scale_down_waits_for_polls():
+    policy = autoscale.ScalingPolicy(0, 10, scale_down_polls=3, cooldown=0)
+    assert policy.decide(0, 0, 4, 4, now=0) == 4
+    assert policy.decide(0, 0, 4, 4, now=1) == 4
+    assert policy.decide(0, 0, 4, 4, now=2) == 0
+
+
+def test_direction_change_resets_polls():
+    policy = autoscale.ScalingPolicy(0, 10, scale_up_polls=2,
+                                     scale_down_polls=2, cooldown=0)
+    assert policy.decide(50, 0, 3, 3, now=0) == 3
+    assert policy.decide(0, 0, 3, 3, now=1) == 3
+    assert policy.decide(50, 0, 3, 3, now=2) == 3
+    assert policy.decide(50, 0, 3, 3, now=3) == 5
+
+
+def test_steady_load_resets_polls():
+    policy = autoscale.ScalingPolicy(0, 10, scale_up_polls=2, cooldown=0)
+    assert policy.decide(50, 0, 1, 1, now=0) == 1
+    assert policy.decide(10, 0, 1, 1, now=1) == 1
+    assert policy.decide(50, 0, 1, 1, now=2) == 1
+    assert policy.decide(50, 0, 1, 1, now=3) == 5
+
+
+def test_cooldown():
+    policy = autoscale.ScalingPolicy(0, 10, scale_up_polls=1, cooldown=100)
+    assert policy.decide(20, 0, 1, 1, now=0) == 2
+    assert policy.decide(50, 0, 2, 2, now=50) == 2
+    assert policy.decide(50, 0, 2, 2, now=100) == 5
+
+
+def test_current_out_of_bounds_is_clamped():
+    policy = autoscale.ScalingPolicy(2, 4, cooldown=1000)
+    assert policy.decide(0, 0, 0, 0, now=0) == 2
+    assert policy.decide(0, 0, 6, 6, now=0) == 4
@@ -0,0 +1,88 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the k-ary revision bisection."""
+import pytest
+
+from local.butler.reproduce_tool import bisection
+from local.butler.reproduce_tool import errors
+
+
+def _make_tester(change, untestable=(), calls=None):
+  """Return a test_revisions callback for a change introduced at |change|."""
+
+  def test_revisions(revisions):
+    if calls is not None:
+      calls.append(list(revisions))
+    return {
+        revision: None if revision in untestable else revision >= change
+        for revision in revisions
+    }
+
+  return test_revisions
+
+
+def test_pick_probes_splits_evenly():
+  assert bisection._pick_probes(list(range(1, 12)), 1) == [6]
+  assert bisection._pick_probes(list(range(1, 12)), 2) == [4, 8]
+  assert bisection._pick_probes(list(range(1, 12)), 3) == [3, 6, 9]
+
+
+def test_pick_probes_with_few_candidates():
+  assert bisection._pick_probes([5, 7], 4) == [5, 7]
+  assert bisection._pick_probes([5], 3) == [5]
+  assert bisection._pick_probes([], 3) == []
+
+
+def test_pick_probes_are_unique_and_sorted():
+  for size in range(1, 30):
+    candidates = list(range(size))
+    for ways in range(1, 8):
+      probes = bisection._pick_probes(candidates, ways)
+      assert probes == sorted(set(probes))
+      assert len(probes) == min(ways, size)
+
+
+@pytest.mark.parametrize('ways', [1, 2, 3, 7])
+@pytest.mark.parametrize('change', [1, 2, 50, 98, 99])
+def test_find_change(change, ways):
+  revisions = list(range(100))
+  assert bisection.find_change(revisions, _make_tester(change),
+                               ways) == (change - 1, change)
+
+
+def test_find_change_tests_ends_in_first_round():
+  calls = []
+  bisection.find_change(list(range(10)), _make_tester(5, calls=calls), 2)
+  assert calls[0][:2] == [0, 9]
+  assert all(len(call) <= 2 for call in calls[1:])
+
+
+def test_find_change_skips_untestable_revisions():
+  revisions = list(range(20))
+  before, after = bisection.find_change(
+      revisions, _make_tester(10, untestable={9, 10}), 3)
+  assert (before, after) == (8, 11)
+
+
+def test_find_change_needs_two_revisions():
+  with pytest.raises(errors.ReproduceToolUnrecoverableError):
+    bisection.find_change([1], _make_tester(1), 2)
+
+
+def test_find_change_checks_range_ends():
+  with pytest.raises(errors.ReproduceToolUnrecoverableError):
+    bisection.find_change(list(range(10)), _make_tester(0), 2)
+  with pytest.raises(errors.ReproduceToolUnrecoverableError):
+    bisection.find_change(list(range(10)), _make_tester(10), 2)
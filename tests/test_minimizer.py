@@ -0,0 +1,84 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the parallel delta debugging minimizer."""
+import pytest
+
+pytest.importorskip('pingu_sdk')
+
+from local.butler.reproduce_tool import errors  # pylint: disable=wrong-import-position
+from local.butler.reproduce_tool import minimizer  # pylint: disable=wrong-import-position
+
+
+class FakePool(object):
+  """Runs candidates in process with |reproduces| instead of a test run."""
+
+  def __init__(self, reproduces):
+    self.reproduces = reproduces
+    self.tested = []
+
+  def map(self, _, candidates):
+    self.tested.extend(candidates)
+    return [self.reproduces(candidate) for candidate in candidates]
+
+
+def test_split():
+  assert minimizer._split(list('abcdefg'), 3) == [['a', 'b'], ['c', 'd'],
+                                                  ['e', 'f', 'g']]
+  assert minimizer._split(list('ab'), 2) == [['a'], ['b']]
+
+
+def test_tokenize():
+  assert minimizer._tokenize(b'a\nb\nc', minimizer.LINES) == [
+      b'a\n', b'b\n', b'c'
+  ]
+  assert minimizer._tokenize(b'abc', minimizer.BYTES) == [b'a', b'b', b'c']
+
+
+def test_minimize_lines_and_bytes():
+  pool = FakePool(lambda data: b'crash' in data)
+  data = b'header\nfoo crash bar\nfooter\n'
+  assert minimizer.Minimizer(pool, 4).minimize(data) == b'crash'
+
+
+def test_minimize_keeps_needed_parts():
+  pool = FakePool(lambda data: b'A' in data and b'Z' in data)
+  assert minimizer.Minimizer(pool, 2).minimize(b'xxAyyyyZzz') == b'AZ'
+
+
+def test_minimize_never_tests_the_same_contents_twice():
+  pool = FakePool(lambda data: b'crash' in data)
+  minimizer.Minimizer(pool, 3).minimize(b'a\ncrash\nb\nc\nd\n')
+  assert len(pool.tested) == len(set(pool.tested))
+
+
+def test_find_reproducing_prefers_the_smallest_in_a_batch():
+  pool = FakePool(lambda data: b'x' in data)
+  instance = minimizer.Minimizer(pool, 3)
+  assert instance.find_reproducing([[b'ab'], [b'xxx'], [b'x']]) == 2
+
+
+def test_find_reproducing_uses_cached_results():
+  pool = FakePool(lambda data: data == b'b')
+  instance = minimizer.Minimizer(pool, 1)
+  assert instance.find_reproducing([[b'a'], [b'b']]) == 1
+  assert instance.find_reproducing([[b'a'], [b'b']]) == 1
+  assert instance.tests == 2
+  assert instance.cache_hits == 2
+
+
+def test_minimize_requires_a_reproducing_test_case():
+  pool = FakePool(lambda data: False)
+  with pytest.raises(errors.ReproduceToolUnrecoverableError):
+    minimizer.Minimizer(pool, 2).minimize(b'abc')
@@ -0,0 +1,81 @@
+# Copyright 2024 IOActive
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the reproducibility estimate."""
+import pytest
+
+pytest.importorskip('pingu_sdk')
+
+from local.butler.reproduce_tool import parallel  # pylint: disable=wrong-import-position
+
+
+def _make_estimate(crashes, attempts):
+  estimate = parallel.ReproducibilityEstimate()
+  for attempt in range(attempts):
+    estimate.add(attempt < crashes)
+  return estimate
+
+
+def test_empty_estimate():
+  estimate = parallel.ReproducibilityEstimate()
+  assert estimate.rate == 0.0
+  assert estimate.interval() == (0.0, 1.0)
+  assert not estimate.is_precise()
+
+
+def test_rate():
+  assert _make_estimate(3, 4).rate == 0.75
+
+
+def test_interval_contains_rate():
+  for crashes, attempts in [(0, 5), (1, 5), (5, 5), (40, 100)]:
+    estimate = _make_estimate(crashes, attempts)
+    lower, upper = estimate.interval()
+    assert 0.0 <= lower <= estimate.rate <= upper <= 1.0
+
+
+def test_interval_matches_wilson_score():
+  lower, upper = _make_estimate(5, 10).interval()
+  assert lower == pytest.approx(0.2366, abs=1e-4)
+  assert upper == pytest.approx(0.7634, abs=1e-4)
+
+
+def test_interval_narrows_with_attempts():
+  small_lower, small_upper = _make_estimate(5, 10).interval()
+  large_lower, large_upper = _make_estimate(50, 100).interval()
+  assert large_upper - large_lower < small_upper - small_lower
+
+
+def test_is_precise():
+  assert not _make_estimate(0, parallel.MIN_ESTIMATE_ATTEMPTS - 1).is_precise()
+  assert _make_estimate(1000, 1000).is_precise()
+  assert not _make_estimate(parallel.MIN_ESTIMATE_ATTEMPTS // 2,
+                            parallel.MIN_ESTIMATE_ATTEMPTS).is_precise()
+
+
+def test_devices():
+  estimate = parallel.ReproducibilityEstimate()
+  estimate.add(True, device='b')
+  estimate.add(False, device='a')
+  estimate.add(True, device='b')
+  estimate.add(True)
+  assert (estimate.crashes, estimate.attempts) == (3, 4)
+  assert (estimate.devices['a'].crashes, estimate.devices['a'].attempts) == (
+      0, 1)
+  assert (estimate.devices['b'].crashes, estimate.devices['b'].attempts) == (
+      2, 2)
+  lines = str(estimate).splitlines()
+  assert lines[0].startswith('3/4 attempts crashed (75%')
+  assert lines[1] == '  a: 0/1 attempts crashed'
+  assert lines[2] == '  b: 2/2 attempts crashed'